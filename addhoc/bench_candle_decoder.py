@@ -0,0 +1,54 @@
+# Micro-benchmark: per-instrument parse cost of the fast decoder vs the old json + DataFrame path.
+#
+#   python -m addhoc.bench_candle_decoder --candles 375 --iterations 2000
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+import pandas as pd
+import pytz
+from app.candle_decoder import decode_candle_response, candle_columns_to_frame
+
+IST = pytz.timezone("Asia/Kolkata")
+
+
+def make_body(n_candles: int) -> bytes:
+    start = IST.localize(datetime(2025, 6, 6, 15, 15))
+    candles = [
+        [(start - timedelta(minutes=15 * i)).isoformat(), 1520.5, 1524.85, 1518.1, 1522.3, 123456, 0]
+        for i in range(n_candles)
+    ]
+    return json.dumps({"status": "success", "data": {"candles": candles}}).encode()
+
+
+def old_path(body: bytes) -> pd.DataFrame:
+    candles_list = json.loads(body)["data"]["candles"]
+    candles_df = pd.DataFrame(candles_list, columns=["timestamp", "open", "high", "low", "close", "volume", "oi"])
+    candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"])
+    return candles_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Candle decoder micro-benchmark")
+    parser.add_argument("--candles", type=int, default=375, help="candles per response (2 weeks of 15m bars = 375)")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--instruments", type=int, default=500, help="universe size for the one-frame-per-cycle build")
+    args = parser.parse_args()
+
+    body = make_body(args.candles)
+    assert len(decode_candle_response(body)) == len(old_path(body))
+
+    old = timeit.timeit(lambda: old_path(body), number=args.iterations) / args.iterations
+    fast = timeit.timeit(lambda: decode_candle_response(body), number=args.iterations) / args.iterations
+
+    parts = [(f"NSE_EQ|{i}", "15m", decode_candle_response(body)) for i in range(args.instruments)]
+    frame = timeit.timeit(lambda: candle_columns_to_frame(parts), number=10) / 10
+
+    print(f"{args.candles} candles per response, {args.iterations} iterations")
+    print(f"  json + DataFrame + to_datetime : {old * 1e6:9.1f} us/instrument")
+    print(f"  decode_candle_response         : {fast * 1e6:9.1f} us/instrument ({old / fast:.1f}x)")
+    print(f"  one frame for {args.instruments} instruments  : {frame * 1e3:9.2f} ms/cycle")
+
+
+if __name__ == "__main__":
+    main()
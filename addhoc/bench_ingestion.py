@@ -0,0 +1,244 @@
+# End-to-end ingestion benchmark: the real intraday/historical jobs against the fake Upstox server
+# and a local Postgres/TimescaleDB (docker-compose up timescaledb).
+#
+#   python -m addhoc.bench_ingestion --universe 500 --latency-ms 80 --jitter-ms 40 --rate-limit 50
+#   python -m addhoc.bench_ingestion --universe 10000 --engine asyncio --save-baseline
+#   python -m addhoc.bench_ingestion --universe 500 --scenarios intraday --throttle-rate 0.02
+#
+# Writes go to a separate database (--db-name, created if missing) with a synthetic universe,
+# never to the one the service uses. Each scenario runs in a fresh process so peak RSS and
+# module state belong to that scenario alone. Results are compared with the baseline stored
+# under the same (scenario, engine, universe) key; a regression beyond --tolerance exits 1.
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from queue import Empty
+
+BASELINE_PATH = Path(__file__).with_name("bench_baseline.json")
+SCENARIOS = ("historical", "intraday")
+
+
+def _wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"fake Upstox server did not start on port {port}")
+
+
+def _ensure_database(db_name: str):
+    import psycopg2
+
+    conn = psycopg2.connect(
+        dbname="postgres", user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"), port=os.getenv("DB_PORT"),
+    )
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (db_name,))
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE "{db_name}"')
+    finally:
+        conn.close()
+
+
+def _prepare(universe: int):
+    from app.warmup import _prepare_schema
+    from app.db import sync_engine
+    from app.db_crud import sync_instrument_rows
+
+    _prepare_schema()
+    sync_instrument_rows(
+        (f"BENCH_EQ|BENCH{i:05d}", f"BENCH{i:05d}", f"Bench Instrument {i}", "Bench", "NSE_EQ", "EQ", True)
+        for i in range(universe)
+    )
+    with sync_engine.begin() as conn:
+        conn.exec_driver_sql("TRUNCATE candles")
+        conn.exec_driver_sql("DO $$ BEGIN IF to_regclass('candles_compact') IS NOT NULL THEN TRUNCATE candles_compact; END IF; END $$")
+        conn.exec_driver_sql("TRUNCATE ingest_workers")
+
+
+def _db_counters() -> dict:
+    from app.db import sync_engine
+
+    conn = sync_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_stat_clear_snapshot()")
+        cursor.execute("SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()")
+        counters = {"transactions": cursor.fetchone()[0], "statements": None}
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+        if cursor.fetchone():
+            cursor.execute("""
+                SELECT sum(calls) FROM pg_stat_statements s JOIN pg_database d ON d.oid = s.dbid
+                WHERE d.datname = current_database()
+            """)
+            counters["statements"] = int(cursor.fetchone()[0] or 0)
+        conn.commit()
+        return counters
+    finally:
+        conn.close()
+
+
+def _run_scenario(name: str, results):
+    # Runs in a spawned process with the bench environment already in os.environ
+    import numpy as np
+    from app import metrics
+    from app.jobs.load_intraday_15m_candles import loadIntradayFifteenMinutesCandles
+    from app.jobs.load_historical_15m_candles import loadHistoricalFifteenMinutesCandles
+    from app.db_crud import fetch_active_instruments
+
+    job = {"intraday": loadIntradayFifteenMinutesCandles, "historical": loadHistoricalFifteenMinutesCandles}[name]()
+    instruments = len(fetch_active_instruments())
+    before = _db_counters()
+    started = time.perf_counter()
+    job.run()
+    elapsed = time.perf_counter() - started
+    # pg_stat counters are flushed shortly after each transaction ends
+    time.sleep(1.0)
+    after = _db_counters()
+
+    per_instrument = {}
+    for (job_label, stage, instrument_key), seconds in metrics.INSTRUMENT_STAGE_SECONDS.values().items():
+        if job_label == name:
+            per_instrument[instrument_key] = per_instrument.get(instrument_key, 0.0) + seconds
+    latencies = np.array(list(per_instrument.values()) or [np.nan]) * 1000
+    stages = {
+        stage: round(state[1] / state[2] * 1000, 3)
+        for (job_label, stage), state in metrics.STAGE_SECONDS.values().items() if job_label == name and state[2]
+    }
+    candles = sum(metrics.CANDLES_WRITTEN.values().values())
+    retries = sum(metrics.UPSTOX_RETRIES.values().values())
+    statements = None
+    if before["statements"] is not None and after["statements"] is not None:
+        statements = after["statements"] - before["statements"]
+
+    results.put({
+        "scenario": name,
+        "instruments": instruments,
+        "instruments_fetched": len(per_instrument),
+        "seconds": round(elapsed, 3),
+        "instruments_per_second": round(len(per_instrument) / elapsed, 2),
+        "candles_written": int(candles),
+        "candles_per_second": round(candles / elapsed, 1),
+        "p50_instrument_ms": round(float(np.nanpercentile(latencies, 50)), 2),
+        "p99_instrument_ms": round(float(np.nanpercentile(latencies, 99)), 2),
+        "mean_stage_ms": stages,
+        "upstox_retries": int(retries),
+        "db_transactions": after["transactions"] - before["transactions"],
+        "db_statements": statements,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != "darwin" else 1024 ** 2), 1),
+    })
+
+
+# metric -> True when higher is better
+COMPARED = {
+    "instruments_per_second": True,
+    "candles_per_second": True,
+    "p99_instrument_ms": False,
+    "peak_rss_mb": False,
+}
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for metric, higher_is_better in COMPARED.items():
+        old, new = baseline.get(metric), result.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f"{metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the candle jobs end to end against a fake Upstox server")
+    parser.add_argument("--universe", type=int, default=500, help="synthetic instruments, e.g. 500 .. 10000")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated, run in this order")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default=os.getenv("INGEST_ENGINE", "threads"))
+    parser.add_argument("--historical-mode", choices=["full", "gaps"], default="full")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--rate-limit", type=float, default=0, help="fake server requests/s before 429")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="fraction of requests answered 429 at random")
+    parser.add_argument("--db-name", default=os.getenv("BENCH_DB_NAME", "stockdb_bench"))
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    _ensure_database(args.db_name)
+    # Everything the app reads at import time, inherited by the scenario processes
+    os.environ.update({
+        "DB_NAME": args.db_name,
+        "UPSTOX_BASE_URL": f"http://127.0.0.1:{args.port}",
+        "INGEST_ENGINE": args.engine,
+        "HISTORICAL_MODE": args.historical_mode,
+        "INGEST_ROLE": "all",
+    })
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "addhoc.fake_upstox_server", "--port", str(args.port),
+         "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+         "--rate-limit", str(args.rate_limit), "--throttle-rate", str(args.throttle_rate)],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for_port(args.port)
+        _prepare(args.universe)
+        context = multiprocessing.get_context("spawn")
+        results = []
+        for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+            queue = context.Queue()
+            process = context.Process(target=_run_scenario, args=(name, queue))
+            process.start()
+            while True:
+                try:
+                    results.append(queue.get(timeout=1))
+                    break
+                except Empty:
+                    if not process.is_alive():
+                        raise RuntimeError(f"scenario {name} exited with code {process.exitcode} before reporting")
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    baselines = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    failed = False
+    for result in results:
+        key = f"{result['scenario']}/{args.engine}/{args.universe}"
+        print(json.dumps({"key": key, **result}, indent=2))
+        if key in baselines:
+            regressions = compare(result, baselines[key], args.tolerance)
+            for line in regressions:
+                print(f"REGRESSION {key} {line}")
+            failed |= bool(regressions)
+        else:
+            print(f"no baseline for {key}")
+        if args.save_baseline:
+            baselines[key] = result
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"baseline written to {args.baseline}")
+    sys.exit(1 if failed and not args.save_baseline else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# Local stand-in for the Upstox v3 history endpoints, for exercising ingestion without the real API.
+#
+#   python -m addhoc.fake_upstox_server --port 8081
+#   python -m addhoc.fake_upstox_server --latency-ms 80 --jitter-ms 40 --rate-limit 50 --throttle-rate 0.01
+#   UPSTOX_BASE_URL=http://127.0.0.1:8081 INGEST_ENGINE=asyncio uvicorn app.main:app
+#   python -m addhoc.fake_upstox_server --ticks data/ticks/bench.jsonl --tick-speed 10
+#   MARKET_FEED_URL=ws://127.0.0.1:8081/v3/feed/market-data-feed MARKET_FEED_ENABLED=true uvicorn app.main:app
+import argparse
+import asyncio
+import json
+import random
+import time as clock
+import zlib
+from datetime import datetime, date, time, timedelta
+from aiohttp import web
+import pytz
+
+IST = pytz.timezone("Asia/Kolkata")
+SESSION_OPEN = time(9, 15)
+BARS_PER_SESSION = 25
+
+
+def session_bars(instrument_key: str, day: date, interval_minutes: int = 15, until: datetime = None) -> list:
+    # Deterministic per (instrument, day) so repeated calls return the same prices
+    rng = random.Random(zlib.crc32(f"{instrument_key}|{day.isoformat()}".encode()))
+    price = rng.uniform(50, 5000)
+    start = IST.localize(datetime.combine(day, SESSION_OPEN))
+    bars = []
+    for i in range(BARS_PER_SESSION * 15 // interval_minutes):
+        ts = start + timedelta(minutes=i * interval_minutes)
+        if until is not None and ts > until:
+            break
+        open_ = price
+        close = max(1.0, open_ * (1 + rng.gauss(0, 0.004)))
+        high = max(open_, close) * (1 + abs(rng.gauss(0, 0.002)))
+        low = min(open_, close) * (1 - abs(rng.gauss(0, 0.002)))
+        bars.append([ts.isoformat(), round(open_, 2), round(high, 2), round(low, 2), round(close, 2), rng.randint(1_000, 500_000), 0])
+        price = close
+    return bars
+
+
+def candles_response(candles: list) -> web.Response:
+    # Upstox returns newest candle first
+    return web.json_response({"status": "success", "data": {"candles": list(reversed(candles))}})
+
+
+def throttled_response(retry_after: float) -> web.Response:
+    return web.json_response(
+        {"status": "error", "errors": [{"errorCode": "UDAPI10005", "message": "Too Many Request Sent"}]},
+        status=429, headers={"Retry-After": f"{retry_after:g}"},
+    )
+
+
+def create_app(latency_ms: float = 0, jitter_ms: float = 0, rate_limit: float = 0, throttle_rate: float = 0,
+               retry_after: float = 0.5, ticks: str = None, tick_speed: float = 1.0) -> web.Application:
+    """`rate_limit` answers 429 above that many requests per second (token bucket, 1s burst),
+    `throttle_rate` additionally throttles that fraction of requests at random.
+    `ticks` is a message file (addhoc/tick_stream.py) the market-feed WebSocket replays to
+    every subscriber at `tick_speed` times the recorded pace, 0 = as fast as possible."""
+    rng = random.Random(0)
+    bucket = {"tokens": float(rate_limit), "updated": clock.monotonic()}
+    stats = {"requests": 0, "throttled": 0}
+
+    def should_throttle() -> bool:
+        stats["requests"] += 1
+        if rate_limit:
+            now = clock.monotonic()
+            bucket["tokens"] = min(float(rate_limit), bucket["tokens"] + (now - bucket["updated"]) * rate_limit)
+            bucket["updated"] = now
+            if bucket["tokens"] < 1:
+                stats["throttled"] += 1
+                return True
+            bucket["tokens"] -= 1
+        if throttle_rate and rng.random() < throttle_rate:
+            stats["throttled"] += 1
+            return True
+        return False
+
+    async def maybe_sleep():
+        delay = latency_ms + (rng.uniform(-jitter_ms, jitter_ms) if jitter_ms else 0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+    async def intraday(request: web.Request):
+        if should_throttle():
+            return throttled_response(retry_after)
+        await maybe_sleep()
+        now = datetime.now(IST)
+        interval = int(request.match_info["interval"])
+        return candles_response(session_bars(request.match_info["instrument_key"], now.date(), interval, until=now))
+
+    async def historical(request: web.Request):
+        if should_throttle():
+            return throttled_response(retry_after)
+        await maybe_sleep()
+        key = request.match_info["instrument_key"]
+        interval = int(request.match_info["interval"])
+        day = date.fromisoformat(request.match_info["from_date"])
+        to_day = date.fromisoformat(request.match_info["to_date"])
+        candles = []
+        while day <= to_day:
+            if day.weekday() < 5:
+                candles.extend(session_bars(key, day, interval))
+            day += timedelta(days=1)
+        return candles_response(candles)
+
+    async def server_stats(request: web.Request):
+        return web.json_response(stats)
+
+    async def market_feed(request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscribed = set()
+        first_subscription = asyncio.Event()
+
+        async def read_subscriptions():
+            async for msg in ws:
+                if msg.type in (web.WSMsgType.BINARY, web.WSMsgType.TEXT):
+                    request_body = json.loads(msg.data)
+                    keys = set(request_body.get("data", {}).get("instrumentKeys", []))
+                    if request_body.get("method") == "unsub":
+                        subscribed.difference_update(keys)
+                    else:
+                        subscribed.update(keys)
+                    first_subscription.set()
+
+        reader = asyncio.create_task(read_subscriptions())
+        try:
+            await first_subscription.wait()
+            first, started = None, clock.monotonic()
+            with open(ticks, "rb") as f:
+                for line in f:
+                    message = json.loads(line)
+                    at = int(message.get("currentTs") or 0) / 1000
+                    if tick_speed and at:
+                        first = first or at
+                        delay = (at - first) / tick_speed - (clock.monotonic() - started)
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    feeds = {k: v for k, v in message.get("feeds", {}).items() if k in subscribed}
+                    if feeds:
+                        await ws.send_str(json.dumps({**message, "feeds": feeds}))
+                    if ws.closed:
+                        break
+        finally:
+            reader.cancel()
+            await ws.close()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/v3/historical-candle/intraday/{instrument_key}/{unit}/{interval}", intraday)
+    app.router.add_get("/v3/historical-candle/{instrument_key}/{unit}/{interval}/{to_date}/{from_date}", historical)
+    app.router.add_get("/_stats", server_stats)
+    if ticks:
+        app.router.add_get("/v3/feed/market-data-feed", market_feed)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Upstox history API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0, help="uniform +/- jitter on top of --latency-ms")
+    parser.add_argument("--rate-limit", type=float, default=0, help="requests per second before answering 429, 0 = unlimited")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="fraction of requests answered with 429 at random")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After seconds sent with every 429")
+    parser.add_argument("--ticks", help="market-feed message file to replay over /v3/feed/market-data-feed")
+    parser.add_argument("--tick-speed", type=float, default=1.0, help="replay pace, 0 = as fast as possible")
+    args = parser.parse_args()
+    web.run_app(
+        create_app(args.latency_ms, args.jitter_ms, args.rate_limit, args.throttle_rate, args.retry_after,
+                   args.ticks, args.tick_speed),
+        host=args.host, port=args.port,
+    )
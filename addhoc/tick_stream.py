@@ -0,0 +1,118 @@
+# Synthetic market-feed tick streams for exercising app/market_feed.py without Upstox.
+#
+#   python -m addhoc.tick_stream generate data/ticks/bench.jsonl --universe 200 --day 2025-06-06
+#   python -m addhoc.tick_stream check data/ticks/bench.jsonl
+#   python -m app.market_feed replay data/ticks/bench.jsonl --dry-run
+#
+# Ticks are derived from the fake server's deterministic 15m bars (addhoc/fake_upstox_server.py),
+# one message per second in the v3 FeedResponse layout (fullFeed.marketFF with ltpc, vtt, oi).
+# `check` replays a file through the real decoder and aggregator and compares every 15m bar
+# with what the fake REST endpoints return for the same instrument and day.
+import argparse
+import asyncio
+import random
+import zlib
+from collections import defaultdict
+from datetime import date, datetime
+from pathlib import Path
+
+import orjson
+
+from addhoc.fake_upstox_server import session_bars
+
+
+def _bar_ticks(rng: random.Random, bar: list, bar_start: int, ticks_per_bar: int) -> list:
+    _, open_, high, low, close, volume, _ = bar
+    n = max(4, ticks_per_bar)
+    seconds = sorted(rng.sample(range(0, 15 * 60 - 1), n))
+    prices = [open_] + [round(rng.uniform(low, high), 2) for _ in range(n - 2)] + [close]
+    # the bar's high and low each land on one of the middle ticks
+    middle = rng.sample(range(1, n - 1), 2)
+    prices[middle[0]], prices[middle[1]] = high, low
+    cuts = sorted(rng.sample(range(1, volume), n - 1)) if volume > n else list(range(1, n))
+    quantities = [b - a for a, b in zip([0] + cuts, cuts + [max(volume, n)])]
+    return [(bar_start + s, p, q) for s, p, q in zip(seconds, prices, quantities)]
+
+
+def generate_messages(keys: list, day: date, ticks_per_bar: int = 8):
+    """Yield feed messages for a whole session, in time order, one per second that has trades."""
+    by_second = defaultdict(dict)
+    for key in keys:
+        rng = random.Random(zlib.crc32(f"ticks|{key}|{day.isoformat()}".encode()))
+        total = 0
+        for bar in session_bars(key, day):
+            bar_start = int(datetime.fromisoformat(bar[0]).timestamp())
+            for ts, price, quantity in _bar_ticks(rng, bar, bar_start, ticks_per_bar):
+                total += quantity
+                by_second[ts][key] = {"fullFeed": {"marketFF": {
+                    "ltpc": {"ltp": price, "ltt": str(ts * 1000), "ltq": str(quantity), "cp": bar[1]},
+                    "vtt": str(total),
+                    "oi": 0,
+                }}}
+    for ts in sorted(by_second):
+        yield {"type": "live_feed", "feeds": by_second[ts], "currentTs": str(ts * 1000)}
+
+
+def generate(path: Path, universe: int, day: date, ticks_per_bar: int):
+    keys = [f"BENCH_EQ|BENCH{i:05d}" for i in range(universe)]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    messages = 0
+    with path.open("wb") as f:
+        for message in generate_messages(keys, day, ticks_per_bar):
+            f.write(orjson.dumps(message) + b"\n")
+            messages += 1
+    print(f"{messages} messages for {universe} instruments on {day} written to {path}")
+
+
+def check(path: Path) -> int:
+    from app.market_feed import MarketFeed, FileTickSource
+
+    frames = []
+
+    def collect(frame):
+        frames.append(frame)
+        return len(frame)
+
+    feed = MarketFeed()
+    source = FileTickSource(str(path))
+    asyncio.run(feed.run(source, write=collect, after_bar_close=None, keys=source.instrument_keys()))
+    bars = [row for frame in frames for row in frame[frame["timeframe"] == "15m"].itertuples(index=False)]
+
+    expected = {}
+    for key in {bar.instrument_key for bar in bars}:
+        day = bars[0].timestamp.tz_convert("Asia/Kolkata").date()
+        for candle in session_bars(key, day):
+            expected[(key, int(datetime.fromisoformat(candle[0]).timestamp()))] = candle[1:6]
+
+    mismatches = 0
+    for bar in bars:
+        want = expected.get((bar.instrument_key, int(bar.timestamp.timestamp())))
+        got = [bar.open, bar.high, bar.low, bar.close, bar.volume]
+        if want is None or any(abs(a - b) > 1e-6 for a, b in zip(got, want)):
+            mismatches += 1
+            if mismatches <= 10:
+                print(f"MISMATCH {bar.instrument_key} {bar.timestamp}: streamed {got}, REST {want}")
+    print(f"{len(bars)} 15m bars from {feed.status()['ticks']} ticks, {len(expected)} expected, {mismatches} mismatches")
+    return 1 if mismatches or len(bars) != len(expected) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate or check synthetic market-feed tick streams")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gen = commands.add_parser("generate")
+    gen.add_argument("file", type=Path)
+    gen.add_argument("--universe", type=int, default=200)
+    gen.add_argument("--day", type=date.fromisoformat, default=date.today())
+    gen.add_argument("--ticks-per-bar", type=int, default=8)
+    chk = commands.add_parser("check")
+    chk.add_argument("file", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate(args.file, args.universe, args.day, args.ticks_per_bar)
+    else:
+        raise SystemExit(check(args.file))
+
+
+if __name__ == "__main__":
+    main()
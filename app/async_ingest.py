@@ -0,0 +1,310 @@
+# app/async_ingest.py - asyncio ingestion engine: aiohttp fetches, shared rate limiter, asyncpg COPY writes
+from app.db import ASYNCPG_DSN
+from app.rate_limiter import upstox_rate_limiter
+from app.concurrency import controllers
+from app.compact_candles import compact_schema_enabled, timeframe_code_sql, timeframe_name_sql
+from app.candle_batcher import INTRADAY_BATCH_SIZE, INTRADAY_FLUSH_INTERVAL
+from app.candle_decoder import decode_candle_response, UpstoxResponseError
+from app.db_crud import on_candles_written
+from app.delta_tracker import delta_tracker, INTRADAY_DELTA_WRITES
+from app.metrics import observe_stage, timed, CANDLES_WRITTEN, UPSTOX_RETRIES
+from app.upstox_replay import UPSTOX_MODE, key_from_url, recorder, archive
+from urllib.parse import quote
+from dotenv import load_dotenv
+import aiohttp
+import asyncpg
+import asyncio
+import pandas as pd
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# "asyncio" runs the candle jobs on this engine, "threads" keeps the ThreadPoolExecutor + SDK path
+INGEST_ENGINE = os.getenv("INGEST_ENGINE", "threads")
+UPSTOX_BASE_URL = os.getenv("UPSTOX_BASE_URL", "https://api.upstox.com").rstrip("/")
+UPSTOX_ACCESS_TOKEN = os.getenv("UPSTOX_ACCESS_TOKEN")
+# Hard cap on open HTTP connections; the adaptive controllers decide how many are actually used
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "200"))
+ASYNC_MAX_RETRIES = int(os.getenv("ASYNC_MAX_RETRIES", "3"))
+ASYNC_REQUEST_TIMEOUT = float(os.getenv("ASYNC_REQUEST_TIMEOUT", "30"))
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "4"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+STAGING_COLUMNS = ["instrument_key", "timeframe", "timestamp", "open", "high", "low", "close", "volume", "oi"]
+
+
+def intraday_url(instrument_key: str, unit: str = "minutes", interval: str = "15") -> str:
+    return f"{UPSTOX_BASE_URL}/v3/historical-candle/intraday/{quote(instrument_key, safe='')}/{unit}/{interval}"
+
+def historical_url(instrument_key: str, to_date: str, from_date: str, unit: str = "minutes", interval: str = "15") -> str:
+    return f"{UPSTOX_BASE_URL}/v3/historical-candle/{quote(instrument_key, safe='')}/{unit}/{interval}/{to_date}/{from_date}"
+
+def upstox_session() -> aiohttp.ClientSession:
+    headers = {"Accept": "application/json"}
+    if UPSTOX_ACCESS_TOKEN:
+        headers["Authorization"] = f"Bearer {UPSTOX_ACCESS_TOKEN}"
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=ASYNC_MAX_IN_FLIGHT),
+        headers=headers,
+        timeout=aiohttp.ClientTimeout(total=ASYNC_REQUEST_TIMEOUT),
+    )
+
+async def fetch_candle_body(http: aiohttp.ClientSession, url: str, endpoint: str) -> bytes:
+    if UPSTOX_MODE == "replay":
+        return await archive().get_async(key_from_url(url))
+    controller = controllers[endpoint]
+    requested = time.monotonic()
+    for attempt in range(ASYNC_MAX_RETRIES + 1):
+        await upstox_rate_limiter.async_acquire()
+        await controller.async_acquire()
+        started = time.monotonic()
+        status = 599
+        try:
+            async with http.get(url) as resp:
+                status = resp.status
+                if resp.status in RETRY_STATUSES and attempt < ASYNC_MAX_RETRIES:
+                    try:
+                        delay = float(resp.headers.get("Retry-After", ""))
+                    except ValueError:
+                        delay = 0.3 * 2 ** attempt
+                else:
+                    resp.raise_for_status()
+                    body = await resp.read()
+                    if UPSTOX_MODE == "record":
+                        recorder().record(key_from_url(url), body, time.monotonic() - requested)
+                    return body
+        finally:
+            await controller.async_release(time.monotonic() - started, status)
+        UPSTOX_RETRIES.inc(endpoint=endpoint, status=status)
+        await asyncio.sleep(delay)
+
+
+def _merge_sql(upsert: bool) -> list:
+    """Statements moving the staged rows into the candle table; the last one returns the
+    (instrument_key, timeframe, timestamp) of every row it inserted or updated."""
+    update_cols = ["open", "high", "low", "close", "volume", "oi"]
+    if compact_schema_enabled():
+        conflict = (
+            "DO UPDATE SET " + ", ".join(f"{c} = EXCLUDED.{c}" for c in update_cols) if upsert else "DO NOTHING"
+        )
+        return [
+            """
+            INSERT INTO instrument_ids (instrument_key)
+            SELECT DISTINCT instrument_key FROM async_candles_staging
+            ON CONFLICT (instrument_key) DO NOTHING
+            """,
+            f"""
+            WITH written AS (
+                INSERT INTO candles_compact (instrument_id, timeframe, timestamp, open, high, low, close, volume, oi)
+                SELECT i.id, {timeframe_code_sql('s.timeframe')}, s.timestamp, s.open, s.high, s.low, s.close, s.volume, s.oi
+                FROM async_candles_staging s
+                JOIN instrument_ids i ON i.instrument_key = s.instrument_key
+                ON CONFLICT ON CONSTRAINT candles_compact_pkey {conflict}
+                RETURNING instrument_id, timeframe, timestamp
+            )
+            SELECT i.instrument_key, {timeframe_name_sql('w.timeframe')}, w.timestamp
+            FROM written w
+            JOIN instrument_ids i ON i.id = w.instrument_id
+            """,
+        ]
+
+    conflict = (
+        "DO UPDATE SET " + ", ".join(f"{c} = EXCLUDED.{c}" for c in update_cols) if upsert else "DO NOTHING"
+    )
+    return [f"""
+        INSERT INTO candles ({', '.join(STAGING_COLUMNS)})
+        SELECT {', '.join(STAGING_COLUMNS)} FROM async_candles_staging
+        ON CONFLICT (instrument_key, timeframe, timestamp) {conflict}
+        RETURNING instrument_key, timeframe, timestamp
+    """]
+
+def _trim_sql() -> str:
+    if compact_schema_enabled():
+        return f"""
+            DELETE FROM candles_compact c
+            USING (
+                SELECT instrument_id, timeframe, timestamp FROM (
+                    SELECT instrument_id, timeframe, timestamp,
+                        ROW_NUMBER() OVER (PARTITION BY instrument_id, timeframe ORDER BY timestamp DESC) AS rn
+                    FROM candles_compact
+                    WHERE (instrument_id, timeframe) IN (
+                        SELECT DISTINCT i.id, {timeframe_code_sql('s.timeframe')}
+                        FROM async_candles_staging s
+                        JOIN instrument_ids i ON i.instrument_key = s.instrument_key
+                    )
+                ) AS ranked
+                WHERE rn > $1
+            ) AS old
+            WHERE c.instrument_id = old.instrument_id
+              AND c.timeframe = old.timeframe
+              AND c.timestamp = old.timestamp
+        """
+    return """
+        DELETE FROM candles c
+        USING (
+            SELECT id FROM (
+                SELECT id,
+                    ROW_NUMBER() OVER (PARTITION BY instrument_key, timeframe ORDER BY timestamp DESC) AS rn
+                FROM candles
+                WHERE (instrument_key, timeframe) IN (
+                    SELECT DISTINCT instrument_key, timeframe FROM async_candles_staging
+                )
+            ) AS ranked
+            WHERE rn > $1
+        ) AS old
+        WHERE c.id = old.id
+    """
+
+
+class AsyncCandleWriter:
+    """Buffers candle records from many instruments and writes them with COPY + one merge per flush."""
+
+    def __init__(self, pool: asyncpg.Pool, upsert: bool = True, retention: int = None,
+                 batch_size: int = INTRADAY_BATCH_SIZE, flush_interval: float = INTRADAY_FLUSH_INTERVAL,
+                 job: str = "intraday"):
+        self.pool = pool
+        self.job = job
+        self.upsert = upsert
+        self.retention = retention
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._records = []
+        self._last_flush = time.monotonic()
+        self._flush_lock = asyncio.Lock()
+        self.rows_written = 0
+        self.flushes = 0
+        self.failed_rows = 0
+
+    async def add(self, records: list):
+        self._records.extend(records)
+        if len(self._records) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        records, self._records = self._records, []
+        self._last_flush = time.monotonic()
+        if not records:
+            return
+        # ON CONFLICT can't touch the same row twice in one statement, keep the latest copy
+        records = list({(r[0], r[1], r[2]): r for r in records}.values())
+
+        try:
+            async with self._flush_lock:
+                started = time.perf_counter()
+                async with self.pool.acquire() as conn:
+                    observe_stage(self.job, "db_acquire", time.perf_counter() - started)
+                    transaction = conn.transaction()
+                    await transaction.start()
+                    try:
+                        started = time.perf_counter()
+                        await conn.execute("""
+                            CREATE TEMP TABLE IF NOT EXISTS async_candles_staging (
+                                instrument_key VARCHAR NOT NULL,
+                                timeframe VARCHAR NOT NULL,
+                                timestamp TIMESTAMPTZ NOT NULL,
+                                open FLOAT8 NOT NULL,
+                                high FLOAT8 NOT NULL,
+                                low FLOAT8 NOT NULL,
+                                close FLOAT8 NOT NULL,
+                                volume BIGINT NOT NULL,
+                                oi BIGINT NOT NULL
+                            ) ON COMMIT DELETE ROWS
+                        """)
+                        await conn.copy_records_to_table("async_candles_staging", records=records, columns=STAGING_COLUMNS)
+                        *setup, merge = _merge_sql(self.upsert)
+                        for sql in setup:
+                            await conn.execute(sql)
+                        written = await conn.fetch(merge)
+                        if self.retention:
+                            await conn.execute(_trim_sql(), self.retention)
+                    except Exception:
+                        await transaction.rollback()
+                        raise
+                    observe_stage(self.job, "write", time.perf_counter() - started)
+                    with timed(self.job, "commit"):
+                        await transaction.commit()
+        except Exception as e:
+            self.failed_rows += len(records)
+            logger.error(f"Async writer flush of {len(records)} candles failed: {e}")
+            return
+
+        if not self.upsert:
+            # DO NOTHING skipped the bars already stored; only the inserted ones are news to readers
+            inserted = {(row[0], row[1], row[2]) for row in written}
+            records = [r for r in records if (r[0], r[1], r[2]) in inserted]
+        self.rows_written += len(records)
+        self.flushes += 1
+        CANDLES_WRITTEN.inc(len(records), job=self.job)
+        on_candles_written(pd.DataFrame(records, columns=STAGING_COLUMNS))
+        logger.info(f"Async writer flushed {len(records)} candles.")
+
+    async def close(self):
+        await self.flush()
+
+
+async def _run_cycle(instrument_keys: list, endpoint: str, url_for, writer_kwargs: dict, min_candles: int = 0, keep_latest: int = None, delta: bool = False):
+    waited_before = upstox_rate_limiter.waited_seconds
+    pool = await asyncpg.create_pool(ASYNCPG_DSN, min_size=1, max_size=ASYNC_DB_POOL_SIZE)
+    writer = AsyncCandleWriter(pool, job=endpoint, **writer_kwargs)
+    started = time.monotonic()
+    failed = 0
+    try:
+        async with upstox_session() as http:
+
+            async def process_instrument(instrument_key: str):
+                nonlocal failed
+                try:
+                    fetch_started = time.perf_counter()
+                    body = await fetch_candle_body(http, url_for(instrument_key), endpoint)
+                    observe_stage(endpoint, "fetch", time.perf_counter() - fetch_started, instrument_key)
+                    try:
+                        with timed(endpoint, "parse", instrument_key):
+                            columns = decode_candle_response(body)
+                    except UpstoxResponseError as e:
+                        logger.error(f"Error fetching candles for {instrument_key} 15m: {e}")
+                        failed += 1
+                        return
+                    if delta:
+                        columns = delta_tracker.filter_columns(columns, instrument_key, "15m")
+                    records = columns.to_records(instrument_key, "15m")
+                    if len(records) < min_candles:
+                        logger.warning(f"{instrument_key}: Expected at least {min_candles} candles, got {len(records)}")
+                        return
+                    if not records:
+                        return
+                    if keep_latest:
+                        records = sorted(records, key=lambda r: r[2], reverse=True)[:keep_latest]
+                    await writer.add(records)
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Error fetching candles for {instrument_key}: {e}")
+
+            await asyncio.gather(*(process_instrument(key) for key in instrument_keys))
+            await writer.close()
+    finally:
+        await pool.close()
+
+    logger.info(
+        f"Async cycle finished in {time.monotonic() - started:.2f}s: {len(instrument_keys)} instruments, "
+        f"{writer.rows_written} candles written in {writer.flushes} flushes ({writer.failed_rows} failed), "
+        f"{failed} instruments failed, "
+        f"{upstox_rate_limiter.waited_seconds - waited_before:.2f}s spent waiting on the rate limiter, "
+        f"{endpoint} window now {controllers[endpoint].window}."
+    )
+
+
+async def run_intraday_cycle(instrument_keys: list):
+    await _run_cycle(instrument_keys, "intraday", intraday_url, {"upsert": True}, delta=INTRADAY_DELTA_WRITES)
+
+async def run_historical_cycle(instrument_keys: list, to_date: str, from_date: str, retention: int = 100):
+    await _run_cycle(
+        instrument_keys,
+        "historical",
+        lambda key: historical_url(key, to_date, from_date),
+        {"upsert": False, "retention": retention},
+        min_candles=retention,
+        keep_latest=retention,
+    )
@@ -0,0 +1,270 @@
+# app/backfill.py - Resumable multi-year historical backfill into candles_archive
+#
+#   python -m app.backfill --start 2022-01-01 --end 2025-06-30
+#   python -m app.backfill --status
+#
+# Every (instrument, request window) is a row in backfill_progress. A window is marked done in
+# the same transaction that COPYs its candles, so a crash or Ctrl-C loses at most the windows
+# still buffered, and the next run picks up exactly the ones that are not done.
+from app.db import ASYNCPG_DSN, Base, sync_engine
+from app.models import ArchiveCandle, BackfillProgress
+from app.async_ingest import upstox_session, fetch_candle_body, historical_url, STAGING_COLUMNS, ASYNC_DB_POOL_SIZE
+from app.candle_decoder import decode_candle_response
+from app.db_crud import fetch_active_instruments
+from app.logging_config import setup_logging
+from datetime import date, timedelta
+from dotenv import load_dotenv
+import argparse
+import asyncpg
+import asyncio
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "50"))
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "20000"))
+BACKFILL_MAX_ATTEMPTS = int(os.getenv("BACKFILL_MAX_ATTEMPTS", "5"))
+
+TIMEFRAME_SUFFIX = {"minutes": "m", "hours": "h", "days": "d"}
+
+
+def max_window_months(unit: str, interval: int) -> int:
+    # Largest range the v3 historical endpoint serves in one request
+    if unit == "minutes" and interval <= 15:
+        return 1
+    if unit in ("minutes", "hours"):
+        return 3
+    return 120
+
+
+def split_range(start: date, end: date, months: int) -> list:
+    """Inclusive (from, to) windows covering [start, end], cut on calendar-month boundaries."""
+    windows = []
+    cursor = start
+    while cursor <= end:
+        month_index = cursor.year * 12 + cursor.month - 1 + months
+        next_start = date(month_index // 12, month_index % 12 + 1, 1)
+        windows.append((cursor, min(end, next_start - timedelta(days=1))))
+        cursor = next_start
+    return windows
+
+
+class ArchiveWriter:
+    """Buffers fetched windows and writes them with one COPY + merge + checkpoint per flush."""
+
+    def __init__(self, pool: asyncpg.Pool, timeframe: str, batch_size: int = BACKFILL_BATCH_SIZE):
+        self.pool = pool
+        self.timeframe = timeframe
+        self.batch_size = batch_size
+        self._records = []
+        self._windows = []
+        self._flush_lock = asyncio.Lock()
+        self.rows_written = 0
+        self.windows_done = 0
+        self.failed_flushes = 0
+
+    async def add(self, instrument_key: str, window_start: date, records: list):
+        self._records.extend(records)
+        self._windows.append((instrument_key, window_start, len(records)))
+        if len(self._records) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        records, self._records = self._records, []
+        windows, self._windows = self._windows, []
+        if not windows:
+            return
+        keys, starts, counts = (list(column) for column in zip(*windows))
+
+        try:
+            async with self._flush_lock:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        if records:
+                            await conn.execute("""
+                                CREATE TEMP TABLE IF NOT EXISTS archive_staging (
+                                    instrument_key VARCHAR NOT NULL,
+                                    timeframe VARCHAR NOT NULL,
+                                    timestamp TIMESTAMPTZ NOT NULL,
+                                    open FLOAT8 NOT NULL,
+                                    high FLOAT8 NOT NULL,
+                                    low FLOAT8 NOT NULL,
+                                    close FLOAT8 NOT NULL,
+                                    volume BIGINT NOT NULL,
+                                    oi BIGINT NOT NULL
+                                ) ON COMMIT DELETE ROWS
+                            """)
+                            await conn.copy_records_to_table("archive_staging", records=records, columns=STAGING_COLUMNS)
+                            await conn.execute(f"""
+                                INSERT INTO candles_archive ({', '.join(STAGING_COLUMNS)})
+                                SELECT {', '.join(STAGING_COLUMNS)} FROM archive_staging
+                                ON CONFLICT ON CONSTRAINT candles_archive_pkey DO NOTHING
+                            """)
+                        await conn.execute("""
+                            UPDATE backfill_progress p
+                            SET status = 'done', rows = w.rows, attempts = p.attempts + 1, error = NULL, updated_at = now()
+                            FROM unnest($1::varchar[], $2::date[], $3::int[]) AS w(instrument_key, window_start, rows)
+                            WHERE p.instrument_key = w.instrument_key
+                              AND p.window_start = w.window_start
+                              AND p.timeframe = $4
+                        """, keys, starts, counts, self.timeframe)
+        except Exception as e:
+            # The windows stay pending and are fetched again on the next run
+            self.failed_flushes += 1
+            logger.error(f"Backfill flush of {len(windows)} windows ({len(records)} candles) failed: {e}")
+            return
+
+        self.rows_written += len(records)
+        self.windows_done += len(windows)
+
+
+async def _plan(pool: asyncpg.Pool, instrument_keys: list, timeframe: str, windows: list):
+    keys = [key for key in instrument_keys for _ in windows]
+    starts = [w[0] for _ in instrument_keys for w in windows]
+    ends = [w[1] for _ in instrument_keys for w in windows]
+    async with pool.acquire() as conn:
+        # A window cut short by an earlier --end is reopened when the range now reaches further
+        await conn.execute("""
+            INSERT INTO backfill_progress (instrument_key, timeframe, window_start, window_end, status, rows, attempts)
+            SELECT k, $4, s, e, 'pending', 0, 0
+            FROM unnest($1::varchar[], $2::date[], $3::date[]) AS w(k, s, e)
+            ON CONFLICT ON CONSTRAINT backfill_progress_pkey DO UPDATE
+            SET window_end = EXCLUDED.window_end, status = 'pending'
+            WHERE backfill_progress.window_end < EXCLUDED.window_end
+        """, keys, starts, ends, timeframe)
+        return await conn.fetch("""
+            SELECT instrument_key, window_start, window_end
+            FROM backfill_progress
+            WHERE timeframe = $1
+              AND instrument_key = ANY($2::varchar[])
+              AND window_start BETWEEN $3 AND $4
+              AND (status = 'pending' OR (status = 'failed' AND attempts < $5))
+            ORDER BY window_start DESC, instrument_key
+        """, timeframe, instrument_keys, windows[0][0], windows[-1][0], BACKFILL_MAX_ATTEMPTS)
+
+
+async def _mark_failed(pool: asyncpg.Pool, instrument_key: str, timeframe: str, window_start: date, error: str):
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE backfill_progress
+            SET status = 'failed', attempts = attempts + 1, error = $4, updated_at = now()
+            WHERE instrument_key = $1 AND timeframe = $2 AND window_start = $3
+        """, instrument_key, timeframe, window_start, error[:500])
+
+
+async def run_backfill(instrument_keys: list, start: date, end: date, unit: str = "minutes", interval: int = 15,
+                       workers: int = BACKFILL_WORKERS):
+    timeframe = f"{interval}{TIMEFRAME_SUFFIX[unit]}"
+    windows = split_range(start, end, max_window_months(unit, interval))
+    if not windows or not instrument_keys:
+        logger.info("Backfill: nothing to do.")
+        return
+
+    pool = await asyncpg.create_pool(ASYNCPG_DSN, min_size=1, max_size=ASYNC_DB_POOL_SIZE)
+    try:
+        pending = await _plan(pool, instrument_keys, timeframe, windows)
+        total = len(instrument_keys) * len(windows)
+        logger.info(
+            f"Backfill {timeframe} {start} .. {end}: {len(instrument_keys)} instruments x {len(windows)} windows, "
+            f"{len(pending)} of {total} still to fetch."
+        )
+
+        queue = asyncio.Queue()
+        for row in pending:
+            queue.put_nowait(tuple(row))
+        writer = ArchiveWriter(pool, timeframe)
+        started = time.monotonic()
+        failed = 0
+
+        async with upstox_session() as http:
+
+            async def worker():
+                nonlocal failed
+                while True:
+                    try:
+                        instrument_key, window_start, window_end = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    url = historical_url(
+                        instrument_key, window_end.isoformat(), window_start.isoformat(), unit, str(interval)
+                    )
+                    try:
+                        columns = decode_candle_response(await fetch_candle_body(http, url, "historical"))
+                        await writer.add(instrument_key, window_start, columns.to_records(instrument_key, timeframe))
+                    except Exception as e:
+                        failed += 1
+                        logger.error(f"Backfill {instrument_key} {window_start} .. {window_end} failed: {e}")
+                        await _mark_failed(pool, instrument_key, timeframe, window_start, str(e))
+
+            async def report():
+                while True:
+                    await asyncio.sleep(30)
+                    done = writer.windows_done
+                    rate = done / max(time.monotonic() - started, 1e-9)
+                    remaining = len(pending) - done - failed
+                    logger.info(
+                        f"Backfill progress: {done}/{len(pending)} windows, {writer.rows_written} candles, "
+                        f"{failed} failed, {rate:.1f} windows/s, ETA {remaining / rate / 60 if rate else 0:.0f} min."
+                    )
+
+            reporter = asyncio.create_task(report())
+            try:
+                await asyncio.gather(*(worker() for _ in range(min(workers, len(pending)) or 1)))
+                await writer.flush()
+            finally:
+                reporter.cancel()
+
+        logger.info(
+            f"Backfill finished in {time.monotonic() - started:.0f}s: {writer.windows_done} windows, "
+            f"{writer.rows_written} candles written, {failed} windows failed "
+            f"(retried on the next run up to {BACKFILL_MAX_ATTEMPTS} attempts)."
+        )
+    finally:
+        await pool.close()
+
+
+def print_status():
+    conn = sync_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT timeframe, status, count(*), sum(rows), min(window_start), max(window_end)
+            FROM backfill_progress GROUP BY timeframe, status ORDER BY timeframe, status
+        """)
+        for timeframe, status, windows, rows, first, last in cursor.fetchall():
+            print(f"{timeframe:>4} {status:<8} {windows:>8} windows {rows or 0:>12} candles  {first} .. {last}")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable historical candle backfill into candles_archive")
+    parser.add_argument("--start", type=date.fromisoformat, help="first day, e.g. 2022-01-01")
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today() - timedelta(days=1))
+    parser.add_argument("--instruments", help="comma-separated instrument keys (default: all active instruments)")
+    parser.add_argument("--unit", choices=sorted(TIMEFRAME_SUFFIX), default="minutes")
+    parser.add_argument("--interval", type=int, default=15)
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    parser.add_argument("--status", action="store_true", help="print checkpoint totals and exit")
+    args = parser.parse_args()
+
+    setup_logging()
+    Base.metadata.create_all(bind=sync_engine, tables=[ArchiveCandle.__table__, BackfillProgress.__table__])
+    if args.status:
+        print_status()
+        return
+    if args.start is None:
+        parser.error("--start is required")
+
+    if args.instruments:
+        keys = [key.strip() for key in args.instruments.split(",") if key.strip()]
+    else:
+        keys = [i.instrument_key for i in fetch_active_instruments()]
+    asyncio.run(run_backfill(keys, args.start, args.end, args.unit, args.interval, args.workers))
+
+
+if __name__ == "__main__":
+    main()
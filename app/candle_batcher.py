@@ -0,0 +1,106 @@
+# app/candle_batcher.py - Collects parsed candle frames across instruments and flushes them in bulk
+from app.db_crud import bulk_upsert_candles
+from app.candle_decoder import CandleColumns, candle_columns_to_frame
+from dotenv import load_dotenv
+import pandas as pd
+import threading
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# "batched" collects all instruments and flushes a few large upserts,
+# "per_instrument" keeps the old one-upsert-per-instrument behaviour
+INTRADAY_WRITE_MODE = os.getenv("INTRADAY_WRITE_MODE", "batched")
+INTRADAY_BATCH_SIZE = int(os.getenv("INTRADAY_BATCH_SIZE", "5000"))
+INTRADAY_FLUSH_INTERVAL = float(os.getenv("INTRADAY_FLUSH_INTERVAL", "5"))
+
+
+class CandleBatchCollector:
+    """Thread-safe buffer of candle frames that is written out with bulk_upsert_candles.
+
+    A flush happens once `batch_size` rows are buffered or `flush_interval` seconds
+    have passed since the last one, and always on close().
+    """
+
+    def __init__(self, batch_size: int = INTRADAY_BATCH_SIZE, flush_interval: float = INTRADAY_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._frames = []
+        self._columns = []
+        self._rows = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        # serializes the DB writes so fetch threads only wait on the buffer swap
+        self._flush_lock = threading.Lock()
+        self.rows_written = 0
+        self.flushes = 0
+        self.failed_rows = 0
+
+    def add(self, candles_df: pd.DataFrame, instrument_key: str, timeframe: str):
+        if candles_df.empty:
+            return
+        self._buffer(self._frames, candles_df.assign(instrument_key=instrument_key, timeframe=timeframe))
+
+    def add_columns(self, columns: CandleColumns, instrument_key: str, timeframe: str):
+        # Decoded NumPy columns are kept as-is and only turned into a DataFrame once per flush
+        if not len(columns):
+            return
+        self._buffer(self._columns, (instrument_key, timeframe, columns))
+
+    def _buffer(self, target: list, item):
+        with self._lock:
+            target.append(item)
+            self._rows += len(item) if not isinstance(item, tuple) else len(item[2])
+            due = (
+                self._rows >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+            batch = self._swap() if due else None
+
+        if batch:
+            self._write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._swap()
+        if batch:
+            self._write(batch)
+
+    def close(self):
+        self.flush()
+        logger.info(
+            f"Candle batch collector closed: {self.rows_written} rows written in {self.flushes} flushes, "
+            f"{self.failed_rows} rows failed."
+        )
+
+    def _swap(self):
+        if not self._frames and not self._columns:
+            return None
+        batch = (self._frames, self._columns)
+        self._frames = []
+        self._columns = []
+        self._rows = 0
+        self._last_flush = time.monotonic()
+        return batch
+
+    def _write(self, batch):
+        frames, columns = batch
+        if columns:
+            frames = frames + [candle_columns_to_frame(columns)]
+        batch_df = pd.concat(frames, ignore_index=True)
+        with self._flush_lock:
+            try:
+                self.rows_written += bulk_upsert_candles(batch_df)
+                self.flushes += 1
+            except Exception as e:
+                self.failed_rows += len(batch_df)
+                logger.error(f"Candle batch flush of {len(batch_df)} rows failed: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,263 @@
+# app/candle_bus.py - In-process fan-out of freshly written candles to WebSocket/SSE subscribers
+#
+# db_crud.on_candles_written publishes every committed batch here, so subscribers get the bars
+# straight from the writer: no polling and no DB reads. Each bar is serialized once; every
+# subscriber gets its own bounded queue, and one that falls that far behind is disconnected
+# rather than slowing the writers down or growing without bound.
+#
+# Writers run in other processes when ingestion is split off (INGEST_ROLE=worker / api), so
+# worker processes also relay their bars over Postgres NOTIFY, and every process with
+# subscribers LISTENs and fans the other processes' bars out to its own.
+from app.instrument_registry import instrument_registry
+from app.coordination import INGEST_ROLE
+from app.db import sync_engine, ASYNCPG_DSN
+from app.metrics import Counter, Gauge
+from dotenv import load_dotenv
+from datetime import datetime, timezone
+import pandas as pd
+import threading
+import asyncio
+import asyncpg
+import orjson
+import itertools
+import uuid
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Messages a subscriber may have queued before it is dropped as a slow consumer
+CANDLE_BUS_QUEUE_SIZE = int(os.getenv("CANDLE_BUS_QUEUE_SIZE", "256"))
+# NOTIFY committed bars to the other processes' buses. On by default only for INGEST_ROLE=worker,
+# whose bars are served by separate api processes; several sharded "all" processes turn it on
+CANDLE_BUS_RELAY = os.getenv("CANDLE_BUS_RELAY", str(INGEST_ROLE == "worker")).lower() == "true"
+CANDLE_BUS_CHANNEL = "candle_bus"
+# Postgres caps a NOTIFY payload just under 8000 bytes
+RELAY_PAYLOAD_BYTES = 7800
+
+BUS_SUBSCRIBERS = Gauge("candle_bus_subscribers", "Clients subscribed to pushed candles")
+BUS_BARS_PUBLISHED = Counter("candle_bus_bars_published_total", "Committed bars published to the candle bus")
+BUS_DROPPED = Counter("candle_bus_dropped_subscribers_total", "Subscribers disconnected for falling behind")
+BUS_BARS_RELAYED = Counter("candle_bus_bars_relayed_total", "Bars received from other processes over NOTIFY")
+
+
+class Subscription:
+    """One client's filters and queue. Empty filter sets match everything.
+
+    A bar matches when its timeframe is wanted and its instrument is either listed
+    directly or belongs to a listed industry.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue_size: int = CANDLE_BUS_QUEUE_SIZE):
+        self.id = next(self._ids)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.instrument_keys = set()
+        self.timeframes = set()
+        self.industries = set()
+        self.dropped = False
+        self.closed = False
+        self.sent = 0
+
+    def update(self, instrument_keys=(), timeframes=(), industries=(), remove: bool = False):
+        for target, values in ((self.instrument_keys, instrument_keys), (self.timeframes, timeframes),
+                               (self.industries, industries)):
+            if remove:
+                target.difference_update(values)
+            else:
+                target.update(v for v in values if v)
+
+    def filters(self) -> dict:
+        return {
+            "instrument_keys": sorted(self.instrument_keys),
+            "timeframes": sorted(self.timeframes),
+            "industries": sorted(self.industries),
+        }
+
+    def matches(self, instrument_key: str, timeframe: str, industry) -> bool:
+        if self.timeframes and timeframe not in self.timeframes:
+            return False
+        if not self.instrument_keys and not self.industries:
+            return True
+        return instrument_key in self.instrument_keys or industry in self.industries
+
+    def _wake(self):
+        # discard the backlog and leave a None for next() to return
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    def _put(self, message: bytes):
+        # runs on the subscriber's loop
+        if self.dropped or self.closed:
+            return
+        try:
+            self.queue.put_nowait(message)
+            self.sent += 1
+        except asyncio.QueueFull:
+            self.dropped = True
+            BUS_DROPPED.inc()
+            logger.warning(f"Candle bus subscriber {self.id} fell {self.queue.maxsize} messages behind, dropping it.")
+            self._wake()
+
+    def close(self):
+        """The client went away; must be called on the subscriber's loop."""
+        if not self.closed:
+            self.closed = True
+            self._wake()
+
+    async def next(self):
+        """Next serialized message, or None once the subscriber has been dropped or closed."""
+        message = await self.queue.get()
+        return None if self.dropped or self.closed else message
+
+
+def _relay_payloads(origin: str, bodies: list) -> list:
+    # "<origin> [bar,bar,...]" chunks, each under the NOTIFY payload limit
+    payloads, chunk, size = [], [], 0
+    for body in bodies:
+        if chunk and size + len(body) + 1 > RELAY_PAYLOAD_BYTES:
+            payloads.append(f"{origin} [{b','.join(chunk).decode()}]")
+            chunk, size = [], 0
+        chunk.append(body)
+        size += len(body) + 1
+    if chunk:
+        payloads.append(f"{origin} [{b','.join(chunk).decode()}]")
+    return payloads
+
+
+class CandleBus:
+    def __init__(self, relay: bool = CANDLE_BUS_RELAY):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self.relay = relay
+        # tags this process's NOTIFYs so its own listener skips bars it already fanned out
+        self.origin = uuid.uuid4().hex[:12]
+        self._listener = None
+
+    def subscribe(self) -> Subscription:
+        loop = asyncio.get_running_loop()
+        subscription = Subscription(loop)
+        with self._lock:
+            self._subscribers[subscription.id] = subscription
+            BUS_SUBSCRIBERS.set(len(self._subscribers))
+            if self._listener is None or self._listener.done():
+                self._listener = loop.create_task(self._listen())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.pop(subscription.id, None)
+            BUS_SUBSCRIBERS.set(len(self._subscribers))
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish_frame(self, candles_df: pd.DataFrame):
+        """Fan a committed batch (instrument_key, timeframe, timestamp, OHLCV, oi) out to the
+        subscribers, and relay it to the other processes' buses when relaying is on.
+
+        Called from the writer's thread; it serializes, NOTIFYs and hands each subscriber's
+        message to that subscriber's event loop. Without either there is nothing to do.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        if (not subscribers and not self.relay) or candles_df.empty:
+            return
+
+        timestamps = pd.to_datetime(candles_df["timestamp"], utc=True).to_numpy(dtype="datetime64[s]").astype("int64")
+        by_key = instrument_registry.snapshot().by_key
+        bars = []
+        for key, timeframe, ts, o, h, l, c, v, oi in zip(
+            candles_df["instrument_key"], candles_df["timeframe"], timestamps.tolist(),
+            candles_df["open"].tolist(), candles_df["high"].tolist(), candles_df["low"].tolist(),
+            candles_df["close"].tolist(), candles_df["volume"].tolist(), candles_df["oi"].fillna(0).tolist(),
+        ):
+            record = by_key.get(key)
+            body = orjson.dumps({
+                "instrument_key": key, "timeframe": timeframe,
+                "timestamp": datetime.fromtimestamp(ts, timezone.utc).isoformat(),
+                "open": float(o), "high": float(h), "low": float(l), "close": float(c),
+                "volume": int(v), "oi": int(oi),
+            })
+            bars.append((key, timeframe, record.industry if record is not None else None, body))
+        BUS_BARS_PUBLISHED.inc(len(bars))
+        if self.relay:
+            self._notify([body for *_, body in bars])
+        self._fan_out(subscribers, bars)
+
+    def _fan_out(self, subscribers: list, bars: list):
+        for subscriber in subscribers:
+            if subscriber.dropped or subscriber.closed:
+                continue
+            selected = [body for key, timeframe, industry, body in bars if subscriber.matches(key, timeframe, industry)]
+            if not selected:
+                continue
+            message = b'{"type":"candles","candles":[' + b",".join(selected) + b"]}"
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber._put, message)
+            except RuntimeError:
+                # the subscriber's loop is gone, e.g. the server is shutting down
+                self.unsubscribe(subscriber)
+
+
+    def _notify(self, bodies: list):
+        try:
+            conn = sync_engine.raw_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT pg_notify(%(channel)s, payload) FROM unnest(%(payloads)s::text[]) AS payload",
+                    {"channel": CANDLE_BUS_CHANNEL, "payloads": _relay_payloads(self.origin, bodies)},
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Error relaying {len(bodies)} bars to other processes: {e}")
+
+    def _on_notify(self, connection, pid, channel, payload: str):
+        origin, _, bars = payload.partition(" ")
+        if origin == self.origin:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        if not subscribers:
+            return
+        by_key = instrument_registry.snapshot().by_key
+        relayed = []
+        for bar in orjson.loads(bars):
+            record = by_key.get(bar["instrument_key"])
+            relayed.append((bar["instrument_key"], bar["timeframe"],
+                            record.industry if record is not None else None, orjson.dumps(bar)))
+        BUS_BARS_RELAYED.inc(len(relayed))
+        self._fan_out(subscribers, relayed)
+
+    async def _listen(self):
+        """LISTEN on the relay channel for as long as the loop runs, reconnecting on errors."""
+        delay = 1.0
+        while True:
+            try:
+                conn = await asyncpg.connect(ASYNCPG_DSN)
+                try:
+                    await conn.add_listener(CANDLE_BUS_CHANNEL, self._on_notify)
+                    logger.info("Candle bus listening for bars relayed from other processes.")
+                    delay = 1.0
+                    while not conn.is_closed():
+                        await asyncio.sleep(5)
+                finally:
+                    if not conn.is_closed():
+                        await conn.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Candle bus relay listener failed, reconnecting in {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+
+candle_bus = CandleBus()
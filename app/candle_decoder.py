@@ -0,0 +1,107 @@
+# app/candle_decoder.py - Fast decoder for raw Upstox candle responses into typed NumPy columns
+from typing import NamedTuple
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+import orjson
+import os
+
+load_dotenv()
+# "fast" decodes raw response bodies here, "sdk" goes through upstox_client's model deserializer
+UPSTOX_DECODER = os.getenv("UPSTOX_DECODER", "fast")
+
+CANDLE_VALUE_FIELDS = ("open", "high", "low", "close", "volume", "oi")
+
+
+class UpstoxResponseError(Exception):
+    pass
+
+
+class CandleColumns(NamedTuple):
+    timestamp: np.ndarray  # int64 epoch seconds, UTC
+    open: np.ndarray       # float64
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+    oi: np.ndarray
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def to_frame(self) -> pd.DataFrame:
+        return candle_columns_to_frame([(None, None, self)])
+
+    def to_records(self, instrument_key: str, timeframe: str) -> list:
+        # (instrument_key, timeframe, timestamp, open, high, low, close, volume, oi) tuples for asyncpg COPY
+        timestamps = [datetime.fromtimestamp(ts, timezone.utc) for ts in self.timestamp.tolist()]
+        return list(zip(
+            [instrument_key] * len(timestamps), [timeframe] * len(timestamps), timestamps,
+            self.open.tolist(), self.high.tolist(), self.low.tolist(), self.close.tolist(),
+            self.volume.astype(np.int64).tolist(), self.oi.astype(np.int64).tolist(),
+        ))
+
+
+EMPTY_COLUMNS = CandleColumns(np.empty(0, np.int64), *(np.empty(0, np.float64) for _ in CANDLE_VALUE_FIELDS))
+
+
+def _parse_timestamps(raw: list) -> np.ndarray:
+    # Upstox sends ISO-8601 with a fixed offset, e.g. "2025-06-06T15:15:00+05:30"
+    stamps = np.array(raw)
+    suffix = raw[0][19:]
+    if len(suffix) == 6 and suffix[0] in "+-" and np.char.endswith(stamps, suffix).all():
+        local = stamps.astype("U19").astype("datetime64[s]").astype(np.int64)
+        sign = 1 if suffix[0] == "+" else -1
+        offset = sign * (int(suffix[1:3]) * 3600 + int(suffix[4:6]) * 60)
+        return local - offset
+    # mixed or unusual offsets: let pandas sort it out
+    return pd.to_datetime(raw, utc=True).asi8 // 1_000_000_000
+
+
+def decode_candle_response(body: bytes) -> CandleColumns:
+    payload = orjson.loads(body)
+    if payload.get("status") != "success":
+        raise UpstoxResponseError(f"Upstox returned status {payload.get('status')}: {payload.get('errors') or payload}")
+
+    candles = (payload.get("data") or {}).get("candles")
+    if not candles:
+        return EMPTY_COLUMNS
+
+    # Some responses omit oi, so rows are padded to the full 6 values
+    values = np.zeros((len(candles), len(CANDLE_VALUE_FIELDS)), dtype=np.float64)
+    try:
+        values[:, :len(candles[0]) - 1] = [c[1:] for c in candles]
+        # a null (e.g. "oi": null) arrives as NaN; zero it like the ragged path below does
+        np.nan_to_num(values, copy=False, nan=0.0)
+    except ValueError:
+        # ragged rows, fill one by one
+        for i, c in enumerate(candles):
+            values[i, :len(c) - 1] = [v or 0 for v in c[1:]]
+
+    return CandleColumns(_parse_timestamps([c[0] for c in candles]), *values.T)
+
+
+def candle_columns_to_frame(parts: list) -> pd.DataFrame:
+    """Build one DataFrame from many (instrument_key, timeframe, CandleColumns) parts.
+
+    Columns are concatenated once, so a whole cycle costs a single DataFrame construction.
+    """
+    parts = [p for p in parts if len(p[2])]
+    if not parts:
+        return pd.DataFrame(columns=["timestamp", *CANDLE_VALUE_FIELDS])
+
+    frame = pd.DataFrame({
+        "timestamp": pd.to_datetime(np.concatenate([p[2].timestamp for p in parts]), unit="s", utc=True),
+        **{
+            field: np.concatenate([getattr(p[2], field) for p in parts])
+            for field in CANDLE_VALUE_FIELDS
+        },
+    })
+    if parts[0][0] is not None:
+        lengths = [len(p[2]) for p in parts]
+        frame["instrument_key"] = np.repeat([p[0] for p in parts], lengths)
+        frame["timeframe"] = np.repeat([p[1] for p in parts], lengths)
+    frame["volume"] = frame["volume"].astype(np.int64)
+    frame["oi"] = frame["oi"].astype(np.int64)
+    return frame
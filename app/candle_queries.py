@@ -0,0 +1,104 @@
+# app/candle_queries.py - Keyset-paginated candle reads on the async engine, no ORM or Decimal per row
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException
+from fastapi.responses import Response
+from app.compact_candles import candle_read_source
+from datetime import datetime, timezone
+import base64
+import orjson
+
+CANDLE_FIELDS = ["timestamp", "open", "high", "low", "close", "volume", "oi"]
+MAX_PAGE_SIZE = 5000
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def encode_cursor(instrument_key: str, ts: int) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps([instrument_key, ts])).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        instrument_key, ts = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return instrument_key, int(ts)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def fetch_candle_page(db: AsyncSession, instrument_keys: list, timeframe: str,
+                            start: datetime = None, end: datetime = None, limit: int = 500, cursor: str = None):
+    """One page of candles ordered by (instrument_key, timestamp DESC).
+
+    The ordering matches idx_instrument_timeframe_timestamp_desc, so each page is an index range
+    scan that starts right after the cursor row instead of an OFFSET.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    filters = ["instrument_key = ANY(:instrument_keys)", "timeframe = :timeframe"]
+    params = {"instrument_keys": instrument_keys, "timeframe": timeframe, "limit": limit + 1}
+    if start is not None:
+        filters.append("timestamp >= :start")
+        params["start"] = start
+    if end is not None:
+        filters.append("timestamp < :end")
+        params["end"] = end
+    if cursor:
+        params["cursor_key"], cursor_ts = decode_cursor(cursor)
+        params["cursor_ts"] = datetime.fromtimestamp(cursor_ts, timezone.utc)
+        filters.append(
+            "(instrument_key > :cursor_key OR (instrument_key = :cursor_key AND timestamp < :cursor_ts))"
+        )
+
+    result = await db.execute(text(f"""
+        SELECT instrument_key,
+               extract(epoch FROM timestamp)::bigint AS ts,
+               open::float8, high::float8, low::float8, close::float8,
+               volume, COALESCE(oi, 0) AS oi
+        FROM {candle_read_source()}
+        WHERE {' AND '.join(filters)}
+        ORDER BY instrument_key, timestamp DESC
+        LIMIT :limit
+    """), params)
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+    return rows, next_cursor
+
+
+def _group_rows(rows) -> dict:
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row[0], []).append(tuple(row[1:]))
+    return grouped
+
+def render_candle_page(rows, next_cursor: str, timeframe: str, fmt: str) -> Response:
+    if fmt == "arrow":
+        # pyarrow is heavy and only needed here, so import it on first use
+        import pyarrow as pa
+
+        columns = list(zip(*rows)) if rows else [[] for _ in range(len(CANDLE_FIELDS) + 1)]
+        table = pa.table({
+            "instrument_key": pa.array(columns[0], pa.string()),
+            "timestamp": pa.array(columns[1], pa.timestamp("s", tz="UTC")),
+            **{field: pa.array(columns[i + 2], pa.float64()) for i, field in enumerate(CANDLE_FIELDS[1:5])},
+            "volume": pa.array(columns[6], pa.int64()),
+            "oi": pa.array(columns[7], pa.int64()),
+        })
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+        return Response(sink.getvalue().to_pybytes(), media_type=ARROW_MEDIA_TYPE, headers=headers)
+
+    grouped = _group_rows(rows)
+    if fmt == "columnar":
+        candles = {
+            key: {field: list(values) for field, values in zip(CANDLE_FIELDS, zip(*key_rows))}
+            for key, key_rows in grouped.items()
+        }
+    else:
+        candles = grouped
+
+    body = {"timeframe": timeframe, "fields": CANDLE_FIELDS, "candles": candles, "next_cursor": next_cursor}
+    return Response(orjson.dumps(body), media_type="application/json")
@@ -0,0 +1,188 @@
+# app/candle_store.py - Process-local store of the latest candles per (instrument, timeframe)
+from app.db import sync_engine
+from app.compact_candles import candle_read_source
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+import threading
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Matches the 100 candles the historical sync retains per instrument + timeframe
+CANDLE_STORE_CAPACITY = int(os.getenv("CANDLE_STORE_CAPACITY", "100"))
+CANDLE_STORE_ENABLED = os.getenv("CANDLE_STORE_ENABLED", "true").lower() == "true"
+
+VALUE_FIELDS = ("open", "high", "low", "close", "volume", "oi")
+
+
+class CandleRingBuffer:
+    """Preallocated ring buffer of candles for one instrument + timeframe.
+
+    Every bar is written twice, at `pos` and `pos + capacity`, so the latest `size` bars
+    are always one contiguous slice and reads can hand out views without copying.
+    """
+
+    def __init__(self, capacity: int = CANDLE_STORE_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = np.zeros(2 * capacity, dtype=np.int64)
+        self.values = np.zeros((len(VALUE_FIELDS), 2 * capacity), dtype=np.float64)
+        self.head = 0  # next write position in [0, capacity)
+        self.size = 0
+
+    @property
+    def last_timestamp(self):
+        if not self.size:
+            return None
+        return int(self.timestamps[(self.head - 1) % self.capacity])
+
+    def _write(self, pos: int, ts: int, row):
+        self.timestamps[pos] = self.timestamps[pos + self.capacity] = ts
+        self.values[:, pos] = self.values[:, pos + self.capacity] = row
+
+    def append(self, ts: int, row):
+        self._write(self.head, ts, row)
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def update_last(self, row):
+        pos = (self.head - 1) % self.capacity
+        self._write(pos, self.timestamps[pos], row)
+
+    def upsert(self, ts: int, row):
+        last = self.last_timestamp
+        if last is None or ts > last:
+            self.append(ts, row)
+        elif ts == last:
+            self.update_last(row)
+        else:
+            # A late correction or a gap fill for an older bar
+            start = (self.head - self.size) % self.capacity
+            window = self.timestamps[start:start + self.size]
+            idx = int(np.searchsorted(window, ts))
+            if idx < self.size and window[idx] == ts:
+                self._write((start + idx) % self.capacity, ts, row)
+            elif idx > 0 or self.size < self.capacity:
+                self._insert(idx, ts, row)
+            # else: older than everything in a full buffer, so outside the window anyway
+
+    def _insert(self, idx: int, ts: int, row):
+        # Rebuild the window with the bar at position idx; a full buffer drops its oldest bar
+        start = (self.head - self.size) % self.capacity
+        timestamps = np.insert(self.timestamps[start:start + self.size], idx, ts)
+        values = np.insert(self.values[:, start:start + self.size], idx, row, axis=1)
+        self.load(timestamps, values)
+
+    def load(self, timestamps: np.ndarray, values: np.ndarray):
+        # Bulk (re)fill from oldest-first arrays, keeping the newest `capacity` bars
+        n = min(len(timestamps), self.capacity)
+        self.timestamps[:n] = self.timestamps[self.capacity:self.capacity + n] = timestamps[-n:]
+        self.values[:, :n] = self.values[:, self.capacity:self.capacity + n] = values[:, -n:]
+        self.head = n % self.capacity
+        self.size = n
+
+    def view(self, limit: int = None) -> dict:
+        """Zero-copy, oldest-first views of the latest `limit` bars.
+
+        Views are live: a later write shows through, so copy them if a stable snapshot is needed.
+        """
+        size = self.size if limit is None else min(limit, self.size)
+        end = (self.head - self.size) % self.capacity + self.size
+        start = end - size
+        out = {"timestamp": self.timestamps[start:end]}
+        for i, field in enumerate(VALUE_FIELDS):
+            out[field] = self.values[i, start:end]
+        for arr in out.values():
+            arr.flags.writeable = False
+        return out
+
+
+class CandleStore:
+    def __init__(self, capacity: int = CANDLE_STORE_CAPACITY):
+        self.capacity = capacity
+        self._buffers = {}
+        self._lock = threading.Lock()
+        # bumped on every write, lets readers cache derived results
+        self.version = 0
+
+    def _buffer(self, instrument_key: str, timeframe: str) -> CandleRingBuffer:
+        buffer = self._buffers.get((instrument_key, timeframe))
+        if buffer is None:
+            buffer = self._buffers[(instrument_key, timeframe)] = CandleRingBuffer(self.capacity)
+        return buffer
+
+    def ingest_frame(self, candles_df: pd.DataFrame):
+        """Apply written candle rows (instrument_key, timeframe, timestamp, OHLCV, oi) to the buffers."""
+        if candles_df.empty:
+            return
+        timestamps = pd.to_datetime(candles_df["timestamp"], utc=True).to_numpy(dtype="datetime64[s]").astype(np.int64)
+        values = candles_df[list(VALUE_FIELDS)].fillna(0).to_numpy(dtype=np.float64)
+        order = np.lexsort((timestamps, candles_df["timeframe"].to_numpy(), candles_df["instrument_key"].to_numpy()))
+
+        keys = candles_df["instrument_key"].to_numpy()[order]
+        timeframes = candles_df["timeframe"].to_numpy()[order]
+        timestamps = timestamps[order]
+        values = values[order]
+
+        with self._lock:
+            for i in range(len(order)):
+                self._buffer(keys[i], timeframes[i]).upsert(int(timestamps[i]), values[i])
+            self.version += 1
+
+    def get(self, instrument_key: str, timeframe: str, limit: int = None):
+        """Copies of the latest `limit` bars, taken under the lock so a concurrent write can't tear them."""
+        with self._lock:
+            buffer = self._buffers.get((instrument_key, timeframe))
+            if buffer is None:
+                return None
+            return {field: arr.copy() for field, arr in buffer.view(limit).items()}
+
+    def latest(self, instrument_key: str, timeframe: str):
+        with self._lock:
+            buffer = self._buffers.get((instrument_key, timeframe))
+            if buffer is None or not buffer.size:
+                return None
+            view = buffer.view(1)
+            return {field: arr[0].item() for field, arr in view.items()}
+
+    def keys(self, timeframe: str = None) -> list:
+        return [k for k in list(self._buffers) if timeframe is None or k[1] == timeframe]
+
+    def rebuild_from_db(self):
+        conn = sync_engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT instrument_key, timeframe, extract(epoch FROM timestamp)::bigint,
+                       open::float8, high::float8, low::float8, close::float8,
+                       volume::float8, COALESCE(oi, 0)::float8
+                FROM (
+                    SELECT *, ROW_NUMBER() OVER (
+                        PARTITION BY instrument_key, timeframe ORDER BY timestamp DESC
+                    ) AS rn
+                    FROM {candle_read_source()}
+                ) AS ranked
+                WHERE rn <= %(capacity)s
+                ORDER BY instrument_key, timeframe, timestamp
+            """, {"capacity": self.capacity})
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        buffers = {}
+        if rows:
+            frame = pd.DataFrame(rows, columns=["instrument_key", "timeframe", "timestamp", *VALUE_FIELDS])
+            for (instrument_key, timeframe), group in frame.groupby(["instrument_key", "timeframe"], sort=False):
+                buffer = CandleRingBuffer(self.capacity)
+                buffer.load(group["timestamp"].to_numpy(np.int64), group[list(VALUE_FIELDS)].to_numpy(np.float64).T)
+                buffers[(instrument_key, timeframe)] = buffer
+
+        with self._lock:
+            self._buffers = buffers
+            self.version += 1
+        logger.info(f"Candle store rebuilt from DB: {len(rows)} candles across {len(buffers)} series.")
+
+
+candle_store = CandleStore()
@@ -0,0 +1,183 @@
+# app/compact_candles.py - Compact candle layout: smallint ids, minute timeframes, float8 prices
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from app.db import sync_engine
+from app.models import CompactCandle, TIMEFRAME_CODES
+from dotenv import load_dotenv
+import pandas as pd
+import threading
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# "compact" routes the bulk candle writers to candles_compact, "legacy" keeps candles
+CANDLE_SCHEMA = os.getenv("CANDLE_SCHEMA", "legacy")
+
+# View with the legacy column names, so raw SQL readers work against either layout
+COMPACT_VIEW = "candles_compact_view"
+COMPACT_CHUNK_SIZE = 5000
+PRICE_COLUMNS = ["open", "high", "low", "close"]
+
+_id_cache = {}
+_id_lock = threading.Lock()
+
+def compact_schema_enabled() -> bool:
+    return CANDLE_SCHEMA == "compact"
+
+def candle_read_source() -> str:
+    return COMPACT_VIEW if compact_schema_enabled() else "candles"
+
+def timeframe_name_sql(column: str) -> str:
+    whens = " ".join(f"WHEN {column} = {code} THEN '{name}'" for name, code in TIMEFRAME_CODES.items())
+    return f"CASE {whens} END"
+
+def timeframe_code_sql(column: str) -> str:
+    whens = " ".join(f"WHEN {column} = '{name}' THEN {code}" for name, code in TIMEFRAME_CODES.items())
+    return f"CASE {whens} END"
+
+def create_compact_view(conn):
+    conn.execute(text(f"""
+        CREATE OR REPLACE VIEW {COMPACT_VIEW} AS
+        SELECT i.instrument_key,
+               {timeframe_name_sql('c.timeframe')} AS timeframe,
+               c.timestamp, c.open, c.high, c.low, c.close, c.volume, c.oi
+        FROM candles_compact c
+        JOIN instrument_ids i ON i.id = c.instrument_id
+    """))
+
+def instrument_ids_for(conn, instrument_keys) -> dict:
+    """Map instrument keys to their smallint ids, assigning ids to keys seen for the first time."""
+    keys = set(instrument_keys)
+    with _id_lock:
+        missing = [k for k in keys if k not in _id_cache]
+    if missing:
+        conn.execute(text("""
+            INSERT INTO instrument_ids (instrument_key)
+            SELECT unnest(CAST(:keys AS VARCHAR[]))
+            ON CONFLICT (instrument_key) DO NOTHING
+        """), {"keys": missing})
+        rows = conn.execute(text(
+            "SELECT instrument_key, id FROM instrument_ids WHERE instrument_key = ANY(:keys)"
+        ), {"keys": missing}).all()
+        with _id_lock:
+            _id_cache.update({row.instrument_key: row.id for row in rows})
+    with _id_lock:
+        return {k: _id_cache[k] for k in keys}
+
+def rows_in(candles_df: pd.DataFrame, keys) -> pd.DataFrame:
+    """The rows of `candles_df` whose (instrument_key, timeframe, timestamp) is among `keys`,
+    e.g. what an INSERT ... ON CONFLICT DO NOTHING RETURNING reported as inserted."""
+    wanted = {(key, timeframe, int(ts.timestamp())) for key, timeframe, ts in keys}
+    seconds = (pd.to_datetime(candles_df["timestamp"], utc=True) - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+    mask = [k in wanted for k in zip(candles_df["instrument_key"], candles_df["timeframe"], seconds)]
+    return candles_df[mask]
+
+def write_compact_candles(candles_df: pd.DataFrame, on_conflict: str = "update", retention: int = None) -> pd.DataFrame:
+    """Write legacy-shaped candle rows into candles_compact and return the rows actually written.
+
+    on_conflict="update" upserts (intraday), "nothing" keeps existing bars (historical), so only
+    the newly inserted rows come back. With `retention`, each touched instrument + timeframe is
+    trimmed to its latest N bars.
+    """
+    if candles_df.empty:
+        return candles_df
+
+    candles_df = candles_df.copy()
+    candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"], utc=True)
+    candles_df = candles_df.drop_duplicates(subset=["instrument_key", "timeframe", "timestamp"], keep="last")
+
+    with sync_engine.begin() as conn:
+        id_map = instrument_ids_for(conn, candles_df["instrument_key"].unique())
+        rows = pd.DataFrame({
+            "instrument_id": candles_df["instrument_key"].map(id_map).astype(int),
+            "timeframe": candles_df["timeframe"].map(TIMEFRAME_CODES).astype(int),
+            "timestamp": candles_df["timestamp"],
+            **{col: candles_df[col].astype(float) for col in PRICE_COLUMNS},
+            "volume": candles_df["volume"].astype("int64"),
+            "oi": candles_df["oi"].fillna(0).astype("int64"),
+        })
+
+        inserted = []
+        for start in range(0, len(rows), COMPACT_CHUNK_SIZE):
+            stmt = insert(CompactCandle).values(rows.iloc[start:start + COMPACT_CHUNK_SIZE].to_dict(orient="records"))
+            if on_conflict == "update":
+                stmt = stmt.on_conflict_do_update(
+                    constraint="candles_compact_pkey",
+                    set_={col: getattr(stmt.excluded, col) for col in PRICE_COLUMNS + ["volume", "oi"]}
+                )
+                conn.execute(stmt)
+            else:
+                stmt = stmt.on_conflict_do_nothing(constraint="candles_compact_pkey").returning(
+                    CompactCandle.instrument_id, CompactCandle.timeframe, CompactCandle.timestamp
+                )
+                inserted.extend(conn.execute(stmt).all())
+
+        if retention:
+            result = conn.execute(text("""
+                DELETE FROM candles_compact c
+                USING (
+                    SELECT instrument_id, timeframe, timestamp FROM (
+                        SELECT instrument_id, timeframe, timestamp,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY instrument_id, timeframe
+                                ORDER BY timestamp DESC
+                            ) AS rn
+                        FROM candles_compact
+                        WHERE instrument_id = ANY(:ids) AND timeframe = ANY(:timeframes)
+                    ) AS ranked
+                    WHERE rn > :retention
+                ) AS old
+                WHERE c.instrument_id = old.instrument_id
+                  AND c.timeframe = old.timeframe
+                  AND c.timestamp = old.timestamp
+            """), {
+                "ids": [int(i) for i in rows["instrument_id"].unique()],
+                "timeframes": [int(t) for t in rows["timeframe"].unique()],
+                "retention": retention,
+            })
+            logger.info(f"candles_compact: deleted {result.rowcount} old candles.")
+
+    if on_conflict != "update":
+        keys_by_id = {i: key for key, i in id_map.items()}
+        names_by_code = {code: name for name, code in TIMEFRAME_CODES.items()}
+        candles_df = rows_in(candles_df, [(keys_by_id[i], names_by_code[tf], ts) for i, tf, ts in inserted])
+    logger.info(f"candles_compact: wrote {len(candles_df)} of {len(rows)} candles across {len(id_map)} instruments.")
+    return candles_df
+
+def migrate_candles_to_compact():
+    """Copy everything in the legacy candles table into candles_compact (idempotent)."""
+    with sync_engine.begin() as conn:
+        create_compact_view(conn)
+        conn.execute(text("""
+            INSERT INTO instrument_ids (instrument_key)
+            SELECT DISTINCT instrument_key FROM candles
+            ON CONFLICT (instrument_key) DO NOTHING
+        """))
+        result = conn.execute(text(f"""
+            INSERT INTO candles_compact (instrument_id, timeframe, timestamp, open, high, low, close, volume, oi)
+            SELECT i.id, {timeframe_code_sql('c.timeframe')}, c.timestamp,
+                   c.open::float8, c.high::float8, c.low::float8, c.close::float8,
+                   c.volume, COALESCE(c.oi, 0)
+            FROM candles c
+            JOIN instrument_ids i ON i.instrument_key = c.instrument_key
+            WHERE c.timeframe = ANY(:timeframes)
+            ON CONFLICT ON CONSTRAINT candles_compact_pkey DO NOTHING
+        """), {"timeframes": list(TIMEFRAME_CODES)})
+        logger.info(f"Migrated {result.rowcount} candles into candles_compact.")
+        return result.rowcount
+
+def setup_compact_schema():
+    if not compact_schema_enabled():
+        return
+    try:
+        with sync_engine.begin() as conn:
+            create_compact_view(conn)
+            migrated = conn.execute(text("SELECT EXISTS (SELECT 1 FROM candles_compact)")).scalar()
+        # One-shot copy of the legacy table the first time compact mode is switched on
+        if not migrated:
+            migrate_candles_to_compact()
+        logger.info("Compact candle schema enabled, bulk writers target candles_compact.")
+    except Exception as e:
+        logger.error(f"Error setting up compact candle schema: {e}")
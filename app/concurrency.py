@@ -0,0 +1,181 @@
+# app/concurrency.py - AIMD concurrency control for Upstox fetches
+from app.metrics import UPSTOX_REQUEST_SECONDS
+from dotenv import load_dotenv
+import threading
+import asyncio
+import weakref
+import time
+import os
+
+load_dotenv()
+UPSTOX_INTRADAY_MAX_CONCURRENCY = int(os.getenv("UPSTOX_INTRADAY_MAX_CONCURRENCY", "50"))
+UPSTOX_HISTORICAL_MAX_CONCURRENCY = int(os.getenv("UPSTOX_HISTORICAL_MAX_CONCURRENCY", "30"))
+UPSTOX_INITIAL_CONCURRENCY = int(os.getenv("UPSTOX_INITIAL_CONCURRENCY", "10"))
+# Back off once smoothed latency is this many times the best latency seen
+UPSTOX_LATENCY_TOLERANCE = float(os.getenv("UPSTOX_LATENCY_TOLERANCE", "2.0"))
+# The best latency is re-baselined to the previous period's best every this many seconds
+UPSTOX_LATENCY_BASELINE_SECONDS = float(os.getenv("UPSTOX_LATENCY_BASELINE_SECONDS", "300"))
+
+
+class AdaptiveConcurrencyController:
+    """Additive-increase / multiplicative-decrease limit on in-flight requests for one endpoint.
+
+    Each success grows the window by ~1 per window's worth of requests. A 429/5xx halves it, and
+    latency drifting past `latency_tolerance` x the best observed latency shrinks it by 10%.
+    Only 2xx responses are latency samples, and the best latency is re-baselined every
+    `baseline_period` seconds so one unusually fast response cannot pin it down. Decreases are
+    rate limited to one per `cooldown` seconds so a burst of failures from the same window only
+    counts once.
+
+    Threads and event loops share one window: every release wakes the thread gate and the
+    asyncio gate of every loop that has waited on this controller.
+    """
+
+    def __init__(self, name: str, initial: int, min_limit: int = 1, max_limit: int = 50,
+                 latency_tolerance: float = UPSTOX_LATENCY_TOLERANCE, cooldown: float = 1.0,
+                 baseline_period: float = UPSTOX_LATENCY_BASELINE_SECONDS):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.baseline_period = baseline_period
+        self.in_flight = 0
+        self.requests = 0
+        self.throttles = 0
+        self.errors = 0
+        self.min_latency = None
+        self.smoothed_latency = None
+        self._period_min_latency = None
+        self._baseline_started = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # one asyncio.Condition per event loop; asyncio.run() cycles drop out with their loop
+        self._async_conds = weakref.WeakKeyDictionary()
+
+    @property
+    def window(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    # --- feedback ---
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(float(self.min_limit), self.limit * factor)
+            self._last_decrease = now
+
+    def _record(self, latency: float, status: int):
+        self.requests += 1
+        UPSTOX_REQUEST_SECONDS.observe(latency, endpoint=self.name)
+        if status == 429:
+            self.throttles += 1
+            self._decrease(0.5)
+            return
+        if status >= 500 or status == 0:
+            # 0 is a transport failure (SSL, reset) the SDK reports without a status
+            self.errors += 1
+            self._decrease(0.5)
+            return
+        if not 200 <= status < 300:
+            # a fast 400/401 says nothing about how loaded Upstox is
+            return
+
+        now = time.monotonic()
+        if now - self._baseline_started >= self.baseline_period and self._period_min_latency is not None:
+            self.min_latency = self._period_min_latency
+            self._period_min_latency = None
+            self._baseline_started = now
+        self._period_min_latency = latency if self._period_min_latency is None else min(self._period_min_latency, latency)
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        self.smoothed_latency = latency if self.smoothed_latency is None else 0.8 * self.smoothed_latency + 0.2 * latency
+        if self.smoothed_latency > self.latency_tolerance * self.min_latency:
+            self._decrease(0.9)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+    # --- thread gate ---
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.window:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, status: int = 200):
+        with self._cond:
+            self.in_flight -= 1
+            self._record(latency, status)
+            self._cond.notify_all()
+        self._wake_async()
+
+    # --- asyncio gate ---
+
+    def _get_async_cond(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            cond = self._async_conds.get(loop)
+            if cond is None:
+                cond = self._async_conds[loop] = asyncio.Condition()
+            return cond
+
+    def _take_slot(self) -> bool:
+        with self._lock:
+            if self.in_flight >= self.window:
+                return False
+            self.in_flight += 1
+            return True
+
+    def _wake_async(self):
+        # asyncio conditions are not thread-safe, so the notify runs on each waiter's own loop
+        with self._lock:
+            waiting = list(self._async_conds.items())
+        for loop, cond in waiting:
+            try:
+                loop.call_soon_threadsafe(lambda loop=loop, cond=cond: loop.create_task(self._notify(cond)))
+            except RuntimeError:
+                # the loop closed since; nothing is parked on it any more
+                pass
+
+    @staticmethod
+    async def _notify(cond: asyncio.Condition):
+        async with cond:
+            cond.notify_all()
+
+    async def async_acquire(self):
+        cond = self._get_async_cond()
+        async with cond:
+            await cond.wait_for(self._take_slot)
+
+    async def async_release(self, latency: float, status: int = 200):
+        self.release(latency, status)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "window": self.window,
+                "in_flight": self.in_flight,
+                "max_limit": self.max_limit,
+                "requests": self.requests,
+                "throttles": self.throttles,
+                "errors": self.errors,
+                "smoothed_latency_ms": round(self.smoothed_latency * 1000, 2) if self.smoothed_latency else None,
+                "min_latency_ms": round(self.min_latency * 1000, 2) if self.min_latency else None,
+            }
+
+
+controllers = {
+    "intraday": AdaptiveConcurrencyController(
+        "intraday", min(UPSTOX_INITIAL_CONCURRENCY, UPSTOX_INTRADAY_MAX_CONCURRENCY),
+        max_limit=UPSTOX_INTRADAY_MAX_CONCURRENCY,
+    ),
+    "historical": AdaptiveConcurrencyController(
+        "historical", min(UPSTOX_INITIAL_CONCURRENCY, UPSTOX_HISTORICAL_MAX_CONCURRENCY),
+        max_limit=UPSTOX_HISTORICAL_MAX_CONCURRENCY,
+    ),
+}
+
+def concurrency_stats() -> dict:
+    return {name: controller.stats() for name, controller in controllers.items()}
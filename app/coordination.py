@@ -0,0 +1,147 @@
+# app/coordination.py - Which process ingests what: worker leases, job locks and instrument shards
+#
+# Every ingestion process keeps a lease row in ingest_workers alive. At the start of each cycle
+# a worker reads the live leases, builds a consistent-hash ring over them and fetches only the
+# instruments it owns. A worker that dies stops heartbeating; once its lease expires the others
+# take over its instruments on their next cycle, and only those instruments move.
+# Universe-wide jobs such as the instrument sync run under a Postgres advisory lock instead.
+from app.db import sync_engine
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import threading
+import hashlib
+import bisect
+import socket
+import uuid
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# "all" serves the API and ingests in the same process, "api" only serves,
+# "worker" only ingests (python -m app.worker)
+INGEST_ROLE = os.getenv("INGEST_ROLE", "all")
+WORKER_HEARTBEAT_SECONDS = int(os.getenv("WORKER_HEARTBEAT_SECONDS", "10"))
+WORKER_LEASE_SECONDS = int(os.getenv("WORKER_LEASE_SECONDS", "45"))
+HASH_RING_VNODES = int(os.getenv("HASH_RING_VNODES", "128"))
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing with virtual nodes: adding or removing a member moves ~1/N of the keys."""
+
+    def __init__(self, members, vnodes: int = HASH_RING_VNODES):
+        self.members = sorted(set(members))
+        points = sorted((_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._points = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    def owner(self, key: str):
+        if not self._points:
+            return None
+        return self._owners[bisect.bisect(self._points, _hash(key)) % len(self._points)]
+
+    def owned(self, keys, member: str) -> list:
+        return [key for key in keys if self.owner(key) == member]
+
+
+class WorkerLease:
+    def __init__(self, worker_id: str = None):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._members = None
+        # whether the last shard() left part of the universe to other workers
+        self.sharded = False
+        self._lock = threading.Lock()
+
+    def _execute(self, sql: str, params: dict = None, fetch: bool = False):
+        conn = sync_engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, params or {})
+            rows = cursor.fetchall() if fetch else None
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def heartbeat(self):
+        self._execute("""
+            INSERT INTO ingest_workers (worker_id, hostname, pid, started_at, heartbeat_at)
+            VALUES (%(worker_id)s, %(hostname)s, %(pid)s, now(), now())
+            ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = now();
+            -- rows of workers that died long ago are only clutter
+            DELETE FROM ingest_workers WHERE heartbeat_at < now() - make_interval(secs => %(expire)s);
+        """, {
+            "worker_id": self.worker_id, "hostname": socket.gethostname(), "pid": os.getpid(),
+            "expire": WORKER_LEASE_SECONDS * 10,
+        })
+
+    def release(self):
+        # a clean shutdown hands its instruments over without waiting for the lease to expire
+        try:
+            self._execute("DELETE FROM ingest_workers WHERE worker_id = %(worker_id)s", {"worker_id": self.worker_id})
+        except Exception as e:
+            logger.error(f"Releasing worker lease {self.worker_id} failed: {e}")
+
+    def live_workers(self) -> list:
+        rows = self._execute("""
+            SELECT worker_id FROM ingest_workers
+            WHERE heartbeat_at >= now() - make_interval(secs => %(lease)s)
+            ORDER BY worker_id
+        """, {"lease": WORKER_LEASE_SECONDS}, fetch=True)
+        return [row[0] for row in rows]
+
+    def shard(self, instrument_keys: list) -> list:
+        """The instruments this worker owns among the current live workers."""
+        try:
+            members = set(self.live_workers())
+        except Exception as e:
+            # Without the lease table every worker ingests everything; upserts make that safe, just wasteful
+            logger.error(f"Reading worker leases failed, ingesting the whole universe: {e}")
+            return list(instrument_keys)
+        # this process is alive even if its own lease has just lapsed
+        members.add(self.worker_id)
+        ring = HashRing(members)
+        owned = ring.owned(instrument_keys, self.worker_id)
+        self.sharded = len(owned) < len(instrument_keys)
+        with self._lock:
+            if ring.members != self._members:
+                self._members = ring.members
+                logger.info(
+                    f"Worker {self.worker_id} owns {len(owned)} of {len(instrument_keys)} instruments "
+                    f"across {len(ring.members)} live workers."
+                )
+        return owned
+
+
+worker_lease = WorkerLease()
+
+
+def ingest_shard(instrument_keys: list) -> list:
+    return worker_lease.shard(instrument_keys)
+
+
+@contextmanager
+def job_lock(name: str):
+    """Session-level advisory lock on a dedicated connection; yields True if this process holds it.
+
+    Postgres drops the lock with the session, so a process that dies mid-run never blocks the job.
+    """
+    conn = sync_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext(%(name)s))", {"name": f"ingest:{name}"})
+        acquired = cursor.fetchone()[0]
+        conn.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                cursor.execute("SELECT pg_advisory_unlock(hashtext(%(name)s))", {"name": f"ingest:{name}"})
+                conn.commit()
+    finally:
+        conn.close()
@@ -4,7 +4,10 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import Session, sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+from app.metrics import DB_POOL_WAIT_SECONDS
 from dotenv import load_dotenv
+import time
 import os
 
 load_dotenv()
@@ -20,8 +23,20 @@ DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_POR
 # Async DATABASE URL (asyncpg)
 ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Plain asyncpg DSN, used by the asyncio ingestion pipeline for COPY-based writes
+ASYNCPG_DSN = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+class TimedQueuePool(QueuePool):
+    # Checkout wait (including pre-ping and any new connect) for /metrics
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
 # Sync engine and session
-sync_engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+sync_engine = create_engine(DATABASE_URL, pool_pre_ping=True, poolclass=TimedQueuePool)
 SyncSessionLocal = scoped_session(sessionmaker(bind=sync_engine, autocommit=False, autoflush=False))
 
 # Async engine and session
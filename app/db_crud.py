@@ -1,71 +1,165 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import select, desc, text, update, delete
 from sqlalchemy.dialects.postgresql import insert
-from app.db import get_sync_session
-from app.models import Instrument, Candle
+from app.db import get_sync_session, sync_engine
+from app.models import Candle
+from app.compact_candles import compact_schema_enabled, write_compact_candles, timeframe_code_sql, rows_in
+from app.candle_store import candle_store, CANDLE_STORE_ENABLED
+from app.delta_tracker import delta_tracker
+from app.candle_bus import candle_bus
+from app.instrument_registry import instrument_registry
+from app.metrics import timed, observe_stage, CANDLES_WRITTEN
 import pandas as pd
+import itertools
+import time
+import csv
+import io
 import logging
 
 logger = logging.getLogger(__name__)
 
-def fetch_all_instruments():
+# Called with every committed candle batch (instrument_key, timeframe, timestamp, OHLCV, oi)
+def on_candles_written(candles_df: pd.DataFrame):
     try:
-        session_gen = get_sync_session()
-        db: Session = next(session_gen)
-        return db.execute(select(Instrument)).scalars().all()
-    finally:
-        db.close()
+        if CANDLE_STORE_ENABLED:
+            candle_store.ingest_frame(candles_df)
+    except Exception as e:
+        logger.error(f"Error applying written candles to the in-memory store: {e}")
+    try:
+        delta_tracker.mark_persisted(candles_df)
+    except Exception as e:
+        logger.error(f"Error recording persisted candles for delta writes: {e}")
+    try:
+        candle_bus.publish_frame(candles_df)
+    except Exception as e:
+        logger.error(f"Error publishing written candles to subscribers: {e}")
 
-def sync_instruments_with_db(equity_df: pd.DataFrame):
-    session_gen = get_sync_session()
-    db: Session = next(session_gen)
+def fetch_all_instruments():
+    # Served from the in-process registry; it reloads only after an instrument sync
+    return list(instrument_registry.all())
 
-    try:
-        csv_keys = set(equity_df["instrument_key"].tolist())
+def fetch_active_instruments():
+    # The candle jobs' universe; the instrument master also holds F&O and BSE rows they skip
+    return list(instrument_registry.active())
 
-        # Get all existing instrument keys from DB
-        existing_rows = db.execute(select(Instrument.instrument_key)).scalars().all()
-        existing_keys = set(existing_rows)
+INSTRUMENT_COLUMNS = ["instrument_key", "trading_symbol", "company_name", "industry", "segment", "instrument_type", "active"]
+INSTRUMENT_COPY_CHUNK_SIZE = 20000
 
-        # Determine new and stale keys
-        new_keys = csv_keys - existing_keys
-        stale_keys = existing_keys - csv_keys
+def _ensure_instrument_staging_table(cursor):
+    cursor.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS instruments_staging (
+            instrument_key VARCHAR NOT NULL,
+            trading_symbol VARCHAR,
+            company_name VARCHAR NOT NULL,
+            industry VARCHAR NOT NULL,
+            segment VARCHAR,
+            instrument_type VARCHAR,
+            active BOOLEAN NOT NULL
+        )
+    """)
 
-        
-        # Insert new instruments
-        new_instruments = [
-            Instrument(
-                instrument_key=row['instrument_key'],
-                trading_symbol=row['trading_symbol'],
-                company_name=row['company_name'],
-                industry=row['industry'],
-            )
-            for _, row in equity_df.iterrows()
-            if row['instrument_key'] in new_keys
-        ]
+def _copy_instruments_to_staging(cursor, rows) -> int:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY instruments_staging ({', '.join(INSTRUMENT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buffer,
+    )
+    return len(rows)
 
-        if new_instruments:
-            db.add_all(new_instruments)
-            logger.info(f"Inserted {len(new_instruments)} new instruments.")
+def sync_instrument_rows(rows) -> dict:
+    """Make the instruments table match `rows`, an iterable of INSTRUMENT_COLUMNS tuples.
 
-        # Delete stale instruments
-        if stale_keys:
-            deleted = db.query(Instrument).filter(Instrument.instrument_key.in_(stale_keys)).delete(synchronize_session=False)
-            logger.info(f"Deleted {deleted} stale instruments.")
+    Rows are streamed into an unlogged staging table in fixed-size COPY chunks, so memory
+    stays flat however large the source is. The diff then runs set-based in Postgres:
+    new keys are inserted, changed rows updated, and keys missing from the source are
+    deleted, or deactivated if candles still reference them.
+    """
+    conn = sync_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        _ensure_instrument_staging_table(cursor)
+        cursor.execute("TRUNCATE instruments_staging")
+        staged = 0
+        for chunk in iter(lambda: list(itertools.islice(rows, INSTRUMENT_COPY_CHUNK_SIZE)), []):
+            staged += _copy_instruments_to_staging(cursor, chunk)
+        if not staged:
+            # An empty source is far more likely a broken download than an empty market
+            raise ValueError("No instruments to sync, refusing to deactivate the whole table")
+        cursor.execute("ANALYZE instruments_staging")
 
-        db.commit()
+        columns = ", ".join(INSTRUMENT_COLUMNS)
+        cursor.execute(f"""
+            INSERT INTO instruments ({columns})
+            SELECT DISTINCT ON (instrument_key) {columns} FROM instruments_staging
+            ORDER BY instrument_key
+            ON CONFLICT (instrument_key) DO UPDATE SET
+                {', '.join(f"{c} = EXCLUDED.{c}" for c in INSTRUMENT_COLUMNS[1:])}
+            WHERE ({', '.join(f"instruments.{c}" for c in INSTRUMENT_COLUMNS[1:])})
+                IS DISTINCT FROM ({', '.join(f"EXCLUDED.{c}" for c in INSTRUMENT_COLUMNS[1:])})
+            RETURNING xmax = 0
+        """)
+        # xmax is 0 only on freshly inserted tuples, so one statement reports both counts
+        merged = [row[0] for row in cursor.fetchall()]
+        inserted = sum(merged)
+
+        missing = "NOT EXISTS (SELECT 1 FROM instruments_staging s WHERE s.instrument_key = i.instrument_key)"
+        referenced = """(
+            EXISTS (SELECT 1 FROM candles c WHERE c.instrument_key = i.instrument_key)
+            OR EXISTS (SELECT 1 FROM instrument_ids d WHERE d.instrument_key = i.instrument_key)
+        )"""
+        cursor.execute(f"DELETE FROM instruments i WHERE {missing} AND NOT {referenced}")
+        deleted = cursor.rowcount
+        cursor.execute(f"UPDATE instruments i SET active = false WHERE i.active AND {missing}")
+        deactivated = cursor.rowcount
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
+    instrument_registry.invalidate()
+    counts = {
+        "staged": staged, "inserted": inserted, "updated": len(merged) - inserted,
+        "deleted": deleted, "deactivated": deactivated,
+    }
+    logger.info(
+        f"Instruments synced: {staged} staged, {counts['inserted']} inserted, {counts['updated']} updated, "
+        f"{deleted} deleted, {deactivated} deactivated."
+    )
+    return counts
+
+def sync_instruments_with_db(equity_df: pd.DataFrame):
+    # The CSV universe path: every listed instrument is an active NSE equity
+    try:
+        frame = equity_df.assign(
+            segment=equity_df["instrument_key"].str.split("|").str[0],
+            instrument_type="EQ",
+            active=True,
+        )
+        frame = frame[INSTRUMENT_COLUMNS].astype(object).where(frame[INSTRUMENT_COLUMNS].notna(), None)
+        sync_instrument_rows(iter(frame.itertuples(index=False, name=None)))
     except Exception as e:
-        db.rollback()
         logger.error(f"Error syncing instruments: {e}")
-    finally:
-        db.close()
 
 # No upsert logic!
 def sync_historical_candles_with_db(candles_df: pd.DataFrame, instrument_key: str, timeframe: str):
     if candles_df.empty:
         logger.info(f"No valid historical candles for {instrument_key}, skipping DB sync.")
         return
+    if compact_schema_enabled():
+        # the Candle model maps the legacy table, which readers ignore in compact mode
+        try:
+            inserted, _ = bulk_load_historical_candles(
+                candles_df.assign(instrument_key=instrument_key, timeframe=timeframe), retention=100,
+            )
+            logger.info(f"{instrument_key} {timeframe}: Inserted {inserted} new candles.")
+        except Exception as e:
+            logger.error(f"Error syncing candles for {instrument_key} {timeframe}: {e}")
+        return
     try:
         session_gen = get_sync_session()
         db: Session = next(session_gen)
@@ -112,9 +206,10 @@ def sync_historical_candles_with_db(candles_df: pd.DataFrame, instrument_key: st
 
             db.add_all(new_candles)
             db.commit()
+            on_candles_written(new_candles_df.assign(instrument_key=instrument_key, timeframe=timeframe))
 
         # Keep only latest 100 candles for instrument + timeframe
-        result = db.execute(text(f"""
+        result = db.execute(text("""
             DELETE FROM candles
             WHERE id IN (
                 SELECT id FROM (
@@ -142,13 +237,22 @@ def sync_historical_candles_with_db(candles_df: pd.DataFrame, instrument_key: st
         db.close()
 
 # with upsert logic!
-def sync_intraday_candles_with_db(candles_df: pd.DataFrame, instrument_key: str, timeframe: str):
+def sync_intraday_candles_with_db(candles_df: pd.DataFrame, instrument_key: str, timeframe: str, job: str = "intraday"):
     if candles_df.empty:
         logger.info(f"No valid intraday candles for {instrument_key}, skipping DB sync.")
         return
+    if compact_schema_enabled():
+        try:
+            written = bulk_upsert_candles(candles_df.assign(instrument_key=instrument_key, timeframe=timeframe), job=job)
+            logger.info(f"{instrument_key} {timeframe}: Bulk upserted {written} candles.")
+        except Exception as e:
+            logger.error(f"{instrument_key} {timeframe}: Failed to bulk upsert candles: {e}")
+        return
     try:
         session_gen = get_sync_session()
         db: Session = next(session_gen)
+        with timed(job, "db_acquire", instrument_key):
+            db.connection()
 
         candles_df["instrument_key"] = instrument_key
         candles_df["timeframe"] = timeframe
@@ -165,8 +269,12 @@ def sync_intraday_candles_with_db(candles_df: pd.DataFrame, instrument_key: str,
             set_={col: getattr(stmt.excluded, col) for col in update_cols}
         )
 
-        db.execute(stmt)
-        db.commit()
+        with timed(job, "write", instrument_key):
+            db.execute(stmt)
+        with timed(job, "commit", instrument_key):
+            db.commit()
+        CANDLES_WRITTEN.inc(len(candles_df), job=job)
+        on_candles_written(candles_df)
 
         logger.info(f"{instrument_key} {timeframe}: Bulk upserted {len(candles_df)} candles.")
     except Exception as e:
@@ -175,3 +283,208 @@ def sync_intraday_candles_with_db(candles_df: pd.DataFrame, instrument_key: str,
     finally:
         db.close()
 
+# Multi-instrument upsert, used by the batched intraday writer.
+# Postgres caps a statement at 65535 bind params (9 per candle row), so keep chunks below that.
+CANDLE_UPSERT_CHUNK_SIZE = 5000
+
+def bulk_upsert_candles(candles_df: pd.DataFrame, chunk_size: int = CANDLE_UPSERT_CHUNK_SIZE, job: str = "intraday") -> int:
+    if candles_df.empty:
+        return 0
+    if compact_schema_enabled():
+        with timed(job, "write"):
+            written = write_compact_candles(candles_df, on_conflict="update")
+        CANDLES_WRITTEN.inc(len(written), job=job)
+        on_candles_written(written)
+        return len(written)
+    try:
+        session_gen = get_sync_session()
+        db: Session = next(session_gen)
+        with timed(job, "db_acquire"):
+            db.connection()
+
+        candles_df = candles_df.copy()
+        candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"], utc=True)
+        # ON CONFLICT can't touch the same row twice in one statement, keep the latest copy
+        candles_df = candles_df.drop_duplicates(
+            subset=["instrument_key", "timeframe", "timestamp"], keep="last"
+        )
+
+        update_cols = ["open", "high", "low", "close", "volume", "oi"]
+        columns = ["instrument_key", "timeframe", "timestamp"] + update_cols
+
+        with timed(job, "write"):
+            for start in range(0, len(candles_df), chunk_size):
+                chunk = candles_df.iloc[start:start + chunk_size]
+                stmt = insert(Candle).values(chunk[columns].to_dict(orient="records"))
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["instrument_key", "timeframe", "timestamp"],
+                    set_={col: getattr(stmt.excluded, col) for col in update_cols}
+                )
+                db.execute(stmt)
+
+        # single commit for the whole batch
+        with timed(job, "commit"):
+            db.commit()
+        CANDLES_WRITTEN.inc(len(candles_df), job=job)
+        on_candles_written(candles_df)
+        logger.info(f"Bulk upserted {len(candles_df)} candles across {candles_df['instrument_key'].nunique()} instruments.")
+        return len(candles_df)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to bulk upsert candle batch of {len(candles_df)} rows: {e}")
+        raise
+    finally:
+        db.close()
+
+# Only the latest N candles per instrument + timeframe are retained
+CANDLE_RETENTION_BARS = 100
+CANDLE_COLUMNS = ["instrument_key", "timeframe", "timestamp", "open", "high", "low", "close", "volume", "oi"]
+
+def _ensure_candle_staging_table(cursor):
+    # Unlogged: staging rows are throwaway, so skip the WAL entirely
+    cursor.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS candles_staging (
+            instrument_key VARCHAR NOT NULL,
+            timeframe VARCHAR NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL,
+            open NUMERIC(12, 4) NOT NULL,
+            high NUMERIC(12, 4) NOT NULL,
+            low NUMERIC(12, 4) NOT NULL,
+            close NUMERIC(12, 4) NOT NULL,
+            volume BIGINT NOT NULL,
+            oi BIGINT DEFAULT 0
+        )
+    """)
+
+def _copy_candles_to_staging(cursor, candles_df: pd.DataFrame):
+    buffer = io.StringIO()
+    candles_df[CANDLE_COLUMNS].to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY candles_staging ({', '.join(CANDLE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buffer,
+    )
+
+# Set-oriented replacement for calling sync_historical_candles_with_db per instrument:
+# one COPY for the whole universe, one INSERT ... SELECT and one retention DELETE.
+def bulk_load_historical_candles(candles_df: pd.DataFrame, retention: int = CANDLE_RETENTION_BARS, job: str = "historical"):
+    if candles_df.empty:
+        logger.info("No historical candles to bulk load, skipping DB sync.")
+        return 0, 0
+    if compact_schema_enabled():
+        with timed(job, "write"):
+            inserted = write_compact_candles(candles_df, on_conflict="nothing", retention=retention)
+        CANDLES_WRITTEN.inc(len(inserted), job=job)
+        on_candles_written(inserted)
+        return len(inserted), 0
+
+    candles_df = candles_df.copy()
+    candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"], utc=True)
+    candles_df["oi"] = candles_df["oi"].fillna(0)
+    # Rows past the retention window would be deleted right away, so never ship them
+    candles_df = (
+        candles_df.sort_values("timestamp", ascending=False)
+        .drop_duplicates(subset=["instrument_key", "timeframe", "timestamp"])
+        .groupby(["instrument_key", "timeframe"], sort=False)
+        .head(retention)
+    )
+
+    with timed(job, "db_acquire"):
+        conn = sync_engine.raw_connection()
+    try:
+        write_started = time.perf_counter()
+        cursor = conn.cursor()
+        _ensure_candle_staging_table(cursor)
+        # TRUNCATE takes an exclusive lock, so concurrent loaders queue up instead of mixing rows
+        cursor.execute("TRUNCATE candles_staging")
+        _copy_candles_to_staging(cursor, candles_df)
+
+        cursor.execute(f"""
+            INSERT INTO candles ({', '.join(CANDLE_COLUMNS)})
+            SELECT {', '.join(CANDLE_COLUMNS)} FROM candles_staging
+            ON CONFLICT (instrument_key, timeframe, timestamp) DO NOTHING
+            RETURNING instrument_key, timeframe, timestamp
+        """)
+        # bars that were already stored are skipped, so only the inserted ones are published
+        inserted_df = rows_in(candles_df, cursor.fetchall())
+        inserted = len(inserted_df)
+
+        # Trim every touched instrument + timeframe to the latest `retention` candles in one pass
+        cursor.execute("""
+            DELETE FROM candles c
+            USING (
+                SELECT id FROM (
+                    SELECT id,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY instrument_key, timeframe
+                            ORDER BY timestamp DESC
+                        ) AS rn
+                    FROM candles
+                    WHERE (instrument_key, timeframe) IN (
+                        SELECT DISTINCT instrument_key, timeframe FROM candles_staging
+                    )
+                ) AS ranked
+                WHERE rn > %(retention)s
+            ) AS old
+            WHERE c.id = old.id
+        """, {"retention": retention})
+        deleted = cursor.rowcount
+
+        cursor.execute("TRUNCATE candles_staging")
+        observe_stage(job, "write", time.perf_counter() - write_started)
+        with timed(job, "commit"):
+            conn.commit()
+        CANDLES_WRITTEN.inc(inserted, job=job)
+        on_candles_written(inserted_df)
+        logger.info(
+            f"Bulk loaded historical candles for {candles_df['instrument_key'].nunique()} instruments: "
+            f"inserted {inserted} new candles, deleted {deleted} old candles."
+        )
+        return inserted, deleted
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to bulk load historical candles: {e}")
+        raise
+    finally:
+        conn.close()
+
+# Set-based "keep latest N" for whole timeframes, e.g. the resampled ones
+def trim_candles(timeframes: list, retention: int = CANDLE_RETENTION_BARS) -> int:
+    if not timeframes:
+        return 0
+    if compact_schema_enabled():
+        table, partition, match = "candles_compact", "instrument_id, timeframe", (
+            "c.instrument_id = old.instrument_id AND c.timeframe = old.timeframe AND c.timestamp = old.timestamp"
+        )
+        key_cols = "instrument_id, timeframe, timestamp"
+        timeframe_filter = f"timeframe IN (SELECT {timeframe_code_sql('tf')} FROM unnest(CAST(:timeframes AS VARCHAR[])) AS tf)"
+    else:
+        table, partition, match = "candles", "instrument_key, timeframe", "c.id = old.id"
+        key_cols = "id"
+        timeframe_filter = "timeframe = ANY(:timeframes)"
+
+    session_gen = get_sync_session()
+    db: Session = next(session_gen)
+    try:
+        result = db.execute(text(f"""
+            DELETE FROM {table} c
+            USING (
+                SELECT {key_cols} FROM (
+                    SELECT {key_cols},
+                        ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY timestamp DESC) AS rn
+                    FROM {table}
+                    WHERE {timeframe_filter}
+                ) AS ranked
+                WHERE rn > :retention
+            ) AS old
+            WHERE {match}
+        """), {"timeframes": list(timeframes), "retention": retention})
+        db.commit()
+        logger.info(f"Trimmed {result.rowcount} old {', '.join(timeframes)} candles.")
+        return result.rowcount
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error trimming {', '.join(timeframes)} candles: {e}")
+        return 0
+    finally:
+        db.close()
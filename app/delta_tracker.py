@@ -0,0 +1,108 @@
+# app/delta_tracker.py - Remembers the last persisted bar per series so intraday runs only write what changed
+from app.candle_decoder import CandleColumns
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+import threading
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+INTRADAY_DELTA_WRITES = os.getenv("INTRADAY_DELTA_WRITES", "true").lower() == "true"
+
+VALUE_FIELDS = ("open", "high", "low", "close", "volume", "oi")
+
+
+def _bar_hash(values) -> int:
+    # Content hash of one bar's OHLCV + oi; NaN and 0 oi hash the same, as they do in the DB
+    return hash(np.nan_to_num(np.asarray(values, dtype=np.float64)).tobytes())
+
+
+class BarDeltaTracker:
+    """Last persisted (timestamp, content hash) per (instrument, timeframe).
+
+    Upstox returns the whole day on every intraday call, but only the forming bar and any
+    newly closed ones differ from what is already stored. Bars older than the last persisted
+    one are final and skipped; the last one is resent only if its content changed.
+    Entries are updated from on_candles_written, i.e. only after a commit succeeded.
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.skipped = 0
+
+    def _mask(self, timestamps: np.ndarray, values: np.ndarray, instrument_key: str, timeframe: str) -> np.ndarray:
+        last = self._last.get((instrument_key, timeframe))
+        if last is None:
+            return np.ones(len(timestamps), dtype=bool)
+        last_ts, last_hash = last
+        mask = timestamps > last_ts
+        same = np.flatnonzero(timestamps == last_ts)
+        if len(same) and _bar_hash(values[:, same[0]]) != last_hash:
+            mask[same[0]] = True
+        return mask
+
+    def _count(self, mask: np.ndarray):
+        sent = int(mask.sum())
+        with self._lock:
+            self.sent += sent
+            self.skipped += len(mask) - sent
+
+    def filter_columns(self, columns: CandleColumns, instrument_key: str, timeframe: str) -> CandleColumns:
+        if not len(columns):
+            return columns
+        values = np.vstack([getattr(columns, f) for f in VALUE_FIELDS])
+        mask = self._mask(columns.timestamp, values, instrument_key, timeframe)
+        self._count(mask)
+        return CandleColumns(*(arr[mask] for arr in columns))
+
+    def filter_frame(self, candles_df: pd.DataFrame, instrument_key: str, timeframe: str) -> pd.DataFrame:
+        if candles_df.empty:
+            return candles_df
+        timestamps = pd.to_datetime(candles_df["timestamp"], utc=True).to_numpy(dtype="datetime64[s]").astype(np.int64)
+        values = candles_df[list(VALUE_FIELDS)].to_numpy(dtype=np.float64).T
+        mask = self._mask(timestamps, values, instrument_key, timeframe)
+        self._count(mask)
+        return candles_df[mask].reset_index(drop=True)
+
+    def mark_persisted(self, candles_df: pd.DataFrame):
+        """Record the newest bar of every series in a committed batch."""
+        if candles_df.empty:
+            return
+        frame = candles_df.assign(_ts=pd.to_datetime(candles_df["timestamp"], utc=True))
+        latest = frame.sort_values("_ts").drop_duplicates(["instrument_key", "timeframe"], keep="last")
+        timestamps = latest["_ts"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+        values = latest[list(VALUE_FIELDS)].to_numpy(dtype=np.float64)
+        with self._lock:
+            for key, timeframe, ts, row in zip(latest["instrument_key"], latest["timeframe"], timestamps, values):
+                current = self._last.get((key, timeframe))
+                if current is None or ts >= current[0]:
+                    self._last[(key, timeframe)] = (int(ts), _bar_hash(row))
+
+    def seed_from_store(self, store):
+        # After a restart the candle store already holds every series' last persisted bar
+        with self._lock:
+            for key, timeframe in store.keys():
+                bar = store.latest(key, timeframe)
+                if bar is not None:
+                    self._last[(key, timeframe)] = (bar["timestamp"], _bar_hash([bar[f] for f in VALUE_FIELDS]))
+
+    def forget(self, timeframe: str):
+        # Every bar of `timeframe` goes to the DB again on the next write, e.g. for a reconciliation pass
+        with self._lock:
+            for key in [k for k in self._last if k[1] == timeframe]:
+                del self._last[key]
+
+    def reset_counts(self):
+        with self._lock:
+            self.sent = self.skipped = 0
+
+    def report(self, label: str):
+        logger.info(f"{label}: {self.sent} new or changed bars sent to the DB, {self.skipped} unchanged bars skipped.")
+
+
+delta_tracker = BarDeltaTracker()
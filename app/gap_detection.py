@@ -0,0 +1,170 @@
+# app/gap_detection.py - Find missing 15m bars against the NSE session grid and refetch only those
+from app.db import sync_engine
+from app.db_crud import bulk_load_historical_candles, CANDLE_RETENTION_BARS
+from app.compact_candles import candle_read_source
+from app.concurrency import UPSTOX_HISTORICAL_MAX_CONCURRENCY
+from app.upstox_api import get_historical_candle_body, get_intraday_candle_body
+from app.candle_decoder import decode_candle_response, candle_columns_to_frame, CandleColumns
+from app.resample import IST_OFFSET
+from app.trading_calendar import trading_calendar
+from app.metrics import timed
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+import numpy as np
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+BAR_SECONDS = 15 * 60
+BARS_PER_SESSION = 25  # a regular 09:15 .. 15:30 IST session
+
+
+def session_grid(days: list) -> np.ndarray:
+    """Epoch (UTC) start of every 15m bar of the given trading days, shortened sessions included."""
+    if not days:
+        return np.empty(0, np.int64)
+    return np.concatenate([trading_calendar.bar_starts(day, 15) for day in days])
+
+
+def expected_slots(now: int, bars: int = CANDLE_RETENTION_BARS) -> np.ndarray:
+    """The latest `bars` completed slots as of `now`: exactly what retention keeps per instrument.
+
+    Checking further back would keep refetching bars the retention trim deletes again.
+    """
+    today = datetime.fromtimestamp(now + IST_OFFSET, timezone.utc).date()
+    # enough calendar days to cover `bars` regular sessions even across holidays and long weekends
+    first = today - timedelta(days=(bars // BARS_PER_SESSION + 1) * 2 + 7)
+    grid = session_grid(trading_calendar.trading_days(first, today))
+    return grid[grid + BAR_SECONDS <= now][-bars:]
+
+
+def find_missing(instrument_keys: list, slots: np.ndarray):
+    """One anti-join of (instrument x slot) against stored 15m bars; returns (keys, timestamps) arrays."""
+    if not instrument_keys or not len(slots):
+        return np.empty(0, object), np.empty(0, np.int64)
+    conn = sync_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT k.instrument_key, extract(epoch FROM g.ts)::bigint
+            FROM unnest(%(keys)s::varchar[]) AS k(instrument_key)
+            CROSS JOIN unnest(%(slots)s::timestamptz[]) AS g(ts)
+            LEFT JOIN (
+                SELECT instrument_key, timestamp FROM {candle_read_source()}
+                WHERE timeframe = '15m' AND timestamp >= %(first)s
+            ) AS stored ON stored.instrument_key = k.instrument_key AND stored.timestamp = g.ts
+            WHERE stored.instrument_key IS NULL
+        """, {
+            "keys": list(instrument_keys),
+            "slots": [datetime.fromtimestamp(ts, timezone.utc) for ts in slots.tolist()],
+            "first": datetime.fromtimestamp(int(slots[0]), timezone.utc),
+        })
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return np.empty(0, object), np.empty(0, np.int64)
+    keys, timestamps = zip(*rows)
+    return np.array(keys, dtype=object), np.array(timestamps, dtype=np.int64)
+
+
+def missing_ranges(keys: np.ndarray, timestamps: np.ndarray, n_instruments: int, slots: np.ndarray) -> list:
+    """Group missing bars into (instrument_key, first_day, last_day, missing_timestamps) requests.
+
+    On days the trading calendar has no holiday list for, a session where every instrument is
+    missing every bar is taken as an unlisted holiday rather than a gap. Consecutive sessions
+    with holes for the same instrument collapse into one request.
+    """
+    if not len(timestamps):
+        return []
+    slot_days = (slots + IST_OFFSET) // 86400
+    days = (timestamps + IST_OFFSET) // 86400
+    session_list, bars_per_day = np.unique(slot_days, return_counts=True)
+    missing_per_day = np.array([np.count_nonzero(days == d) for d in session_list])
+    uncovered = np.array([
+        not trading_calendar.covers(datetime.fromtimestamp(int(d) * 86400, timezone.utc).date()) for d in session_list
+    ], dtype=bool)
+    closed = session_list[(missing_per_day == bars_per_day * n_instruments) & uncovered]
+    keep = ~np.isin(days, closed)
+    keys, timestamps, days = keys[keep], timestamps[keep], days[keep]
+    if not len(timestamps):
+        return []
+
+    order = np.lexsort((timestamps, keys))
+    keys, timestamps, days = keys[order], timestamps[order], days[order]
+    session_index = np.searchsorted(session_list, days)
+    # a new request starts at every new instrument or whenever a session with no holes is skipped
+    new_range = np.r_[True, (keys[1:] != keys[:-1]) | (session_index[1:] - session_index[:-1] > 1)]
+    starts = np.flatnonzero(new_range)
+    ends = np.r_[starts[1:], len(keys)]
+    return [
+        (
+            keys[s],
+            datetime.fromtimestamp(int(days[s]) * 86400, timezone.utc).date(),
+            datetime.fromtimestamp(int(days[e - 1]) * 86400, timezone.utc).date(),
+            timestamps[s:e],
+        )
+        for s, e in zip(starts, ends)
+    ]
+
+
+def _fetch_range(instrument_key: str, first_day, last_day, today) -> list:
+    bodies = []
+    with timed("historical", "fetch", instrument_key):
+        if first_day < today:
+            hist_to = min(last_day, today - timedelta(days=1))
+            bodies.append(get_historical_candle_body(
+                symbol=instrument_key,
+                toDate=hist_to.isoformat(),
+                fromDate=first_day.isoformat(),
+                timePeriod='minutes',
+                multiplier='15'
+            ))
+        if last_day >= today:
+            # the historical endpoint stops at yesterday, today's bars come from the intraday one
+            bodies.append(get_intraday_candle_body(
+                symbol=instrument_key,
+                timePeriod='minutes',
+                multiplier='15'
+            ))
+    with timed("historical", "parse", instrument_key):
+        return [decode_candle_response(body) for body in bodies]
+
+
+def refetch_gaps(instrument_keys: list, now: int = None) -> dict:
+    """Detect holes in the retained 15m bars and fetch only the affected (instrument, days) ranges."""
+    now = int(time.time()) if now is None else now
+    slots = expected_slots(now)
+    keys, timestamps = find_missing(instrument_keys, slots)
+    ranges = missing_ranges(keys, timestamps, len(instrument_keys), slots)
+    missing = sum(len(r[3]) for r in ranges)
+    logger.info(
+        f"Gap detection: {missing} missing 15m bars across {len({r[0] for r in ranges})} instruments "
+        f"in the last {len(slots)} slots, {len(ranges)} refetch requests."
+    )
+    if not ranges:
+        return {"missing": 0, "requests": 0, "filled": 0}
+
+    today = datetime.fromtimestamp(now + IST_OFFSET, timezone.utc).date()
+    parts = []
+
+    def process_range(gap):
+        instrument_key, first_day, last_day, wanted = gap
+        try:
+            for columns in _fetch_range(instrument_key, first_day, last_day, today):
+                # Only the missing bars are written; the rest of the response is already stored
+                mask = np.isin(columns.timestamp, wanted)
+                if mask.any():
+                    parts.append((instrument_key, "15m", CandleColumns(*(arr[mask] for arr in columns))))
+        except Exception as e:
+            logger.error(f"Gap refetch for {instrument_key} {first_day} .. {last_day} failed: {e}")
+
+    with ThreadPoolExecutor(max_workers=min(UPSTOX_HISTORICAL_MAX_CONCURRENCY, len(ranges))) as executor:
+        list(executor.map(process_range, ranges))
+
+    filled = 0
+    if parts:
+        filled, _ = bulk_load_historical_candles(candle_columns_to_frame(parts))
+    logger.info(f"Gap refetch filled {filled} of {missing} missing bars with {len(ranges)} requests.")
+    return {"missing": missing, "requests": len(ranges), "filled": filled}
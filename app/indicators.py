@@ -0,0 +1,236 @@
+# app/indicators.py - Vectorized technical indicators over the whole instrument universe
+from app.candle_store import candle_store, VALUE_FIELDS, CANDLE_STORE_CAPACITY, CANDLE_STORE_ENABLED
+from app.resample import IST_OFFSET, BASE_TIMEFRAME, load_base_bars
+import numpy as np
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+SMA_PERIOD = 20
+EMA_PERIOD = 20
+RSI_PERIOD = 14
+ATR_PERIOD = 14
+INDICATOR_NAMES = ["sma", "ema", "rsi", "atr", "vwap"]
+
+
+def _align(rows: np.ndarray, timestamps: np.ndarray, values: np.ndarray, n_rows: int, window: int):
+    axis = np.unique(timestamps)[-window:]
+    in_window = timestamps >= axis[0]
+    cols = np.searchsorted(axis, timestamps[in_window])
+    cube = np.full((len(VALUE_FIELDS), n_rows, len(axis)), np.nan)
+    cube[:, rows[in_window], cols] = values[:, in_window]
+    return axis, cube
+
+
+def load_universe_matrix(window: int = CANDLE_STORE_CAPACITY):
+    """Align every instrument's retained 15m candles on a shared time axis.
+
+    Returns (instrument_keys, timestamps, fields) where each field is an
+    (n_instruments, n_timestamps) float64 matrix, NaN where an instrument has no bar.
+    """
+    if CANDLE_STORE_ENABLED and candle_store.keys(BASE_TIMEFRAME):
+        keys = sorted(key for key, _ in candle_store.keys(BASE_TIMEFRAME))
+        views = [candle_store.get(key, BASE_TIMEFRAME, window) for key in keys]
+        timestamps = np.concatenate([v["timestamp"] for v in views])
+        values = np.vstack([np.concatenate([v[f] for v in views]) for f in VALUE_FIELDS])
+        rows = np.repeat(np.arange(len(keys)), [len(v["timestamp"]) for v in views])
+    else:
+        key_per_row, timestamps, values = load_base_bars()
+        # rows arrive sorted by instrument, so a row index is a running count of key changes
+        starts = np.r_[True, key_per_row[1:] != key_per_row[:-1]] if len(timestamps) else np.empty(0, bool)
+        keys = key_per_row[starts].tolist()
+        rows = np.cumsum(starts) - 1
+
+    if not len(timestamps):
+        return [], np.empty(0, np.int64), {f: np.empty((0, 0)) for f in VALUE_FIELDS}
+    axis, cube = _align(rows, timestamps, values, len(keys), window)
+    return keys, axis, dict(zip(VALUE_FIELDS, cube))
+
+
+def _step(state: np.ndarray, x: np.ndarray, alpha: float) -> np.ndarray:
+    # one smoothing step for every instrument: seed with the first value, carry over gaps
+    smoothed = alpha * x + (1 - alpha) * state
+    return np.where(np.isnan(state), x, np.where(np.isnan(x), state, smoothed))
+
+
+def _recursive(x: np.ndarray, alpha: float) -> np.ndarray:
+    """Exponential smoothing along time, e.g. EMA (2 / (n + 1)) or Wilder's RMA (1 / n).
+
+    The loop runs over ~100 bars while each step is vectorized across all instruments.
+    """
+    out = np.empty_like(x)
+    state = np.full(x.shape[0], np.nan)
+    for t in range(x.shape[1]):
+        state = out[:, t] = _step(state, x[:, t], alpha)
+    return out
+
+
+def _gains(delta: np.ndarray) -> np.ndarray:
+    return np.where(np.isnan(delta), np.nan, np.maximum(delta, 0.0))
+
+
+def _true_range(high, low, close, prev_close):
+    return np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+
+
+def _session_ids(timestamps: np.ndarray) -> np.ndarray:
+    return (timestamps + IST_OFFSET) // 86400
+
+
+class IndicatorEngine:
+    def __init__(self):
+        self.keys = []
+        self.timestamps = np.empty(0, np.int64)
+        self.fields = {}
+        self.values = {}
+        # per-column recursive state needed to extend the series by one bar
+        self._gain = self._loss = None
+        self._store_version = -1
+        self._lock = threading.Lock()
+        self.last_compute_ms = 0.0
+
+    def recompute(self):
+        started = time.perf_counter()
+        keys, timestamps, fields = load_universe_matrix()
+        values = {}
+        if len(timestamps):
+            close, high, low, volume = fields["close"], fields["high"], fields["low"], fields["volume"]
+            prev_close = np.concatenate([np.full((close.shape[0], 1), np.nan), close[:, :-1]], axis=1)
+
+            values["sma"] = self._sma(close)
+            values["ema"] = _recursive(close, 2 / (EMA_PERIOD + 1))
+
+            delta = close - prev_close
+            gain = _recursive(_gains(delta), 1 / RSI_PERIOD)
+            loss = _recursive(_gains(-delta), 1 / RSI_PERIOD)
+            values["rsi"] = self._rsi(gain, loss)
+            values["atr"] = _recursive(_true_range(high, low, close, prev_close), 1 / ATR_PERIOD)
+            values["vwap"] = self._vwap(timestamps, high, low, close, volume)
+        else:
+            gain = loss = None
+
+        with self._lock:
+            self.keys, self.timestamps, self.fields, self.values = keys, timestamps, fields, values
+            self._gain, self._loss = gain, loss
+            self._store_version = candle_store.version
+        self.last_compute_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Indicators recomputed for {len(keys)} instruments x {len(timestamps)} bars in {self.last_compute_ms:.1f} ms.")
+
+    def update(self):
+        """Compute only the newest column after an intraday cycle, falling back to recompute().
+
+        The incremental path covers the two things a cycle does: revise the forming bar or
+        append the next one. Anything else (new instruments, late corrections) recomputes.
+        """
+        if CANDLE_STORE_ENABLED and candle_store.version == self._store_version:
+            return
+        started = time.perf_counter()
+        keys, timestamps, fields = load_universe_matrix()
+        old_ts = self.timestamps
+        if keys != self.keys or len(timestamps) < 2 or len(old_ts) < 2:
+            return self.recompute()
+
+        if np.array_equal(timestamps, old_ts):
+            drop = 0  # the forming bar was revised
+        elif len(timestamps) == len(old_ts) + 1 and np.array_equal(timestamps[:-1], old_ts):
+            drop = 0  # a new bar landed while the window still has room
+        elif len(timestamps) == len(old_ts) and np.array_equal(timestamps[:-1], old_ts[1:]):
+            drop = 1  # a new bar landed and the oldest one rolled out
+        else:
+            return self.recompute()
+
+        # every column but the newest must match what the current values were computed from
+        kept = len(timestamps) - 1
+        for field in ("high", "low", "close", "volume"):
+            if not np.array_equal(fields[field][:, :kept], self.fields[field][:, drop:drop + kept], equal_nan=True):
+                return self.recompute()
+
+        def extend(matrix, last_column):
+            matrix = matrix[:, drop:drop + kept]
+            return np.concatenate([matrix, last_column[:, None]], axis=1)
+
+        close, high, low, volume = fields["close"], fields["high"], fields["low"], fields["volume"]
+        x, prev_close = close[:, -1], close[:, -2]
+        # recursive state as of the bar before the newest one
+        prev = kept - 1 + drop
+        ema = _step(self.values["ema"][:, prev], x, 2 / (EMA_PERIOD + 1))
+        delta = x - prev_close
+        gain = _step(self._gain[:, prev], _gains(delta), 1 / RSI_PERIOD)
+        loss = _step(self._loss[:, prev], _gains(-delta), 1 / RSI_PERIOD)
+        atr = _step(self.values["atr"][:, prev], _true_range(high[:, -1], low[:, -1], x, prev_close), 1 / ATR_PERIOD)
+
+        values = {
+            "sma": extend(self.values["sma"], self._sma(close[:, -SMA_PERIOD:])[:, -1]),
+            "ema": extend(self.values["ema"], ema),
+            "rsi": extend(self.values["rsi"], self._rsi(gain, loss)),
+            "atr": extend(self.values["atr"], atr),
+            "vwap": extend(self.values["vwap"], self._vwap(timestamps, high, low, close, volume)[:, -1]),
+        }
+        gains, losses = extend(self._gain, gain), extend(self._loss, loss)
+
+        with self._lock:
+            self.timestamps, self.fields, self.values = timestamps, fields, values
+            self._gain, self._loss = gains, losses
+            self._store_version = candle_store.version
+        self.last_compute_ms = (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def _sma(close: np.ndarray) -> np.ndarray:
+        out = np.full(close.shape, np.nan)
+        if close.shape[1] >= SMA_PERIOD:
+            windows = np.lib.stride_tricks.sliding_window_view(close, SMA_PERIOD, axis=1)
+            out[:, SMA_PERIOD - 1:] = windows.mean(axis=-1)
+        return out
+
+    @staticmethod
+    def _rsi(gain, loss):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(loss == 0, np.where(gain == 0, 50.0, 100.0), 100 - 100 / (1 + gain / loss))
+
+    @staticmethod
+    def _vwap(timestamps, high, low, close, volume):
+        # Session VWAP: running sums restart at every IST trading day
+        typical = (high + low + close) / 3
+        pv = np.nan_to_num(typical * volume)
+        vol = np.nan_to_num(volume)
+        cum_pv, cum_vol = np.cumsum(pv, axis=1), np.cumsum(vol, axis=1)
+
+        sessions = _session_ids(timestamps)
+        first = np.searchsorted(sessions, sessions)  # first column of each column's session
+        base_pv = np.where(first > 0, cum_pv[:, np.maximum(first - 1, 0)], 0.0)
+        base_vol = np.where(first > 0, cum_vol[:, np.maximum(first - 1, 0)], 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vwap = (cum_pv - base_pv) / (cum_vol - base_vol)
+        return np.where(np.isnan(close), np.nan, vwap)
+
+    def snapshot(self, instrument_keys: list = None, history: int = 1) -> dict:
+        with self._lock:
+            keys, timestamps, values = self.keys, self.timestamps, self.values
+        if not len(timestamps):
+            return {"timestamps": [], "indicators": {}}
+        history = max(1, min(history, len(timestamps)))
+        index = {key: i for i, key in enumerate(keys)}
+        wanted = keys if not instrument_keys else [k for k in instrument_keys if k in index]
+        rows = [index[k] for k in wanted]
+
+        def clean(arr):
+            return [None if np.isnan(v) else round(float(v), 4) for v in arr]
+
+        return {
+            "timestamps": timestamps[-history:].tolist(),
+            "indicators": {
+                key: {name: clean(values[name][row, -history:]) for name in INDICATOR_NAMES}
+                for key, row in zip(wanted, rows)
+            },
+        }
+
+
+indicator_engine = IndicatorEngine()
+
+def update_indicators():
+    try:
+        indicator_engine.update()
+    except Exception as e:
+        logger.error(f"Error updating indicators: {e}")
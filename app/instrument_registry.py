@@ -0,0 +1,114 @@
+# app/instrument_registry.py - In-process cache of the instruments table, reloaded only when it changes
+from app.db import sync_engine
+import threading
+import hashlib
+import orjson
+import logging
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT_FIELDS = ("instrument_key", "trading_symbol", "company_name", "industry", "segment", "instrument_type", "active")
+
+
+class InstrumentRecord:
+    """Read-only instrument row; attribute-compatible with the ORM Instrument the jobs used before."""
+
+    __slots__ = INSTRUMENT_FIELDS
+
+    def __init__(self, instrument_key, trading_symbol, company_name, industry,
+                 segment=None, instrument_type=None, active=True):
+        values = (instrument_key, trading_symbol, company_name, industry, segment, instrument_type, active)
+        for field, value in zip(INSTRUMENT_FIELDS, values):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("InstrumentRecord is immutable")
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in INSTRUMENT_FIELDS}
+
+    def __repr__(self):
+        return f"InstrumentRecord({self.instrument_key!r}, {self.trading_symbol!r})"
+
+
+def _group(records: tuple, field: str) -> dict:
+    groups = {}
+    for record in records:
+        value = getattr(record, field)
+        if value:
+            groups.setdefault(value, []).append(record)
+    return {value: tuple(group) for value, group in groups.items()}
+
+
+class _Snapshot:
+    # Everything derived from one load, swapped in as a unit so readers never see a mix
+    __slots__ = ("version", "records", "active", "by_key", "by_symbol", "by_industry", "payload", "etag")
+
+    def __init__(self, version: int, records: tuple):
+        self.version = version
+        self.records = records
+        self.active = tuple(r for r in records if r.active)
+        self.by_key = {r.instrument_key: r for r in records}
+        # a symbol can be listed on both NSE and BSE, so these index to groups
+        self.by_symbol = _group(records, "trading_symbol")
+        self.by_industry = _group(records, "industry")
+        self.payload = orjson.dumps([r.as_dict() for r in records])
+        self.etag = f'"{hashlib.blake2b(self.payload, digest_size=8).hexdigest()}"'
+
+
+class InstrumentRegistry:
+    """Lazily loaded, versioned view of the instruments table.
+
+    sync_instrument_rows() calls invalidate() after it commits; the next reader
+    reloads with a single SELECT. Everything else is served from memory.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def snapshot(self) -> _Snapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.version:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != self.version:
+                self._snapshot = _Snapshot(self.version, self._load())
+                logger.info(f"Instrument registry loaded {len(self._snapshot.records)} instruments (version {self.version}).")
+            return self._snapshot
+
+    @staticmethod
+    def _load() -> tuple:
+        conn = sync_engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {', '.join(INSTRUMENT_FIELDS)} FROM instruments ORDER BY instrument_key")
+            return tuple(InstrumentRecord(*row) for row in cursor.fetchall())
+        finally:
+            conn.close()
+
+    def all(self) -> tuple:
+        return self.snapshot().records
+
+    def active(self) -> tuple:
+        return self.snapshot().active
+
+    def get(self, instrument_key: str):
+        return self.snapshot().by_key.get(instrument_key)
+
+    def by_symbol(self, trading_symbol: str) -> tuple:
+        return self.snapshot().by_symbol.get(trading_symbol, ())
+
+    def by_industry(self, industry: str) -> tuple:
+        return self.snapshot().by_industry.get(industry, ())
+
+    def industries(self) -> list:
+        return sorted(self.snapshot().by_industry)
+
+
+instrument_registry = InstrumentRegistry()
@@ -13,3 +13,7 @@ class BaseJob(ABC):
     def schedule(self):
         """Register this job with scheduler."""
         pass
+
+    def warmup(self):
+        """Optional catch-up run, called from the background warmup thread after startup."""
+        pass
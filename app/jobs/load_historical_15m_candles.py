@@ -1,84 +1,164 @@
 from app.jobs.base import BaseJob
-from app.jobs.scheduler import scheduler
+from app.jobs.scheduler import scheduler, TradingDayTrigger
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from app.db_crud import sync_historical_candles_with_db, fetch_all_instruments
-from app.upstox_api import get_historical_candle_data
-from datetime import datetime, timedelta
+from app.db_crud import sync_historical_candles_with_db, bulk_load_historical_candles, fetch_active_instruments
+from app.async_ingest import INGEST_ENGINE, run_historical_cycle
+from app.concurrency import UPSTOX_HISTORICAL_MAX_CONCURRENCY
+from app.upstox_api import get_historical_candle_data, get_historical_candle_body
+from app.resample import rebuild_resampled_candles
+from app.indicators import update_indicators
+from app.gap_detection import refetch_gaps
+from app.candle_decoder import decode_candle_response, candle_columns_to_frame, UPSTOX_DECODER
+from app.coordination import ingest_shard
+from app.trading_calendar import trading_calendar
+from app.metrics import timed, observe_cycle
+from datetime import datetime, timedelta, time
 import pandas as pd
+import asyncio
+from time import monotonic
 import pytz
+import os
 import logging
 
 logger = logging.getLogger(__name__)
 IST = pytz.timezone("Asia/Kolkata")
+# "copy" loads the whole universe through one COPY + set-based merge,
+# "per_instrument" keeps the old sync_historical_candles_with_db path
+HISTORICAL_WRITE_MODE = os.getenv("HISTORICAL_WRITE_MODE", "copy")
+# "gaps" refetches only the bars missing from the session grid, "full" refetches two weeks of every instrument
+HISTORICAL_MODE = os.getenv("HISTORICAL_MODE", "gaps")
+# IST time the historical job runs on trading days
+HISTORICAL_RUN_AT = time.fromisoformat(os.getenv("HISTORICAL_RUN_AT", "18:00"))
 
 def fetch_candles_from_upstox_api_and_sync_with_db():
     try:
-        instruments = fetch_all_instruments()
+        active = fetch_active_instruments()
+        shard = ingest_shard([i.instrument_key for i in active])
+        owned = set(shard)
+        instruments = [i for i in active if i.instrument_key in owned]
+        if not instruments:
+            logger.info("No instruments in this worker's shard, nothing to fetch.")
+            return
+        if HISTORICAL_MODE == "gaps":
+            refetch_gaps([i.instrument_key for i in instruments])
+            rebuild_resampled_candles(shard)
+            update_indicators()
+            return
+
         to_datetime = datetime.now(IST).replace(second=0, microsecond=0)
         to_datetime = to_datetime - timedelta(days=1)
         from_datetime = to_datetime - timedelta(weeks=2)
 
         to_date = to_datetime.strftime('%Y-%m-%d')
         from_date = from_datetime.strftime('%Y-%m-%d')
-        
+        if INGEST_ENGINE == "asyncio":
+            asyncio.run(run_historical_cycle([i.instrument_key for i in instruments], to_date, from_date))
+            rebuild_resampled_candles(shard)
+            update_indicators()
+            return
+
+        collected_frames = []
+        collected_columns = []
+
         def process_instrument(instrument):
             symbol = instrument.instrument_key
             try:
-                raw = get_historical_candle_data(
-                    symbol=symbol,
-                    toDate = to_date,
-                    fromDate = from_date,
-                    timePeriod='minutes',
-                    multiplier='15'
-                )
-                if(raw.status != 'success'):
-                    logger.error(f"Error fetching historical candles for {symbol} 15m: {raw}")
-                    return
-                
-                candles_list = getattr(raw.data, "candles", None)
-
-                if not candles_list or len(candles_list) < 100:
-                    logger.warning(f"{symbol}: Expected at least 100 candles, got {len(candles_list) if candles_list else 0}")
-                    return
-
-                candles_df = pd.DataFrame(
-                    candles_list,
-                    columns=["timestamp", "open", "high", "low", "close", "volume", "oi"]
-                )
-                candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"])
-                sync_historical_candles_with_db(candles_df, instrument.instrument_key, "15m")
+                if UPSTOX_DECODER == "fast":
+                    with timed("historical", "fetch", symbol):
+                        body = get_historical_candle_body(
+                            symbol=symbol,
+                            toDate=to_date,
+                            fromDate=from_date,
+                            timePeriod='minutes',
+                            multiplier='15'
+                        )
+                    with timed("historical", "parse", symbol):
+                        columns = decode_candle_response(body)
+                    if len(columns) < 100:
+                        logger.warning(f"{symbol}: Expected at least 100 candles, got {len(columns)}")
+                        return
+                    if HISTORICAL_WRITE_MODE == "copy":
+                        collected_columns.append((symbol, "15m", columns))
+                        return
+                    candles_df = columns.to_frame()
+                else:
+                    # the SDK deserializes inside the call, so fetch includes its model parsing
+                    with timed("historical", "fetch", symbol):
+                        raw = get_historical_candle_data(
+                            symbol=symbol,
+                            toDate = to_date,
+                            fromDate = from_date,
+                            timePeriod='minutes',
+                            multiplier='15'
+                        )
+                    if(raw.status != 'success'):
+                        logger.error(f"Error fetching historical candles for {symbol} 15m: {raw}")
+                        return
+
+                    candles_list = getattr(raw.data, "candles", None)
+
+                    if not candles_list or len(candles_list) < 100:
+                        logger.warning(f"{symbol}: Expected at least 100 candles, got {len(candles_list) if candles_list else 0}")
+                        return
+
+                    with timed("historical", "parse", symbol):
+                        candles_df = pd.DataFrame(
+                            candles_list,
+                            columns=["timestamp", "open", "high", "low", "close", "volume", "oi"]
+                        )
+                        candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"])
+
+                if HISTORICAL_WRITE_MODE == "copy":
+                    # list.append is atomic, safe to share across worker threads
+                    collected_frames.append(candles_df.assign(instrument_key=symbol, timeframe="15m"))
+                else:
+                    sync_historical_candles_with_db(candles_df, instrument.instrument_key, "15m")
             except Exception as e:
                 logger.error(f"Error fetching candles for {symbol}: {e}")
 
-        # Parallelize this task as each instrument is independent
-        max_workers = min(20, len(instruments))
+        # Parallelize this task as each instrument is independent.
+        # Threads only park on the adaptive controller, which decides how many requests are in flight.
+        max_workers = min(UPSTOX_HISTORICAL_MAX_CONCURRENCY, len(instruments))
 
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = [executor.submit(process_instrument, instrument) for instrument in instruments]
             for f in as_completed(futures):
                 f.result()
 
+        if collected_columns:
+            collected_frames.append(candle_columns_to_frame(collected_columns))
+        if collected_frames:
+            bulk_load_historical_candles(pd.concat(collected_frames, ignore_index=True))
+
+        rebuild_resampled_candles(shard)
+        update_indicators()
+
     except Exception as e:
         logger.error(f"Error in fetch_candles_from_upstox_api_and_sync_with_db: {e}")
     
 class loadHistoricalFifteenMinutesCandles(BaseJob):
     def run(self):
         logger.info("Running loadHistoricalFifteenMinutesCandles Job...")
+        started = monotonic()
+        failed = False
         try:
             fetch_candles_from_upstox_api_and_sync_with_db()
             logger.info("loadHistoricalFifteenMinutesCandles job finished.")
         except Exception as e:
+            failed = True
             logger.error(f"loadHistoricalFifteenMinutesCandles job failed: {e}")
+        observe_cycle("historical", monotonic() - started, failed=failed)
 
     def schedule(self):
+        # Evening of every trading day, after the session has settled
         scheduler.add_job(
-            self.run, 
-            'cron', 
-            hour=12, 
-            minute=30, 
-            day_of_week='tue-sat', 
+            self.run,
+            TradingDayTrigger(at=HISTORICAL_RUN_AT),
             id='load_historical_15m_candles',
             misfire_grace_time=120,
         )
-        # run it once on startup
-        self.run()
\ No newline at end of file
+
+    def warmup(self):
+        # run it once on startup, unless the market is closed today
+        if trading_calendar.is_trading_day(datetime.now(IST).date()):
+            self.run()
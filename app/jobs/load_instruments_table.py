@@ -1,12 +1,21 @@
 from app.jobs.base import BaseJob
 from app.jobs.scheduler import scheduler
-from app.db_crud import sync_instruments_with_db
+from app.db_crud import sync_instruments_with_db, sync_instrument_rows, fetch_active_instruments
+from app.utils.ingest_instruments import iter_instrument_master, INSTRUMENT_MASTER_URL
+from app.coordination import job_lock
+from dotenv import load_dotenv
 import pandas as pd
+import os
 import logging
 
 logger = logging.getLogger(__name__)
 CSV_PATH = "data/NSE_500.csv"
 
+load_dotenv()
+# "master" loads every instrument from the Upstox master and marks the CSV universe active,
+# "csv" syncs only the CSV universe
+INSTRUMENT_SOURCE = os.getenv("INSTRUMENT_SOURCE", "master")
+
 def load_instruments_from_csv(csv_path: str) -> pd.DataFrame:
     df = pd.read_csv(csv_path)
 
@@ -24,12 +33,32 @@ class loadInstrumentsTable(BaseJob):
     def run(self):
         logger.info("Running loadInstrumentsTable Job...")
         try:
-            equity_df = load_instruments_from_csv(CSV_PATH)
-            sync_instruments_with_db(equity_df)
+            # One sync for the whole deployment; other workers skip while it runs
+            with job_lock("loadInstrumentsTable") as acquired:
+                if not acquired:
+                    logger.info("loadInstrumentsTable is running in another worker, skipping.")
+                    return
+                self._sync()
             logger.info("loadInstrumentsTable job finished.")
         except Exception as e:
             logger.error(f"loadInstrumentsTable job failed: {e}")
 
+    def _sync(self):
+        equity_df = load_instruments_from_csv(CSV_PATH)
+        if INSTRUMENT_SOURCE == "master":
+            try:
+                universe = dict(zip(
+                    equity_df["instrument_key"], zip(equity_df["company_name"], equity_df["industry"])
+                ))
+                sync_instrument_rows(iter_instrument_master(INSTRUMENT_MASTER_URL, universe=universe))
+            except Exception as e:
+                logger.error(f"Instrument master sync failed: {e}")
+                # The last good load is still in place; only bootstrap from the CSV if there is none
+                if not fetch_active_instruments():
+                    sync_instruments_with_db(equity_df)
+        else:
+            sync_instruments_with_db(equity_df)
+
     def schedule(self):
         # Weekly job
         scheduler.add_job(
@@ -40,5 +69,7 @@ class loadInstrumentsTable(BaseJob):
             replace_existing=True,
             misfire_grace_time=120,
         )
+
+    def warmup(self):
         # run it once on startup
         self.run()
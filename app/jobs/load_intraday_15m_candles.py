@@ -1,89 +1,174 @@
 from app.jobs.base import BaseJob
-from app.jobs.scheduler import scheduler
+from app.jobs.scheduler import scheduler, BarCloseTrigger
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from app.db_crud import sync_intraday_candles_with_db, fetch_all_instruments
-from app.upstox_api import get_intraday_candle_data
-from datetime import datetime, timedelta
+from app.db_crud import sync_intraday_candles_with_db, fetch_active_instruments
+from app.async_ingest import INGEST_ENGINE, run_intraday_cycle
+from app.concurrency import UPSTOX_INTRADAY_MAX_CONCURRENCY
+from app.upstox_api import get_intraday_candle_data, get_intraday_candle_body
+from app.candle_decoder import decode_candle_response, UPSTOX_DECODER
+from app.candle_batcher import CandleBatchCollector, INTRADAY_WRITE_MODE
+from app.resample import update_resampled_candles
+from app.indicators import update_indicators
+from app.delta_tracker import delta_tracker, INTRADAY_DELTA_WRITES
+from app.trading_calendar import trading_calendar
+from app.coordination import ingest_shard
+from app.market_feed import market_feed, MARKET_FEED_RECONCILE_BARS
+from app.metrics import timed, observe_cycle
+from datetime import datetime
 import pandas as pd
+import asyncio
+import time
 import pytz
+import os
 import logging
 
 logger = logging.getLogger(__name__)
 IST = pytz.timezone("Asia/Kolkata")
+# Seconds after each bar close before fetching, so Upstox has the closed bar
+INTRADAY_TRIGGER_OFFSET = int(os.getenv("INTRADAY_TRIGGER_OFFSET", "120"))
 
 def fetch_candles_from_upstox_api_and_sync_with_db():
     try:
-        instruments = fetch_all_instruments()
-    
+        # Only this worker's share of the universe, recomputed every cycle so a dead worker's
+        # instruments are picked up once its lease expires
+        active = fetch_active_instruments()
+        shard = ingest_shard([i.instrument_key for i in active])
+        owned = set(shard)
+        instruments = [i for i in active if i.instrument_key in owned]
+        if not instruments:
+            logger.info("No instruments in this worker's shard, nothing to fetch.")
+            return
+        delta_tracker.reset_counts()
+        if INGEST_ENGINE == "asyncio":
+            asyncio.run(run_intraday_cycle([i.instrument_key for i in instruments]))
+            if INTRADAY_DELTA_WRITES:
+                delta_tracker.report("Intraday delta refresh")
+            update_resampled_candles(shard)
+            update_indicators()
+            return
+
+        collector = CandleBatchCollector() if INTRADAY_WRITE_MODE == "batched" else None
+
         def process_instrument(instrument):
             symbol = instrument.instrument_key
             try:
-                raw = get_intraday_candle_data(
-                    symbol=symbol,
-                    timePeriod='minutes',
-                    multiplier='15'
-                )
-                if(raw.status != 'success'):
-                    logger.error(f"Error fetching intraday candles for {symbol} 15m: {raw}")
-                    return
-                
-                candles_list = getattr(raw.data, "candles", None)
+                if UPSTOX_DECODER == "fast":
+                    with timed("intraday", "fetch", symbol):
+                        body = get_intraday_candle_body(
+                            symbol=symbol,
+                            timePeriod='minutes',
+                            multiplier='15'
+                        )
+                    with timed("intraday", "parse", symbol):
+                        columns = decode_candle_response(body)
+                    if INTRADAY_DELTA_WRITES:
+                        # Only the forming bar and newly closed ones differ from what is stored
+                        columns = delta_tracker.filter_columns(columns, symbol, "15m")
+                    if collector is not None:
+                        collector.add_columns(columns, symbol, "15m")
+                        return
+                    candles_df = columns.to_frame()
+                else:
+                    # the SDK deserializes inside the call, so fetch includes its model parsing
+                    with timed("intraday", "fetch", symbol):
+                        raw = get_intraday_candle_data(
+                            symbol=symbol,
+                            timePeriod='minutes',
+                            multiplier='15'
+                        )
+                    if(raw.status != 'success'):
+                        logger.error(f"Error fetching intraday candles for {symbol} 15m: {raw}")
+                        return
 
-                candles_df = pd.DataFrame(
-                    candles_list,
-                    columns=["timestamp", "open", "high", "low", "close", "volume", "oi"]
-                )
-                candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"])
-                sync_intraday_candles_with_db(candles_df, instrument.instrument_key, "15m")
+                    candles_list = getattr(raw.data, "candles", None)
+
+                    with timed("intraday", "parse", symbol):
+                        candles_df = pd.DataFrame(
+                            candles_list,
+                            columns=["timestamp", "open", "high", "low", "close", "volume", "oi"]
+                        )
+                        candles_df["timestamp"] = pd.to_datetime(candles_df["timestamp"])
+                    if INTRADAY_DELTA_WRITES:
+                        candles_df = delta_tracker.filter_frame(candles_df, symbol, "15m")
+
+                if candles_df.empty:
+                    return
+                if collector is not None:
+                    collector.add(candles_df, instrument.instrument_key, "15m")
+                else:
+                    sync_intraday_candles_with_db(candles_df, instrument.instrument_key, "15m")
             except Exception as e:
                 logger.error(f"Error fetching candles for {symbol}: {e}")
 
-        # Parallelize this task as each instrument is independent
-        max_workers = min(20, len(instruments))
+        # Parallelize this task as each instrument is independent.
+        # Threads only park on the adaptive controller, which decides how many requests are in flight.
+        max_workers = min(UPSTOX_INTRADAY_MAX_CONCURRENCY, len(instruments))
 
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = [executor.submit(process_instrument, instrument) for instrument in instruments]
             for f in as_completed(futures):
                 f.result()
 
+        # write whatever is still buffered
+        if collector is not None:
+            collector.close()
+        if INTRADAY_DELTA_WRITES:
+            delta_tracker.report("Intraday delta refresh")
+
+        # Derive the higher timeframes from the bars just written, no extra API calls
+        update_resampled_candles(shard)
+        # Indicators only need the newest column recomputed now that the bar has landed
+        update_indicators()
+
     except Exception as e:
         logger.error(f"Error in fetch_candles_from_upstox_api_and_sync_with_db: {e}")
     
 class loadIntradayFifteenMinutesCandles(BaseJob):
+    def __init__(self):
+        # bar closes since the last REST pass while the market feed was healthy
+        self._streamed_bars = 0
+
     def run(self):
+        if market_feed.healthy():
+            self._streamed_bars += 1
+            if self._streamed_bars < MARKET_FEED_RECONCILE_BARS:
+                logger.info(
+                    f"Market feed is live, skipping the REST poll ({self._streamed_bars}/{MARKET_FEED_RECONCILE_BARS} "
+                    "bars until the next reconciliation)."
+                )
+                return
+            # The streamed bars are marked persisted, which would make the delta filter skip every
+            # closed bar; forget them so REST overwrites whatever the feed got wrong
+            delta_tracker.forget("15m")
+        self._streamed_bars = 0
         logger.info("Running loadIntradayFifteenMinutesCandles Job...")
+        started = time.monotonic()
+        # the bar this run ingests, when it runs shortly after a close as scheduled
+        bar_close = trading_calendar.last_bar_close(datetime.now(IST))
+        if bar_close is not None and time.time() - bar_close.timestamp() > 15 * 60:
+            bar_close = None
+        failed = False
         try:
             fetch_candles_from_upstox_api_and_sync_with_db()
             logger.info("loadIntradayFifteenMinutesCandles job finished.")
         except Exception as e:
+            failed = True
             logger.error(f"loadIntradayFifteenMinutesCandles job failed: {e}")
+        observe_cycle(
+            "intraday", time.monotonic() - started,
+            bar_close=bar_close.timestamp() if bar_close is not None else None, failed=failed,
+        )
 
     def schedule(self):
+        # Once per 15m bar close on trading days (special sessions included), nothing on holidays
         scheduler.add_job(
-            self.run, 
-            'cron', 
-            hour=3, 
-            minute=47, 
-            day_of_week='mon-fri', 
-            id='load_15m_candles_1',
-            misfire_grace_time=120,
-        )
-        scheduler.add_job(
-            self.run, 
-            'cron', 
-            hour='4-9', 
-            minute='2,17,32,47', 
-            day_of_week='mon-fri', 
-            id='load_15m_candles_2',
+            self.run,
+            BarCloseTrigger(bar_minutes=15, offset_seconds=INTRADAY_TRIGGER_OFFSET),
+            id='load_15m_candles',
             misfire_grace_time=120,
         )
-        scheduler.add_job(self.run, 
-            'cron', 
-            hour=10, 
-            minute=2, 
-            day_of_week='mon-fri', 
-            id='load_15m_candles_3',
-            misfire_grace_time=120,
-        )
-        # run it once on startup
-        self.run()
\ No newline at end of file
+
+    def warmup(self):
+        # run it once on startup, unless the market is closed today
+        if trading_calendar.is_trading_day(datetime.now(IST).date()):
+            self.run()
\ No newline at end of file
@@ -0,0 +1,42 @@
+from app.jobs.base import BaseJob
+from app.jobs.scheduler import scheduler, BarCloseTrigger
+from app.jobs.load_intraday_15m_candles import INTRADAY_TRIGGER_OFFSET
+from app.candle_store import candle_store, CANDLE_STORE_ENABLED
+from app.indicators import update_indicators
+from app.instrument_registry import instrument_registry
+from app.coordination import worker_lease, INGEST_ROLE
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+# Seconds after the intraday fetch starts before API-only processes reload what the workers wrote
+READ_CACHE_REFRESH_DELAY = int(os.getenv("READ_CACHE_REFRESH_DELAY", "90"))
+
+class refreshReadCaches(BaseJob):
+    """API-only processes (INGEST_ROLE=api) write no candles and sync no instruments, so their
+    in-memory store and instrument registry never see the workers' writes; reload both from
+    the DB once per bar instead. An "all" process that shares the universe with other workers
+    only writes its own shard, so it reloads too whenever its last shard was partial. The
+    registry's ETag is a content hash, so an unchanged reload still answers clients with 304."""
+
+    def run(self):
+        if INGEST_ROLE != "api" and not worker_lease.sharded:
+            # this process ingested the whole universe, its caches are already complete
+            return
+        logger.info("Running refreshReadCaches Job...")
+        try:
+            instrument_registry.invalidate()
+            if CANDLE_STORE_ENABLED:
+                candle_store.rebuild_from_db()
+            update_indicators()
+            logger.info("refreshReadCaches job finished.")
+        except Exception as e:
+            logger.error(f"refreshReadCaches job failed: {e}")
+
+    def schedule(self):
+        scheduler.add_job(
+            self.run,
+            BarCloseTrigger(bar_minutes=15, offset_seconds=INTRADAY_TRIGGER_OFFSET + READ_CACHE_REFRESH_DELAY),
+            id='refreshReadCaches',
+            misfire_grace_time=120,
+        )
@@ -1,13 +1,29 @@
 # app/jobs/registry.py
+from app.jobs.worker_heartbeat import workerHeartbeat
 from app.jobs.load_instruments_table import loadInstrumentsTable
 from app.jobs.load_historical_15m_candles import loadHistoricalFifteenMinutesCandles
 from app.jobs.load_intraday_15m_candles import loadIntradayFifteenMinutesCandles
+from app.jobs.refresh_read_caches import refreshReadCaches
+from app.jobs.stream_market_feed import streamMarketFeed
+from app.market_feed import MARKET_FEED_ENABLED
+from app.coordination import INGEST_ROLE
 
 def register_all_jobs():
-    jobs = [
-        loadInstrumentsTable(), 
-        loadHistoricalFifteenMinutesCandles(), 
-        loadIntradayFifteenMinutesCandles()
-    ]
+    if INGEST_ROLE == "api":
+        jobs = [refreshReadCaches()]
+    else:
+        jobs = [
+            workerHeartbeat(),
+            loadInstrumentsTable(), 
+            loadHistoricalFifteenMinutesCandles(), 
+            loadIntradayFifteenMinutesCandles()
+        ]
+        if MARKET_FEED_ENABLED:
+            # ticks -> bars as they trade; the intraday job above becomes the REST reconciliation
+            jobs.append(streamMarketFeed())
+        if INGEST_ROLE == "all":
+            # serves the API from memory but, next to other workers, only ingests its shard
+            jobs.append(refreshReadCaches())
     for job in jobs:
         job.schedule()
+    return jobs
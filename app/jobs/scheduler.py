@@ -2,6 +2,9 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.base import JobLookupError
 from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.triggers.base import BaseTrigger
+from app.trading_calendar import trading_calendar, TradingCalendar
+from datetime import datetime, timedelta, time
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,3 +28,43 @@ def shutdown_scheduler():
         logger.info("Scheduler shut down.")
     except JobLookupError:
         logger.warning("Scheduler already shut down.")
+
+
+class BarCloseTrigger(BaseTrigger):
+    """Fires `offset_seconds` after every bar close of every trading session, and never on closed days."""
+
+    def __init__(self, bar_minutes: int = 15, offset_seconds: int = 120, calendar: TradingCalendar = trading_calendar):
+        self.bar_minutes = bar_minutes
+        self.offset = timedelta(seconds=offset_seconds)
+        self.calendar = calendar
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        after = (previous_fire_time or now - timedelta(microseconds=1)) - self.offset
+        close = self.calendar.next_bar_close(after, self.bar_minutes)
+        return close + self.offset if close is not None else None
+
+    def __str__(self):
+        return f"bar_close[{self.bar_minutes}m + {int(self.offset.total_seconds())}s]"
+
+
+class TradingDayTrigger(BaseTrigger):
+    """Fires once at `at` (exchange time) on every trading day."""
+
+    def __init__(self, at: time, calendar: TradingCalendar = trading_calendar, max_days: int = 30):
+        self.at = at
+        self.calendar = calendar
+        self.max_days = max_days
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        after = previous_fire_time or now - timedelta(microseconds=1)
+        day = after.astimezone(self.calendar.tz).date()
+        for _ in range(self.max_days):
+            if self.calendar.is_trading_day(day):
+                fire = self.calendar.tz.localize(datetime.combine(day, self.at))
+                if fire > after:
+                    return fire
+            day += timedelta(days=1)
+        return None
+
+    def __str__(self):
+        return f"trading_day[{self.at:%H:%M}]"
@@ -0,0 +1,35 @@
+from app.jobs.base import BaseJob
+from app.jobs.scheduler import scheduler, TradingDayTrigger
+from app.market_feed import market_feed
+from datetime import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+# Exchange time the feed connects on trading days, ahead of the open so the first bar is complete
+MARKET_FEED_START = os.getenv("MARKET_FEED_START", "09:05")
+
+class streamMarketFeed(BaseJob):
+    """Runs the streaming ingestor (app/market_feed.py) through each trading session;
+    it stops by itself a minute after the close."""
+
+    def run(self):
+        logger.info("Running streamMarketFeed Job...")
+        try:
+            market_feed.start()
+        except Exception as e:
+            logger.error(f"streamMarketFeed job failed: {e}")
+
+    def schedule(self):
+        hour, minute = MARKET_FEED_START.split(":")
+        scheduler.add_job(
+            self.run,
+            TradingDayTrigger(at=time(int(hour), int(minute))),
+            id='streamMarketFeed',
+            misfire_grace_time=6 * 3600,
+        )
+
+    def warmup(self):
+        # a restart mid-session reconnects straight away
+        if market_feed.session_end() is not None:
+            self.run()
@@ -0,0 +1,27 @@
+from app.jobs.base import BaseJob
+from app.jobs.scheduler import scheduler
+from app.coordination import worker_lease, WORKER_HEARTBEAT_SECONDS
+import logging
+
+logger = logging.getLogger(__name__)
+
+class workerHeartbeat(BaseJob):
+    def run(self):
+        try:
+            worker_lease.heartbeat()
+        except Exception as e:
+            logger.error(f"workerHeartbeat job failed: {e}")
+
+    def schedule(self):
+        scheduler.add_job(
+            self.run,
+            trigger='interval',
+            seconds=WORKER_HEARTBEAT_SECONDS,
+            id='workerHeartbeat',
+            replace_existing=True,
+            misfire_grace_time=WORKER_HEARTBEAT_SECONDS,
+        )
+
+    def warmup(self):
+        # join the ring before the catch-up runs compute their shard
+        self.run()
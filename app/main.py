@@ -1,14 +1,19 @@
 from fastapi import FastAPI, Depends
-from sqlalchemy.orm import Session
 from sqlalchemy.ext.asyncio import AsyncSession
-from app import models
-from app.models import Instrument, Candle
-from sqlalchemy.future import select
-from app.utils.ingest_instruments import load_instruments
 from app.jobs.scheduler import start_scheduler, shutdown_scheduler
-from app.jobs.registry import register_all_jobs
-from app.db import Base, sync_engine, async_engine, get_sync_session, get_async_session
+from app.db import get_async_session
 from app.logging_config import setup_logging
+from app.concurrency import concurrency_stats
+from fastapi import HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from app.instrument_registry import instrument_registry
+from app.warmup import warmup, start_warmup
+from app.coordination import worker_lease, INGEST_ROLE
+from app.metrics import render as render_metrics
+from datetime import datetime
+from typing import Optional, Literal
+import asyncio
 import os, logging
 
 setup_logging()
@@ -18,35 +23,235 @@ app = FastAPI(title="Stock Feed Service")
 @app.on_event("startup")
 async def startup_event():
     logging.info(f"Connecting to database at {os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}")
-    try:
-        # Create tables
-        Base.metadata.create_all(bind=sync_engine)
-        logging.info("Database tables created successfully")
-        # Start scheduler
-        start_scheduler()
-        register_all_jobs()
-    except Exception as e:
-        logging.error(f"Error during startup: {e}")
-     
+    # Schema setup, cache rebuilds and the jobs' catch-up runs happen on the warmup thread
+    # (app/warmup.py) so uvicorn accepts requests straight away; /ready reports when they are done.
+    start_scheduler()
+    start_warmup()
+
+@app.get("/ready", summary="Readiness: 200 once startup warmup has finished, 503 with progress until then")
+def get_ready():
+    return JSONResponse(warmup.status(), status_code=200 if warmup.ready else 503)
+
+def _instruments_response(request: Request) -> Response:
+    # Pre-serialized registry payload; clients revalidate with If-None-Match and get a 304
+    snapshot = instrument_registry.snapshot()
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if snapshot.etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}:
+        return Response(status_code=304, headers=headers)
+    return Response(snapshot.payload, media_type="application/json", headers=headers)
+
 # --- Example sync route ---
 @app.get("/instruments", summary="Get all instruments (sync)")
-def get_instruments(db: Session = Depends(get_sync_session)):
-    res = db.query(Instrument).all()
-    db.close()
-    return res
+def get_instruments(request: Request):
+    return _instruments_response(request)
 
 # --- Example async route ---
 @app.get("/instruments-async", summary="Get all instruments (async)")
-async def get_instruments_async(db: AsyncSession = Depends(get_async_session)):
-    stmt = select(Instrument)
-    result = await db.execute(stmt)
-    instruments = result.scalars().all()
-    return instruments
+async def get_instruments_async(request: Request):
+    # a reload after invalidation does blocking DB I/O, so keep it off the event loop
+    await run_in_threadpool(instrument_registry.snapshot)
+    return _instruments_response(request)
+
+
+@app.get("/ingest/concurrency", summary="Adaptive Upstox concurrency windows and throttle counts")
+def get_ingest_concurrency():
+    return concurrency_stats()
+
+
+@app.get("/ingest/market-feed", summary="Streaming ingestion: feed health, tick counts and bars written")
+def get_market_feed():
+    from app.market_feed import market_feed
+
+    return market_feed.status()
+
+
+@app.get("/metrics", summary="Ingestion stage latencies, pool usage and retries in Prometheus text format")
+def get_metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _split(values: Optional[str]) -> list:
+    return [value.strip() for value in values.split(",") if value.strip()] if values else []
+
+
+# Pushed candles: every committed bar goes out to matching subscribers straight from the writer
+# (app/candle_bus.py). Filters combine as timeframe AND (instrument OR industry); none means all.
+@app.websocket("/ws/candles")
+async def candles_websocket(
+    websocket: WebSocket,
+    instrument_keys: Optional[str] = None,
+    timeframes: Optional[str] = None,
+    industries: Optional[str] = None,
+):
+    from app.candle_bus import candle_bus
+
+    await websocket.accept()
+    subscription = candle_bus.subscribe()
+    subscription.update(_split(instrument_keys), _split(timeframes), _split(industries))
+
+    async def receive_filters():
+        # {"action": "subscribe" | "unsubscribe", "instrument_keys": [...], "timeframes": [...], "industries": [...]}
+        try:
+            while True:
+                try:
+                    request = await websocket.receive_json()
+                    subscription.update(
+                        request.get("instrument_keys", []), request.get("timeframes", []), request.get("industries", []),
+                        remove=request.get("action") == "unsubscribe",
+                    )
+                except (ValueError, AttributeError, TypeError):
+                    await websocket.send_json({"type": "error", "detail": "expected a JSON object with action and filter lists"})
+                    continue
+                await websocket.send_json({"type": "subscribed", "filters": subscription.filters()})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            subscription.close()
+
+    receiver = asyncio.create_task(receive_filters())
+    try:
+        await websocket.send_json({"type": "subscribed", "filters": subscription.filters()})
+        while True:
+            message = await subscription.next()
+            if message is None:
+                if subscription.dropped:
+                    await websocket.close(code=1013, reason="slow consumer, queue full")
+                break
+            await websocket.send_text(message.decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        candle_bus.unsubscribe(subscription)
+
+
+@app.get("/candles/stream", summary="Server-sent events with every committed bar matching the filters")
+async def candles_sse(
+    request: Request,
+    instrument_keys: Optional[str] = Query(None, description="Comma-separated instrument keys"),
+    timeframes: Optional[str] = Query(None, description="Comma-separated timeframes, all when omitted"),
+    industries: Optional[str] = Query(None, description="Comma-separated industries"),
+):
+    from app.candle_bus import candle_bus
+
+    subscription = candle_bus.subscribe()
+    subscription.update(_split(instrument_keys), _split(timeframes), _split(industries))
+
+    async def events():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.next(), timeout=15)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # comment line, keeps proxies from closing an idle stream
+                    yield b": keep-alive\n\n"
+                    continue
+                if message is None:
+                    yield b"event: dropped\ndata: {\"reason\": \"slow consumer, queue full\"}\n\n"
+                    break
+                yield b"event: candles\ndata: " + message + b"\n\n"
+        finally:
+            candle_bus.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/candles/{instrument_key}/latest", summary="Latest candles from the in-memory store")
+def get_latest_candles(instrument_key: str, timeframe: str = "15m", limit: int = 100):
+    from app.candle_store import candle_store
+
+    view = candle_store.get(instrument_key, timeframe, limit)
+    if view is None:
+        raise HTTPException(status_code=404, detail=f"No candles in memory for {instrument_key} {timeframe}")
+    return {
+        "instrument_key": instrument_key,
+        "timeframe": timeframe,
+        **{field: arr.tolist() for field, arr in view.items()},
+    }
+
+
+@app.get("/candles/{instrument_key}", summary="Candles for one instrument, keyset paginated")
+async def get_candles(
+    instrument_key: str,
+    timeframe: str = "15m",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    cursor: Optional[str] = None,
+    format: Literal["json", "columnar", "arrow"] = "json",
+    db: AsyncSession = Depends(get_async_session),
+):
+    from app.candle_queries import fetch_candle_page, render_candle_page
+
+    rows, next_cursor = await fetch_candle_page(db, [instrument_key], timeframe, start, end, limit, cursor)
+    return render_candle_page(rows, next_cursor, timeframe, format)
+
+@app.get("/candles", summary="Candles for several instruments, keyset paginated")
+async def get_candles_multi(
+    instrument_keys: str = Query(..., description="Comma-separated instrument keys"),
+    timeframe: str = "15m",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    cursor: Optional[str] = None,
+    format: Literal["json", "columnar", "arrow"] = "json",
+    db: AsyncSession = Depends(get_async_session),
+):
+    keys = [key.strip() for key in instrument_keys.split(",") if key.strip()]
+    from app.candle_queries import fetch_candle_page, render_candle_page
+
+    rows, next_cursor = await fetch_candle_page(db, keys, timeframe, start, end, limit, cursor)
+    return render_candle_page(rows, next_cursor, timeframe, format)
+
+
+@app.get("/indicators", summary="SMA, EMA, RSI, ATR and VWAP on 15m bars for the whole universe")
+def get_indicators(
+    instrument_keys: Optional[str] = Query(None, description="Comma-separated instrument keys, all when omitted"),
+    history: int = Query(1, ge=1, le=100),
+):
+    from app.indicators import indicator_engine
+
+    keys = [key.strip() for key in instrument_keys.split(",") if key.strip()] if instrument_keys else None
+    return {
+        "timeframe": "15m",
+        "computed_ms": round(indicator_engine.last_compute_ms, 2),
+        **indicator_engine.snapshot(keys, history),
+    }
+
+
+@app.get("/screener", summary="Filter, sort and group the whole universe on its latest bar")
+def get_screener(
+    filter: Optional[str] = Query(None, description="Expression over the fields, e.g. pct_change > 2 and rel_volume > 1.5"),
+    sort: str = Query("-pct_change", description="Comma-separated expressions, '-' for descending"),
+    timeframe: str = "15m",
+    limit: int = Query(50, ge=1, le=5000),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    group_by: Optional[Literal["industry", "segment"]] = None,
+    industries: Optional[str] = Query(None, description="Comma-separated industries to screen"),
+    current_only: bool = Query(True, description="Skip instruments whose latest bar is not the newest one"),
+):
+    from app.screener import screener, ScreenError, NUMERIC_FIELDS, STRING_FIELDS
+
+    try:
+        return screener.screen(timeframe, filter, sort, limit, _split(fields), group_by, _split(industries), current_only)
+    except ScreenError as e:
+        raise HTTPException(status_code=400, detail={"error": str(e), "fields": [*NUMERIC_FIELDS, *STRING_FIELDS]})
 
 
 @app.on_event("shutdown")
 def on_shutdown():
     shutdown_scheduler()
+    if INGEST_ROLE != "api":
+        from app.market_feed import market_feed
+
+        # closes the forming bars and flushes them before the lease goes
+        market_feed.stop()
+        worker_lease.release()
 
 @app.get("/")
 def health_check():
@@ -0,0 +1,484 @@
+# app/market_feed.py - Streaming ingestion: market-feed ticks -> 1m/15m bars -> candles
+#
+#   MARKET_FEED_ENABLED=true uvicorn app.main:app                          # Upstox feed, live session
+#   MARKET_FEED_RECORD=data/ticks/2025-06-06.jsonl ...                      # also keep every message
+#   python -m app.market_feed replay data/ticks/2025-06-06.jsonl --dry-run  # offline, no Upstox
+#
+# The feed source is pluggable: anything with messages(keys), subscribe(keys, method) and clock()
+# works. UpstoxFeedSource reads the v3 market data WebSocket, FileTickSource replays recorded
+# messages. Messages are decoded into TickBatch arrays and folded into the TickAggregator;
+# closed bars are flushed every MARKET_FEED_FLUSH_INTERVAL seconds through bulk_upsert_candles,
+# so the candle store, delta tracker and metrics see them like any other write.
+# The REST intraday job keeps running as the reconciliation pass (MARKET_FEED_RECONCILE_BARS).
+from app.tick_aggregator import TickAggregator, TickBatch, STREAM_TIMEFRAMES, TIMEFRAME_SECONDS
+from app.trading_calendar import trading_calendar
+from app.metrics import CYCLE_LAG_SECONDS, MARKET_FEED_TICKS, MARKET_FEED_RECONNECTS, MARKET_FEED_CONNECTED
+from app.async_ingest import UPSTOX_BASE_URL, UPSTOX_ACCESS_TOKEN
+from dotenv import load_dotenv
+from datetime import datetime
+import pandas as pd
+import threading
+import aiohttp
+import asyncio
+import orjson
+import uuid
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+MARKET_FEED_ENABLED = os.getenv("MARKET_FEED_ENABLED", "false").lower() == "true"
+# "upstox" streams the live feed, "file" replays MARKET_FEED_FILE
+MARKET_FEED_SOURCE = os.getenv("MARKET_FEED_SOURCE", "upstox")
+# Direct WebSocket URL (e.g. the fake server); empty asks Upstox's authorize endpoint for one
+MARKET_FEED_URL = os.getenv("MARKET_FEED_URL", "")
+# "full" carries the day's cumulative volume (vtt) and oi; "ltpc" only last trade price/qty
+MARKET_FEED_MODE = os.getenv("MARKET_FEED_MODE", "full")
+MARKET_FEED_FILE = os.getenv("MARKET_FEED_FILE", "")
+MARKET_FEED_REPLAY_SPEED = float(os.getenv("MARKET_FEED_REPLAY_SPEED", "0"))
+MARKET_FEED_RECORD = os.getenv("MARKET_FEED_RECORD", "")
+MARKET_FEED_FLUSH_INTERVAL = float(os.getenv("MARKET_FEED_FLUSH_INTERVAL", "2"))
+# No message for this long counts as a dead feed, and the REST job goes back to every bar
+MARKET_FEED_STALE_SECONDS = float(os.getenv("MARKET_FEED_STALE_SECONDS", "30"))
+# While the feed is healthy the REST intraday job only runs on every Nth bar close
+MARKET_FEED_RECONCILE_BARS = int(os.getenv("MARKET_FEED_RECONCILE_BARS", "4"))
+# How often the worker's shard is recomputed and the subscription adjusted
+MARKET_FEED_RESHARD_SECONDS = float(os.getenv("MARKET_FEED_RESHARD_SECONDS", "60"))
+MARKET_FEED_SUBSCRIBE_CHUNK = int(os.getenv("MARKET_FEED_SUBSCRIBE_CHUNK", "500"))
+
+# Rows held back after a failed flush before the oldest are dropped; REST reconciliation refills them
+MAX_PENDING_ROWS = 200_000
+RECONNECT_DELAYS = (1, 2, 5, 10, 30)
+# Decoded messages are folded into the aggregator together once this many ticks or this much time
+# has piled up, since one fold costs about the same for 2 ticks as for 2000
+TICK_BATCH_TICKS = 2000
+TICK_BATCH_SECONDS = 0.1
+
+
+def _decode_protobuf(data: bytes) -> dict:
+    # generated classes ship with the Upstox SDK; imported here so the JSON path needs neither
+    from upstox_client.feeder.proto import MarketDataFeedV3_pb2
+    from google.protobuf.json_format import MessageToDict
+
+    response = MarketDataFeedV3_pb2.FeedResponse()
+    response.ParseFromString(data)
+    return MessageToDict(response)
+
+
+class FeedDecoder:
+    """Feed messages (the v3 FeedResponse as a dict) -> TickBatch.
+
+    Traded volume per tick comes from the change in the day's cumulative volume when the
+    feed carries it, otherwise from the last traded quantity of trades not seen before.
+    """
+
+    def __init__(self):
+        self._total_volume = {}
+        self._last_trade = {}
+
+    def decode(self, message: dict, wanted: set = None) -> TickBatch:
+        keys, timestamps, prices, volumes, ois = [], [], [], [], []
+        for key, feed in (message.get("feeds") or {}).items():
+            if wanted is not None and key not in wanted:
+                continue
+            full = feed.get("fullFeed") or {}
+            market = full.get("marketFF") or full.get("indexFF") or {}
+            ltpc = feed.get("ltpc") or market.get("ltpc")
+            if not ltpc or not ltpc.get("ltt"):
+                continue
+            ltt = int(ltpc["ltt"])
+            new_trade = self._last_trade.get(key) != ltt
+            self._last_trade[key] = ltt
+
+            total = market.get("vtt")
+            if total is not None:
+                total = float(total)
+                previous = self._total_volume.get(key)
+                self._total_volume[key] = total
+                if previous is not None and total >= previous:
+                    volume = total - previous
+                else:
+                    volume = float(ltpc.get("ltq") or 0) if new_trade else 0.0
+            else:
+                volume = float(ltpc.get("ltq") or 0) if new_trade else 0.0
+
+            keys.append(key)
+            timestamps.append(ltt // 1000)
+            prices.append(float(ltpc["ltp"]))
+            volumes.append(volume)
+            ois.append(float(market.get("oi") or 0))
+        return TickBatch(keys, timestamps, prices, volumes, ois)
+
+
+class UpstoxFeedSource:
+    """Upstox market data feed v3: binary frames are protobuf FeedResponses, text frames JSON."""
+
+    def __init__(self, url: str = MARKET_FEED_URL, mode: str = MARKET_FEED_MODE, record: str = MARKET_FEED_RECORD):
+        self.url = url
+        self.mode = mode
+        self.record = record
+        self.finished = False
+        self._ws = None
+
+    def clock(self) -> float:
+        return time.time()
+
+    async def _authorize(self, http: aiohttp.ClientSession) -> str:
+        async with http.get(f"{UPSTOX_BASE_URL}/v3/feed/market-data-feed/authorize") as resp:
+            resp.raise_for_status()
+            data = (await resp.json()).get("data") or {}
+        return data.get("authorized_redirect_uri") or data["authorizedRedirectUri"]
+
+    async def subscribe(self, keys: list, method: str = "sub"):
+        keys = list(keys)
+        for start in range(0, len(keys), MARKET_FEED_SUBSCRIBE_CHUNK):
+            # Upstox only accepts subscription requests as binary frames
+            await self._ws.send_bytes(orjson.dumps({
+                "guid": uuid.uuid4().hex, "method": method,
+                "data": {"mode": self.mode, "instrumentKeys": keys[start:start + MARKET_FEED_SUBSCRIBE_CHUNK]},
+            }))
+
+    async def messages(self, keys: list):
+        headers = {"Accept": "*/*"}
+        if UPSTOX_ACCESS_TOKEN:
+            headers["Authorization"] = f"Bearer {UPSTOX_ACCESS_TOKEN}"
+        record = open(self.record, "ab") if self.record else None
+        try:
+            async with aiohttp.ClientSession(headers=headers) as http:
+                url = self.url or await self._authorize(http)
+                async with http.ws_connect(url, heartbeat=30) as ws:
+                    self._ws = ws
+                    await self.subscribe(keys)
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.BINARY:
+                            message = _decode_protobuf(msg.data)
+                        elif msg.type == aiohttp.WSMsgType.TEXT:
+                            message = orjson.loads(msg.data)
+                        else:
+                            break
+                        if record is not None:
+                            record.write(orjson.dumps(message) + b"\n")
+                        yield message
+        finally:
+            self._ws = None
+            if record is not None:
+                record.close()
+
+
+class FileTickSource:
+    """Feed messages recorded as JSON lines (MARKET_FEED_RECORD), replayed in order.
+
+    The clock follows the messages' currentTs, so bars close exactly as they did live;
+    with `speed` > 0 the replay is paced at that multiple of the recorded rate.
+    """
+
+    def __init__(self, path: str = MARKET_FEED_FILE, speed: float = MARKET_FEED_REPLAY_SPEED):
+        self.path = path
+        self.speed = speed
+        self.finished = False
+        self._clock = 0.0
+
+    def clock(self) -> float:
+        return self._clock
+
+    async def subscribe(self, keys: list, method: str = "sub"):
+        pass
+
+    def instrument_keys(self) -> list:
+        keys = set()
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    keys.update((orjson.loads(line).get("feeds") or {}).keys())
+        return sorted(keys)
+
+    async def messages(self, keys: list):
+        first = None
+        started = time.monotonic()
+        with open(self.path, "rb") as f:
+            for count, line in enumerate(f):
+                if not line.strip():
+                    continue
+                message = orjson.loads(line)
+                at = int(message.get("currentTs") or 0) / 1000
+                if at and self.speed:
+                    first = first or at
+                    delay = (at - first) / self.speed - (time.monotonic() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif count % 1000 == 0:
+                    # let the flush task run during a full-speed replay
+                    await asyncio.sleep(0)
+                self._clock = max(self._clock, at)
+                yield message
+        self.finished = True
+
+
+def make_source():
+    if MARKET_FEED_SOURCE == "file":
+        return FileTickSource()
+    return UpstoxFeedSource()
+
+
+def _write_bars(frame: pd.DataFrame) -> int:
+    from app.db_crud import bulk_upsert_candles
+
+    return bulk_upsert_candles(frame, job="stream")
+
+
+def _after_bar_close(instrument_keys: list):
+    from app.resample import update_resampled_candles
+    from app.indicators import update_indicators
+    from app.db_crud import trim_candles, CANDLE_RETENTION_BARS
+
+    update_resampled_candles(instrument_keys)
+    update_indicators()
+    # 15m and up are trimmed by their own jobs; the feed is the only writer of 1m bars
+    if "1m" in STREAM_TIMEFRAMES:
+        trim_candles(["1m"], CANDLE_RETENTION_BARS)
+
+
+def _shard() -> list:
+    from app.db_crud import fetch_active_instruments
+    from app.coordination import ingest_shard
+
+    return ingest_shard([i.instrument_key for i in fetch_active_instruments()])
+
+
+class MarketFeed:
+    """One streaming session at a time, on its own thread and event loop."""
+
+    def __init__(self):
+        self.aggregator = None
+        self.source = None
+        self.keys = []
+        self.connected = False
+        self.last_message_at = None
+        self.messages = 0
+        self.bars_written = 0
+        self.flush_failures = 0
+        self.write = _write_bars
+        self.after_bar_close = _after_bar_close
+        self._pending = None
+        self._batches = []
+        self._batched_ticks = 0
+        self._batch_started = None
+        self._decoder = None
+        self._consumer = None
+        self._streaming = False
+        self._until = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, source=None):
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=lambda: asyncio.run(self.run(source)), name="market-feed", daemon=True,
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        self._stop.set()
+        if self.running:
+            self._thread.join(timeout)
+
+    def healthy(self) -> bool:
+        return (
+            self.running and self.connected and self.last_message_at is not None
+            and time.monotonic() - self.last_message_at < MARKET_FEED_STALE_SECONDS
+        )
+
+    def status(self) -> dict:
+        aggregator = self.aggregator
+        return {
+            "running": self.running,
+            "healthy": self.healthy(),
+            "instruments": len(self.keys),
+            "messages": self.messages,
+            "ticks": aggregator.ticks if aggregator else 0,
+            "late_ticks": aggregator.late_ticks if aggregator else 0,
+            "outside_session_ticks": aggregator.outside_session if aggregator else 0,
+            "forming_bars": {tf: aggregator.forming(tf) for tf in STREAM_TIMEFRAMES} if aggregator else {},
+            "bars_written": self.bars_written,
+            "flush_failures": self.flush_failures,
+        }
+
+    @staticmethod
+    def session_end():
+        """Epoch seconds after which today's session is over, or None when there is none left today."""
+        session = trading_calendar.session(datetime.now(trading_calendar.tz).date())
+        if session is None or time.time() > session[1].timestamp():
+            return None
+        return session[1].timestamp() + 60
+
+    async def run(self, source=None, write=_write_bars, after_bar_close=_after_bar_close, keys: list = None):
+        """Stream until the session ends (live) or the source runs dry (replay), then flush everything."""
+        self.source = source = source or make_source()
+        self.aggregator = TickAggregator()
+        self.write = write
+        self.after_bar_close = after_bar_close
+        until = None if isinstance(source, FileTickSource) else self.session_end()
+        if until is None and not isinstance(source, FileTickSource):
+            logger.info("No trading session left today, market feed not started.")
+            return
+        self.keys = keys if keys is not None else await asyncio.to_thread(_shard)
+        logger.info(f"Market feed starting for {len(self.keys)} instruments ({type(source).__name__}).")
+
+        self._until = until
+        self._decoder = FeedDecoder()
+        self._streaming = True
+        flusher = asyncio.create_task(self._flush_loop())
+        attempt = 0
+        try:
+            while not self._should_stop() and not source.finished:
+                # a task, so the flush loop can cut a connection at the close or on stop()
+                self._consumer = asyncio.create_task(self._consume(source, static_keys=keys is not None))
+                await asyncio.wait([self._consumer])
+                self.connected = False
+                MARKET_FEED_CONNECTED.set(0)
+                if self._consumer.cancelled():
+                    break
+                error = self._consumer.exception()
+                if self._should_stop() or source.finished:
+                    break
+                if error is not None:
+                    logger.error(f"Market feed connection failed: {error}")
+                    attempt += 1
+                else:
+                    logger.warning("Market feed connection closed by the server.")
+                    attempt = 0
+                MARKET_FEED_RECONNECTS.inc()
+                await asyncio.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+        finally:
+            # let an in-progress write finish rather than cancelling it halfway
+            self._streaming = False
+            await flusher
+            self._fold()
+            self.aggregator.close_all()
+            await self._flush()
+            logger.info(f"Market feed stopped: {self.status()}")
+
+    def _should_stop(self) -> bool:
+        return self._stop.is_set() or (self._until is not None and time.time() >= self._until)
+
+    async def _consume(self, source, static_keys: bool):
+        # kept across reconnects: the snapshot sent after a reconnect must not count its volume twice
+        decoder = self._decoder
+        wanted = set(self.keys)
+        resharded = time.monotonic()
+        async for message in source.messages(self.keys):
+            self.connected = True
+            MARKET_FEED_CONNECTED.set(1)
+            self.last_message_at = time.monotonic()
+            self.messages += 1
+            batch = decoder.decode(message, wanted)
+            if len(batch):
+                MARKET_FEED_TICKS.inc(len(batch))
+                if not self._batches:
+                    self._batch_started = time.monotonic()
+                self._batches.append(batch)
+                self._batched_ticks += len(batch)
+                if self._batched_ticks >= TICK_BATCH_TICKS or time.monotonic() - self._batch_started >= TICK_BATCH_SECONDS:
+                    self._fold()
+            if self._stop.is_set():
+                return
+            if not static_keys and time.monotonic() - resharded >= MARKET_FEED_RESHARD_SECONDS:
+                resharded = time.monotonic()
+                keys = await asyncio.to_thread(_shard)
+                added, removed = set(keys) - wanted, wanted - set(keys)
+                if added or removed:
+                    logger.info(f"Market feed shard changed: +{len(added)} -{len(removed)} instruments.")
+                    await source.subscribe(sorted(added), "sub")
+                    await source.subscribe(sorted(removed), "unsub")
+                    self.keys, wanted = keys, set(keys)
+
+    def _fold(self):
+        if self._batches:
+            batches, self._batches, self._batched_ticks = self._batches, [], 0
+            self.aggregator.add(TickBatch.concat(batches))
+
+    async def _flush_loop(self):
+        # a full-speed replay moves its clock much faster than the wall clock
+        interval = 0.05 if isinstance(self.source, FileTickSource) else MARKET_FEED_FLUSH_INTERVAL
+        while self._streaming:
+            await asyncio.sleep(interval)
+            self._fold()
+            self.aggregator.close_due(self.source.clock())
+            await self._flush()
+            if self._should_stop() and self._consumer is not None and not self._consumer.done():
+                self._consumer.cancel()
+
+    async def _flush(self):
+        frame = self.aggregator.drain()
+        if self._pending is not None:
+            frame = pd.concat([self._pending, frame], ignore_index=True).tail(MAX_PENDING_ROWS)
+            self._pending = None
+        if frame.empty:
+            return
+        try:
+            written = await asyncio.to_thread(self.write, frame)
+        except Exception as e:
+            self.flush_failures += 1
+            self._pending = frame
+            logger.error(f"Market feed flush of {len(frame)} bars failed, retrying next flush: {e}")
+            return
+        self.bars_written += written or 0
+
+        base = frame[frame["timeframe"] == "15m"]
+        if base.empty:
+            return
+        now = time.time()
+        for bar_start in base["timestamp"].unique():
+            CYCLE_LAG_SECONDS.observe(now - (pd.Timestamp(bar_start).timestamp() + TIMEFRAME_SECONDS["15m"]), job="stream")
+        # derived timeframes and indicators follow every 15m close, as after an intraday cycle
+        if self.after_bar_close is not None:
+            await asyncio.to_thread(self.after_bar_close, sorted(base["instrument_key"].unique()))
+
+
+market_feed = MarketFeed()
+
+
+def main():
+    import argparse
+    from app.logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="Replay recorded market-feed messages through the tick aggregator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay = commands.add_parser("replay", help="aggregate a recorded message file into bars")
+    replay.add_argument("file")
+    replay.add_argument("--speed", type=float, default=0, help="pace at this multiple of the recorded rate, 0 = flat out")
+    replay.add_argument("--dry-run", action="store_true", help="print the bars instead of writing them")
+    args = parser.parse_args()
+
+    setup_logging()
+    feed = MarketFeed()
+    bars = []
+
+    def collect(frame):
+        bars.append(frame)
+        return len(frame)
+
+    started = time.monotonic()
+    source = FileTickSource(args.file, args.speed)
+    if args.dry_run:
+        asyncio.run(feed.run(source, write=collect, after_bar_close=None, keys=source.instrument_keys()))
+    else:
+        asyncio.run(feed.run(source))
+    print(f"replayed {feed.messages} messages in {time.monotonic() - started:.1f}s: {feed.status()}")
+    if bars:
+        frame = pd.concat(bars, ignore_index=True)
+        print(frame.groupby("timeframe").size().to_string())
+
+
+if __name__ == "__main__":
+    main()
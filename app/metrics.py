@@ -0,0 +1,243 @@
+# app/metrics.py - Ingestion metrics rendered in the Prometheus text format
+#
+# A small in-process registry instead of a client library: counters, gauges and histograms
+# keyed by label values, plus collectors that read pool and controller state at scrape time.
+# Each process exports its own numbers; python -m app.worker serves them on WORKER_METRICS_PORT.
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import threading
+import bisect
+import time
+import os
+
+load_dotenv()
+# Last duration of every stage per instrument as gauges: ~5 series per instrument and job
+METRICS_PER_INSTRUMENT = os.getenv("METRICS_PER_INSTRUMENT", "true").lower() == "true"
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CYCLE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0, 180.0, 300.0, 600.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def values(self) -> dict:
+        """Current value per label tuple (histograms: [bucket counts, sum, count])."""
+        with self._lock:
+            return dict(self._values)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non-cumulative) counts, running sum, total count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> list:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+REGISTRY = []
+
+STAGE_SECONDS = Histogram(
+    "ingest_stage_seconds", "Time spent in one ingestion stage (fetch, parse, db_acquire, write, commit)",
+    ("job", "stage"),
+)
+INSTRUMENT_STAGE_SECONDS = Gauge(
+    "ingest_instrument_stage_seconds", "Duration of the latest run of a stage for one instrument",
+    ("job", "stage", "instrument_key"),
+)
+CYCLE_SECONDS = Histogram("ingest_cycle_seconds", "Wall time of a whole job run", ("job",), CYCLE_BUCKETS)
+CYCLE_LAG_SECONDS = Histogram(
+    "ingest_cycle_lag_seconds", "Time from the bar close to the end of the run that ingested it", ("job",), CYCLE_BUCKETS,
+)
+CYCLES = Counter("ingest_cycles_total", "Job runs by outcome", ("job", "outcome"))
+CANDLES_WRITTEN = Counter("ingest_candles_written_total", "Candle rows handed to the database", ("job",))
+UPSTOX_RETRIES = Counter("upstox_retries_total", "Upstox requests retried after a throttle or server error", ("endpoint", "status"))
+# Request latency alone; the per-instrument fetch stage also includes waiting on the rate gates
+UPSTOX_REQUEST_SECONDS = Histogram("upstox_request_seconds", "Latency of single Upstox requests", ("endpoint",))
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_checkout_wait_seconds", "Time to check a connection out of the sync_engine pool")
+MARKET_FEED_TICKS = Counter("market_feed_ticks_total", "Ticks decoded from the market feed")
+MARKET_FEED_RECONNECTS = Counter("market_feed_reconnects_total", "Market feed connections lost or refused")
+MARKET_FEED_CONNECTED = Gauge("market_feed_connected", "1 while the market feed is delivering messages")
+
+
+def observe_stage(job: str, stage: str, seconds: float, instrument_key: str = None):
+    STAGE_SECONDS.observe(seconds, job=job, stage=stage)
+    if instrument_key is not None and METRICS_PER_INSTRUMENT:
+        INSTRUMENT_STAGE_SECONDS.set(seconds, job=job, stage=stage, instrument_key=instrument_key)
+
+
+@contextmanager
+def timed(job: str, stage: str, instrument_key: str = None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(job, stage, time.perf_counter() - started, instrument_key)
+
+
+def observe_cycle(job: str, seconds: float, bar_close: float = None, failed: bool = False):
+    """Record a finished run; `bar_close` (epoch seconds) is the close of the bar the run ingested."""
+    CYCLE_SECONDS.observe(seconds, job=job)
+    CYCLES.inc(job=job, outcome="failed" if failed else "ok")
+    if bar_close is not None:
+        CYCLE_LAG_SECONDS.observe(time.time() - bar_close, job=job)
+
+
+# --- scrape-time collectors ---
+
+def _gauge_block(name: str, documentation: str, samples: list, kind: str = "gauge") -> list:
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{labels} {_format_value(value)}" for labels, value in samples)
+    return lines
+
+
+def _sql_pool_lines() -> list:
+    from app.db import sync_engine
+
+    pool = sync_engine.pool
+    if not hasattr(pool, "checkedout"):
+        return []
+    return (
+        _gauge_block("db_pool_size", "Configured size of the sync_engine pool", [("", pool.size())])
+        + _gauge_block("db_pool_checked_out", "sync_engine connections currently in use", [("", pool.checkedout())])
+        + _gauge_block("db_pool_overflow", "sync_engine connections opened beyond the pool size", [("", max(pool.overflow(), 0))])
+    )
+
+
+def _urllib3_lines() -> list:
+    from app import upstox_api
+
+    api = upstox_api._api_instance
+    if api is None:
+        return []
+    manager = api.api_client.rest_client.pool_manager
+    pools = [manager.pools[key] for key in list(manager.pools.keys())]
+    return (
+        _gauge_block("upstox_http_pools", "urllib3 connection pools held by the SDK client", [("", len(pools))])
+        + _gauge_block("upstox_http_idle_connections", "Idle connections parked in the urllib3 pools",
+                       [("", sum(p.pool.qsize() for p in pools if p.pool is not None))])
+        + _gauge_block("upstox_http_connections_opened_total", "Connections the urllib3 pools have opened",
+                       [("", sum(p.num_connections for p in pools))], kind="counter")
+        + _gauge_block("upstox_http_requests_total", "Requests sent through the urllib3 pools",
+                       [("", sum(p.num_requests for p in pools))], kind="counter")
+    )
+
+
+def _controller_lines() -> list:
+    from app.concurrency import controllers
+
+    stats = {name: controller.stats() for name, controller in controllers.items()}
+
+    def label(name: str) -> str:
+        return f'{{endpoint="{name}"}}'
+
+    return (
+        _gauge_block("upstox_concurrency_window", "Current adaptive concurrency window",
+                     [(label(n), s["window"]) for n, s in stats.items()])
+        + _gauge_block("upstox_in_flight", "Upstox requests in flight", [(label(n), s["in_flight"]) for n, s in stats.items()])
+        + _gauge_block("upstox_requests_total", "Upstox requests completed",
+                       [(label(n), s["requests"]) for n, s in stats.items()], kind="counter")
+        + _gauge_block("upstox_throttles_total", "Upstox 429 responses",
+                       [(label(n), s["throttles"]) for n, s in stats.items()], kind="counter")
+        + _gauge_block("upstox_server_errors_total", "Upstox 5xx responses and connection failures",
+                       [(label(n), s["errors"]) for n, s in stats.items()], kind="counter")
+    )
+
+
+COLLECTORS = [_sql_pool_lines, _urllib3_lines, _controller_lines]
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.header())
+        lines.extend(metric.samples())
+    for collector in COLLECTORS:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            lines.append(f"# collector {collector.__name__} failed: {_escape(e)}")
+    return "\n".join(lines) + "\n"
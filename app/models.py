@@ -1,8 +1,10 @@
 # app/models.py - Database models
 
 from sqlalchemy import (
-    Column, Integer, String, Numeric, BigInteger, DateTime, ForeignKey, UniqueConstraint, Index, desc
+    Column, Integer, SmallInteger, String, Numeric, Float, BigInteger, Date, DateTime, Boolean, ForeignKey,
+    UniqueConstraint, PrimaryKeyConstraint, Index, desc
 )
+from sqlalchemy.sql import true
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -14,6 +16,10 @@ class Instrument(Base):
     trading_symbol = Column(String, nullable=True)
     company_name = Column(String, nullable=False)
     industry = Column(String, nullable=False)
+    segment = Column(String, nullable=True)          # e.g. "NSE_EQ", "NSE_FO", "BSE_EQ"
+    instrument_type = Column(String, nullable=True)  # e.g. "EQ", "FUT", "CE"
+    # Only active instruments are fetched by the candle jobs
+    active = Column(Boolean, nullable=False, default=True, server_default=true())
 
     # Relationship to candles
     candles = relationship("Candle", back_populates="instrument")
@@ -42,3 +48,82 @@ class Candle(Base):
             "instrument_key", "timeframe", desc("timestamp")
         ),
     )
+
+
+# --- Compact candle layout (CANDLE_SCHEMA=compact) ---
+
+# Timeframes are stored as their length in minutes
+TIMEFRAME_CODES = {"1m": 1, "15m": 15, "30m": 30, "1h": 60, "1d": 1440}
+
+class InstrumentId(Base):
+    __tablename__ = "instrument_ids"
+    id = Column(SmallInteger, primary_key=True, autoincrement=True)
+    instrument_key = Column(String, ForeignKey("instruments.instrument_key"), nullable=False, unique=True)
+
+
+class CompactCandle(Base):
+    __tablename__ = "candles_compact"
+    # 8-byte columns first so the smallints don't cause alignment padding
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    open = Column(Float(precision=53), nullable=False)
+    high = Column(Float(precision=53), nullable=False)
+    low = Column(Float(precision=53), nullable=False)
+    close = Column(Float(precision=53), nullable=False)
+    volume = Column(BigInteger, nullable=False)
+    oi = Column(BigInteger, nullable=False, default=0)
+    instrument_id = Column(SmallInteger, ForeignKey("instrument_ids.id"), nullable=False)
+    timeframe = Column(SmallInteger, nullable=False)
+
+    # The natural key is the only index; it also serves "latest N bars" scans backwards
+    __table_args__ = (
+        PrimaryKeyConstraint("instrument_id", "timeframe", "timestamp", name="candles_compact_pkey"),
+    )
+
+
+# --- Multi-year backfill (python -m app.backfill) ---
+
+class ArchiveCandle(Base):
+    # Never trimmed, unlike `candles`, which the jobs keep at the latest 100 bars
+    __tablename__ = "candles_archive"
+    instrument_key = Column(String, nullable=False)
+    timeframe = Column(String, nullable=False)
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    open = Column(Float(precision=53), nullable=False)
+    high = Column(Float(precision=53), nullable=False)
+    low = Column(Float(precision=53), nullable=False)
+    close = Column(Float(precision=53), nullable=False)
+    volume = Column(BigInteger, nullable=False)
+    oi = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("instrument_key", "timeframe", "timestamp", name="candles_archive_pkey"),
+    )
+
+
+class BackfillProgress(Base):
+    # One row per (instrument, timeframe, request window); "done" is set in the same transaction as the COPY
+    __tablename__ = "backfill_progress"
+    instrument_key = Column(String, nullable=False)
+    timeframe = Column(String, nullable=False)
+    window_start = Column(Date, nullable=False)
+    window_end = Column(Date, nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending | done | failed
+    rows = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("instrument_key", "timeframe", "window_start", name="backfill_progress_pkey"),
+        Index("idx_backfill_progress_status", "status"),
+    )
+
+
+class IngestWorker(Base):
+    # Lease row per ingestion process; a worker whose heartbeat is older than the lease drops out of the hash ring
+    __tablename__ = "ingest_workers"
+    worker_id = Column(String, primary_key=True)
+    hostname = Column(String, nullable=False)
+    pid = Column(Integer, nullable=False)
+    started_at = Column(DateTime(timezone=True), nullable=False)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=False)
@@ -0,0 +1,74 @@
+# app/rate_limiter.py - Token-bucket rate limiting for Upstox API calls
+from dotenv import load_dotenv
+import threading
+import asyncio
+import time
+import os
+
+load_dotenv()
+# Upstox standard API limits: 50 req/sec, 500 req/min, 2000 req/30 min
+UPSTOX_RATE_PER_SECOND = int(os.getenv("UPSTOX_RATE_PER_SECOND", "50"))
+UPSTOX_RATE_PER_MINUTE = int(os.getenv("UPSTOX_RATE_PER_MINUTE", "500"))
+UPSTOX_RATE_PER_30_MINUTES = int(os.getenv("UPSTOX_RATE_PER_30_MINUTES", "2000"))
+
+
+class TokenBucket:
+    def __init__(self, limit: int, period: float):
+        self.capacity = float(limit)
+        self.rate = limit / period  # tokens refilled per second
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Take a token, going into debt if there is none; returns the seconds until it is covered."""
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """Reserves a token from every bucket, then waits until the slowest one has covered it.
+
+    Several buckets model Upstox's layered per-second / per-minute / per-30-minute caps.
+    Reservations are made under a thread lock, so one limiter serves the threaded SDK path
+    and every asyncio loop in the process (intraday, historical, gap fill, backfill) at once,
+    in FIFO order.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    @classmethod
+    def from_env(cls):
+        return cls([
+            TokenBucket(UPSTOX_RATE_PER_SECOND, 1),
+            TokenBucket(UPSTOX_RATE_PER_MINUTE, 60),
+            TokenBucket(UPSTOX_RATE_PER_30_MINUTES, 30 * 60),
+        ])
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(bucket.reserve(now) for bucket in self.buckets)
+            self.waited_seconds += wait
+            return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+# Upstox's caps are per account, so every caller in the process shares these buckets
+upstox_rate_limiter = RateLimiter.from_env()
@@ -0,0 +1,154 @@
+# app/resample.py - Derive 30m / 1h / 1d candles from stored 15m bars, aligned to NSE sessions
+from app.db import sync_engine
+from app.db_crud import bulk_upsert_candles, trim_candles, CANDLE_RETENTION_BARS
+from app.candle_store import candle_store, CANDLE_STORE_ENABLED, VALUE_FIELDS
+from app.compact_candles import candle_read_source
+from dotenv import load_dotenv
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytz
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+IST = pytz.timezone("Asia/Kolkata")
+IST_OFFSET = 5 * 3600 + 30 * 60
+SESSION_OPEN = 9 * 3600 + 15 * 60  # 09:15 IST, seconds after midnight
+BASE_TIMEFRAME = "15m"
+
+# Bucket width in seconds; buckets start at the session open, daily bars at IST midnight
+TIMEFRAME_SECONDS = {"30m": 30 * 60, "1h": 60 * 60, "1d": 24 * 60 * 60}
+RESAMPLE_TIMEFRAMES = [tf for tf in os.getenv("RESAMPLE_TIMEFRAMES", "30m,1h,1d").split(",") if tf in TIMEFRAME_SECONDS]
+
+
+def bucket_starts(timestamps: np.ndarray, timeframe: str) -> np.ndarray:
+    """Epoch (UTC) start of the bucket each 15m bar falls into."""
+    local = timestamps + IST_OFFSET
+    midnight = local - local % 86400
+    if timeframe == "1d":
+        return midnight - IST_OFFSET
+    width = TIMEFRAME_SECONDS[timeframe]
+    since_open = local - midnight - SESSION_OPEN
+    return midnight + SESSION_OPEN + (since_open // width) * width - IST_OFFSET
+
+
+def resample(keys: np.ndarray, timestamps: np.ndarray, values: np.ndarray, timeframe: str, only_recent: bool = False) -> pd.DataFrame:
+    """Group-reduce 15m bars into `timeframe` buckets for every instrument at once.
+
+    Inputs must be sorted by (instrument, timestamp); `values` is (6, n) in VALUE_FIELDS order.
+    With `only_recent`, each instrument keeps just the buckets holding its last two 15m bars:
+    the one still forming and the one its previous bar may have just completed.
+    """
+    if not len(timestamps):
+        return pd.DataFrame()
+
+    buckets = bucket_starts(timestamps, timeframe)
+    new_key = np.r_[True, keys[1:] != keys[:-1]]
+    starts = np.flatnonzero(new_key | np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(timestamps)] - 1
+
+    opens, highs, lows, closes, volumes, ois = values
+    frame = pd.DataFrame({
+        "instrument_key": keys[starts],
+        "timeframe": timeframe,
+        "timestamp": pd.to_datetime(buckets[starts], unit="s", utc=True),
+        "open": opens[starts],
+        "high": np.maximum.reduceat(highs, starts),
+        "low": np.minimum.reduceat(lows, starts),
+        "close": closes[ends],
+        "volume": np.add.reduceat(volumes, starts).astype(np.int64),
+        "oi": ois[ends].astype(np.int64),
+    })
+
+    # A bucket whose opening 15m bar is missing (trimmed away or never fetched) would get a
+    # wrong open, so it is left alone rather than overwriting a good row
+    first_slot = buckets[starts] + (SESSION_OPEN if timeframe == "1d" else 0)
+    complete = timestamps[starts] == first_slot
+
+    if only_recent:
+        key_starts = np.flatnonzero(new_key)
+        key_ends = np.r_[key_starts[1:], len(timestamps)] - 1
+        # bucket of each instrument's second-to-last bar (or its only bar)
+        threshold = buckets[np.maximum(key_ends - 1, key_starts)]
+        per_row_threshold = np.repeat(threshold, key_ends - key_starts + 1)
+        complete &= buckets[starts] >= per_row_threshold[starts]
+    return frame[complete]
+
+
+def load_base_bars(since: int = None, instrument_keys: list = None):
+    """15m bars of every instrument (or just `instrument_keys`), sorted by (instrument, timestamp), from memory or the DB."""
+    if CANDLE_STORE_ENABLED and candle_store.keys(BASE_TIMEFRAME):
+        parts = []
+        wanted = None if instrument_keys is None else set(instrument_keys)
+        for instrument_key, _ in sorted(candle_store.keys(BASE_TIMEFRAME)):
+            if wanted is not None and instrument_key not in wanted:
+                continue
+            view = candle_store.get(instrument_key, BASE_TIMEFRAME)
+            ts = view["timestamp"]
+            first = 0 if since is None else int(np.searchsorted(ts, since))
+            if first < len(ts):
+                parts.append((instrument_key, ts[first:], np.vstack([view[f][first:] for f in VALUE_FIELDS])))
+        if not parts:
+            return np.empty(0, object), np.empty(0, np.int64), np.empty((6, 0))
+        keys = np.repeat([p[0] for p in parts], [len(p[1]) for p in parts])
+        return keys, np.concatenate([p[1] for p in parts]), np.hstack([p[2] for p in parts])
+
+    conn = sync_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT instrument_key, extract(epoch FROM timestamp)::bigint,
+                   open::float8, high::float8, low::float8, close::float8, volume::float8, COALESCE(oi, 0)::float8
+            FROM {candle_read_source()}
+            WHERE timeframe = %(timeframe)s AND timestamp >= to_timestamp(%(since)s)
+              AND (%(keys)s::varchar[] IS NULL OR instrument_key = ANY(%(keys)s::varchar[]))
+            ORDER BY instrument_key, timestamp
+        """, {"timeframe": BASE_TIMEFRAME, "since": since or 0,
+              "keys": None if instrument_keys is None else list(instrument_keys)})
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return np.empty(0, object), np.empty(0, np.int64), np.empty((6, 0))
+    frame = pd.DataFrame(rows, columns=["instrument_key", "timestamp", *VALUE_FIELDS])
+    return (
+        frame["instrument_key"].to_numpy(),
+        frame["timestamp"].to_numpy(np.int64),
+        frame[list(VALUE_FIELDS)].to_numpy(np.float64).T,
+    )
+
+
+def update_resampled_candles(instrument_keys: list = None):
+    """Incremental pass after an intraday cycle: rewrite only the buckets still moving.
+
+    A sharded worker passes its own instruments; the rest of its store is not kept fresh.
+    """
+    try:
+        now = int(datetime.now(IST).timestamp())
+        # today's daily bucket is the widest one still open, so today's bars cover every timeframe
+        since = int(bucket_starts(np.array([now]), "1d")[0])
+        keys, timestamps, values = load_base_bars(since, instrument_keys)
+        frames = [resample(keys, timestamps, values, tf, only_recent=True) for tf in RESAMPLE_TIMEFRAMES]
+        frames = [f for f in frames if not f.empty]
+        if frames:
+            written = bulk_upsert_candles(pd.concat(frames, ignore_index=True), job="resample")
+            logger.info(f"Resampled {written} open {', '.join(RESAMPLE_TIMEFRAMES)} buckets from {len(timestamps)} 15m bars.")
+    except Exception as e:
+        logger.error(f"Error updating resampled candles: {e}")
+
+
+def rebuild_resampled_candles(instrument_keys: list = None):
+    """Full pass over every retained 15m bar, e.g. after the historical job."""
+    try:
+        keys, timestamps, values = load_base_bars(instrument_keys=instrument_keys)
+        frames = [resample(keys, timestamps, values, tf) for tf in RESAMPLE_TIMEFRAMES]
+        frames = [f for f in frames if not f.empty]
+        if frames:
+            written = bulk_upsert_candles(pd.concat(frames, ignore_index=True), job="resample")
+            trim_candles(RESAMPLE_TIMEFRAMES, CANDLE_RETENTION_BARS)
+            logger.info(f"Rebuilt {written} {', '.join(RESAMPLE_TIMEFRAMES)} candles from {len(timestamps)} 15m bars.")
+    except Exception as e:
+        logger.error(f"Error rebuilding resampled candles: {e}")
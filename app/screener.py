@@ -0,0 +1,392 @@
+# app/screener.py - Cross-sectional screens over every instrument's latest bar
+#
+# The universe is loaded once per bar into flat columns, one row per active instrument:
+# the latest bar's fields, a few derived from the previous bars, and the registry's
+# industry/segment. Filter and sort expressions are parsed with `ast` into a small
+# whitelist (fields, constants, arithmetic, comparisons, and/or/not, `in [...]`, a few
+# functions) and evaluated as numpy operations over whole columns, so a screen is a
+# handful of array passes no matter how many instruments there are.
+from app.candle_store import candle_store, VALUE_FIELDS, CANDLE_STORE_ENABLED
+from app.compact_candles import candle_read_source
+from app.instrument_registry import instrument_registry
+from app.db import sync_engine
+from dotenv import load_dotenv
+from collections import OrderedDict
+from datetime import datetime, timezone
+import numpy as np
+import threading
+import operator
+import time
+import ast
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Bars before the latest one averaged for rel_volume
+SCREENER_VOLUME_BARS = int(os.getenv("SCREENER_VOLUME_BARS", "20"))
+# Without the in-memory store a DB-loaded universe is reused for this many seconds at most
+SCREENER_DB_CACHE_SECONDS = float(os.getenv("SCREENER_DB_CACHE_SECONDS", "30"))
+# Screen results kept per bar (distinct filter/sort/grouping combinations)
+SCREENER_RESULT_CACHE_SIZE = int(os.getenv("SCREENER_RESULT_CACHE_SIZE", "256"))
+
+MAX_EXPRESSION_LENGTH = 500
+STRING_FIELDS = ("instrument_key", "trading_symbol", "industry", "segment")
+GROUP_FIELDS = ("industry", "segment")
+NUMERIC_FIELDS = (
+    "timestamp", *VALUE_FIELDS, "prev_close", "change", "pct_change", "gap_pct", "body_pct",
+    "range", "range_pct", "avg_volume", "rel_volume",
+)
+DEFAULT_FIELDS = ["close", "pct_change", "volume", "rel_volume", "range_pct"]
+
+_COMPARE = {
+    ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+}
+_BINARY = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+}
+_FUNCTIONS = {"abs": np.abs, "min": np.fmin, "max": np.fmax, "log": np.log, "sqrt": np.sqrt, "isnull": np.isnan}
+
+
+class ScreenError(ValueError):
+    """A filter, sort or grouping the screener cannot evaluate; reported to the client as a 400."""
+
+
+def _compile(node: ast.AST, fields: tuple):
+    """Turn a whitelisted expression node into a function of the column dict."""
+    if isinstance(node, ast.Expression):
+        return _compile(node.body, fields)
+    if isinstance(node, ast.Name):
+        if node.id not in fields:
+            raise ScreenError(f"unknown field '{node.id}'")
+        name = node.id
+        return lambda cols: cols[name]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str, bool)):
+        # numbers become float64 so arithmetic on constants alone (9**9**9) overflows to inf
+        # instead of running unbounded Python integer math
+        value = node.value if isinstance(node.value, str) else np.float64(node.value)
+        return lambda cols: value
+    if isinstance(node, ast.BoolOp):
+        parts = [_compile(v, fields) for v in node.values]
+        reduce = np.logical_and.reduce if isinstance(node.op, ast.And) else np.logical_or.reduce
+        return lambda cols: reduce([np.asarray(p(cols), bool) for p in parts])
+    if isinstance(node, ast.UnaryOp):
+        operand = _compile(node.operand, fields)
+        if isinstance(node.op, ast.Not):
+            return lambda cols: np.logical_not(operand(cols))
+        if isinstance(node.op, ast.USub):
+            return lambda cols: -operand(cols)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+        op, left, right = _BINARY[type(node.op)], _compile(node.left, fields), _compile(node.right, fields)
+        return lambda cols: op(left(cols), right(cols))
+    if isinstance(node, ast.Compare):
+        left = _compile(node.left, fields)
+        steps = []
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if not isinstance(comparator, (ast.List, ast.Tuple)) or not all(
+                        isinstance(e, ast.Constant) for e in comparator.elts):
+                    raise ScreenError("'in' takes a list of constants")
+                values = [e.value for e in comparator.elts]
+                invert = isinstance(op, ast.NotIn)
+                steps.append((lambda a, b, values=values, invert=invert: np.isin(a, values, invert=invert), None))
+            elif type(op) in _COMPARE:
+                steps.append((_COMPARE[type(op)], _compile(comparator, fields)))
+            else:
+                break
+        else:
+            def compare(cols):
+                # chained comparisons (1 < x < 2) are pairwise and-ed, as in Python
+                a, result = left(cols), True
+                for op, right in steps:
+                    b = right(cols) if right is not None else None
+                    result = np.logical_and(result, op(a, b))
+                    a = b
+                return result
+            return compare
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS
+            and not node.keywords):
+        function, args = _FUNCTIONS[node.func.id], [_compile(a, fields) for a in node.args]
+        return lambda cols: function(*(a(cols) for a in args))
+    raise ScreenError(f"unsupported expression '{ast.unparse(node)}'")
+
+
+def compile_expression(expression: str):
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ScreenError(f"expression longer than {MAX_EXPRESSION_LENGTH} characters")
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ScreenError(f"invalid expression '{expression}': {e.msg}")
+    return _compile(tree, NUMERIC_FIELDS + STRING_FIELDS)
+
+
+def parse_sort(sort: str) -> list:
+    """'-rel_volume, trading_symbol' -> [(function, descending), ...]"""
+    terms = []
+    for term in (t.strip() for t in sort.split(",")):
+        if term:
+            descending = term.startswith("-")
+            terms.append((compile_expression(term[1:] if descending else term), descending))
+    return terms
+
+
+def _sort_key(values: np.ndarray, descending: bool) -> np.ndarray:
+    if values.dtype == object:
+        values = np.unique(values.astype(str), return_inverse=True)[1].reshape(-1).astype(np.float64)
+    else:
+        values = values.astype(np.float64)
+    if descending:
+        values = -values
+    # missing values sort last either way
+    return np.where(np.isnan(values), np.inf, values)
+
+
+class Universe:
+    """Column arrays for every active instrument with a bar in `timeframe`."""
+
+    def __init__(self, timeframe: str, keys: list, timestamps: np.ndarray, values: np.ndarray, by_key: dict):
+        """`timestamps` is (n, window), `values` (fields, n, window), oldest first and right-aligned, NaN-padded.
+
+        `by_key` comes from the same registry snapshot the keys were filtered against, so an
+        instrument sync in between cannot leave a key without its record.
+        """
+        self.timeframe = timeframe
+        self.size = len(keys)
+        records = [by_key[key] for key in keys]
+        cols = {
+            "instrument_key": np.array(keys, dtype=object),
+            "trading_symbol": np.array([r.trading_symbol for r in records], dtype=object),
+            "industry": np.array([r.industry for r in records], dtype=object),
+            "segment": np.array([r.segment for r in records], dtype=object),
+            "timestamp": timestamps[:, -1] if self.size else np.empty(0, np.int64),
+        }
+        latest = dict(zip(VALUE_FIELDS, values[:, :, -1]))
+        cols.update(latest)
+        prev_close = values[VALUE_FIELDS.index("close"), :, -2] if values.shape[2] > 1 else np.full(self.size, np.nan)
+        history = values[VALUE_FIELDS.index("volume"), :, -1 - SCREENER_VOLUME_BARS:-1]
+        counted = np.count_nonzero(~np.isnan(history), axis=1)
+        with np.errstate(all="ignore"):
+            derived = {
+                "prev_close": prev_close,
+                "change": latest["close"] - prev_close,
+                "pct_change": (latest["close"] / prev_close - 1) * 100,
+                "gap_pct": (latest["open"] / prev_close - 1) * 100,
+                "body_pct": (latest["close"] / latest["open"] - 1) * 100,
+                "range": latest["high"] - latest["low"],
+                "range_pct": (latest["high"] - latest["low"]) / latest["open"] * 100,
+                "avg_volume": np.nansum(history, axis=1) / counted,
+            }
+            derived["rel_volume"] = latest["volume"] / derived["avg_volume"]
+        # a zero previous close or open gives inf; screen it as missing
+        cols.update({name: np.where(np.isfinite(arr), arr, np.nan) for name, arr in derived.items()})
+        self.cols = cols
+        self.latest_timestamp = int(cols["timestamp"].max()) if self.size else None
+
+
+def _universe_from_store(timeframe: str, window: int, active: set):
+    keys = sorted(key for key, _ in candle_store.keys(timeframe) if key in active)
+    timestamps = np.zeros((len(keys), window), np.int64)
+    values = np.full((len(VALUE_FIELDS), len(keys), window), np.nan)
+    for i, key in enumerate(keys):
+        view = candle_store.get(key, timeframe, window)
+        n = len(view["timestamp"])
+        timestamps[i, window - n:] = view["timestamp"]
+        for j, field in enumerate(VALUE_FIELDS):
+            values[j, i, window - n:] = view[field]
+    return keys, timestamps, values
+
+
+def _universe_from_db(timeframe: str, window: int, active: set):
+    # one round trip: the latest `window` bars of every instrument off the (instrument_key,
+    # timeframe, timestamp) index, newest first within each instrument
+    conn = sync_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT i.instrument_key, extract(epoch FROM b.timestamp)::bigint,
+                   b.open::float8, b.high::float8, b.low::float8, b.close::float8,
+                   b.volume::float8, COALESCE(b.oi, 0)::float8
+            FROM instruments AS i
+            CROSS JOIN LATERAL (
+                SELECT timestamp, open, high, low, close, volume, oi
+                FROM {candle_read_source()} AS c
+                WHERE c.instrument_key = i.instrument_key AND c.timeframe = %(timeframe)s
+                ORDER BY c.timestamp DESC
+                LIMIT %(window)s
+            ) AS b
+            WHERE i.active
+            ORDER BY i.instrument_key, b.timestamp DESC
+        """, {"timeframe": timeframe, "window": window})
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    rows = [row for row in rows if row[0] in active]
+    if not rows:
+        return [], np.zeros((0, window), np.int64), np.full((len(VALUE_FIELDS), 0, window), np.nan)
+    key_per_row = np.array([row[0] for row in rows], dtype=object)
+    starts = np.r_[True, key_per_row[1:] != key_per_row[:-1]]
+    row_index = np.cumsum(starts) - 1
+    # newest first, so the n-th row of an instrument goes n columns left of the last one
+    col_index = window - 1 - (np.arange(len(rows)) - np.flatnonzero(starts)[row_index])
+    data = np.array([row[1:] for row in rows], dtype=np.float64)
+    keys = key_per_row[starts].tolist()
+    timestamps = np.zeros((len(keys), window), np.int64)
+    values = np.full((len(VALUE_FIELDS), len(keys), window), np.nan)
+    timestamps[row_index, col_index] = data[:, 0].astype(np.int64)
+    values[:, row_index, col_index] = data[:, 1:].T
+    return keys, timestamps, values
+
+
+class Screener:
+    def __init__(self):
+        self._universes = {}
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.last_compute_ms = 0.0
+
+    def _token(self):
+        # what a cached universe is valid for: a store write or a registry reload replaces it
+        if CANDLE_STORE_ENABLED and candle_store.keys():
+            return ("store", candle_store.version, instrument_registry.version)
+        return ("db", int(time.time() // SCREENER_DB_CACHE_SECONDS), instrument_registry.version)
+
+    def universe(self, timeframe: str) -> Universe:
+        token = self._token()
+        cached = self._universes.get(timeframe)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+        snapshot = instrument_registry.snapshot()
+        active = {r.instrument_key for r in snapshot.active}
+        window = SCREENER_VOLUME_BARS + 1
+        if token[0] == "store":
+            keys, timestamps, values = _universe_from_store(timeframe, window, active)
+        else:
+            keys, timestamps, values = _universe_from_db(timeframe, window, active)
+        universe = Universe(timeframe, keys, timestamps, values, snapshot.by_key)
+        self._universes[timeframe] = (token, universe)
+        return universe
+
+    def screen(self, timeframe: str = "15m", filter: str = None, sort: str = "-pct_change", limit: int = 50,
+               fields: list = None, group_by: str = None, industries: list = None, current_only: bool = True) -> dict:
+        """Evaluate one screen over the whole universe of `timeframe`.
+
+        `filter` and each comma-separated `sort` term are expressions over the screener's
+        fields; a leading '-' sorts descending. With `group_by` the rows are split by industry
+        or segment, with `limit` applying per group. `current_only` drops instruments whose
+        latest bar is older than the universe's newest one.
+        """
+        if group_by is not None and group_by not in GROUP_FIELDS:
+            raise ScreenError(f"group_by must be one of {', '.join(GROUP_FIELDS)}")
+        fields = list(fields or DEFAULT_FIELDS)
+        unknown = [f for f in fields if f not in NUMERIC_FIELDS + STRING_FIELDS]
+        if unknown:
+            raise ScreenError(f"unknown field(s) {', '.join(unknown)}")
+        predicate = compile_expression(filter) if filter else None
+        sort_terms = parse_sort(sort or "")
+
+        started = time.perf_counter()
+        universe = self.universe(timeframe)
+        cache_key = (timeframe, self._universes[timeframe][0], filter, sort, limit, tuple(fields), group_by,
+                     tuple(industries or ()), current_only)
+        with self._lock:
+            cached = self._results.get(cache_key)
+            if cached is not None:
+                self._results.move_to_end(cache_key)
+        if cached is not None:
+            return {**cached, "cached": True, "computed_ms": round((time.perf_counter() - started) * 1000, 3)}
+
+        cols = universe.cols
+        mask = np.ones(universe.size, bool)
+        if current_only and universe.size:
+            mask &= cols["timestamp"] == universe.latest_timestamp
+        if industries:
+            mask &= np.isin(cols["industry"], list(industries))
+        if predicate is not None:
+            try:
+                with np.errstate(all="ignore"):
+                    matched = np.broadcast_to(np.asarray(predicate(cols), bool), mask.shape)
+            except (TypeError, ValueError) as e:
+                raise ScreenError(f"cannot evaluate filter '{filter}': {e}")
+            mask &= matched
+        index = np.flatnonzero(mask)
+
+        if sort_terms and len(index):
+            try:
+                with np.errstate(all="ignore"):
+                    sort_keys = [_sort_key(np.broadcast_to(np.asarray(fn(cols)), mask.shape)[index], desc)
+                                 for fn, desc in sort_terms]
+            except (TypeError, ValueError) as e:
+                raise ScreenError(f"cannot evaluate sort '{sort}': {e}")
+            # lexsort's last key is the primary one
+            index = index[np.lexsort(sort_keys[::-1])]
+
+        result = {
+            "timeframe": timeframe,
+            "timestamp": (datetime.fromtimestamp(universe.latest_timestamp, timezone.utc).isoformat()
+                          if universe.latest_timestamp is not None else None),
+            "universe": universe.size,
+            "matched": len(index),
+        }
+        if group_by is None:
+            result["rows"] = self._rows(cols, index[:limit], fields)
+        else:
+            result["groups"] = self._groups(cols, index, fields, group_by, limit)
+
+        with self._lock:
+            self._results[cache_key] = result
+            while len(self._results) > SCREENER_RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+        self.last_compute_ms = (time.perf_counter() - started) * 1000
+        return {**result, "cached": False, "computed_ms": round(self.last_compute_ms, 3)}
+
+    @staticmethod
+    def _rows(cols: dict, index: np.ndarray, fields: list) -> list:
+        columns = {"instrument_key": cols["instrument_key"][index].tolist(),
+                   "trading_symbol": cols["trading_symbol"][index].tolist(),
+                   "industry": cols["industry"][index].tolist()}
+        for field in fields:
+            if field in columns:
+                continue
+            values = cols[field][index]
+            if field == "timestamp":
+                columns[field] = [datetime.fromtimestamp(ts, timezone.utc).isoformat() for ts in values.tolist()]
+            elif values.dtype == object:
+                columns[field] = values.tolist()
+            else:
+                columns[field] = [None if np.isnan(v) else round(v, 4) for v in values.tolist()]
+        names = list(columns)
+        return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+    def _groups(self, cols: dict, index: np.ndarray, fields: list, group_by: str, limit: int) -> list:
+        labels = np.array(["" if v is None else v for v in cols[group_by][index].tolist()], dtype=object)
+        # a stable sort keeps the screen's order inside each group
+        order = np.argsort(labels, kind="stable")
+        index, labels = index[order], labels[order]
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]]) if len(labels) else np.empty(0, np.int64)
+        ends = np.r_[starts[1:], len(labels)]
+        groups = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            members = index[start:end]
+            change, pct_change = cols["change"][members], cols["pct_change"][members]
+            known = ~np.isnan(pct_change)
+            mean_pct = float(pct_change[known].mean()) if known.any() else None
+            groups.append({
+                group_by: labels[start] or None,
+                "count": end - start,
+                "advancers": int((change > 0).sum()),
+                "decliners": int((change < 0).sum()),
+                "mean_pct_change": None if mean_pct is None else round(mean_pct, 4),
+                "volume": float(np.nansum(cols["volume"][members])),
+                "rows": self._rows(cols, members[:limit], fields),
+            })
+        return groups
+
+
+screener = Screener()
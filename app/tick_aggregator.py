@@ -0,0 +1,270 @@
+# app/tick_aggregator.py - Build OHLCV bars from market-feed ticks in flat per-instrument arrays
+from app.trading_calendar import trading_calendar, TradingCalendar
+from app.candle_decoder import CANDLE_VALUE_FIELDS
+from dotenv import load_dotenv
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import threading
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Bars built from the feed; 1m is kept like any other timeframe (latest CANDLE_RETENTION_BARS)
+STREAM_TIMEFRAMES = [tf for tf in os.getenv("STREAM_TIMEFRAMES", "1m,15m").split(",") if tf.strip()]
+# Seconds a bar stays open after its end for ticks still in flight
+TICK_BAR_CLOSE_GRACE = float(os.getenv("TICK_BAR_CLOSE_GRACE", "2"))
+
+TIMEFRAME_SECONDS = {"1m": 60, "5m": 5 * 60, "15m": 15 * 60, "30m": 30 * 60, "1h": 60 * 60}
+NO_BAR = -1
+
+
+def _changes(values: np.ndarray) -> np.ndarray:
+    # True where a run of equal values starts; np.r_ costs more than the whole fold on small batches
+    mask = np.empty(len(values), dtype=bool)
+    mask[:1] = True
+    np.not_equal(values[1:], values[:-1], out=mask[1:])
+    return mask
+
+
+class TickBatch:
+    """Ticks decoded from one or more feed messages, as parallel arrays."""
+
+    __slots__ = ("keys", "timestamp", "price", "volume", "oi")
+
+    def __init__(self, keys: list, timestamp, price, volume, oi):
+        self.keys = keys                                       # instrument keys
+        self.timestamp = np.asarray(timestamp, np.int64)       # last trade time, epoch seconds
+        self.price = np.asarray(price, np.float64)
+        self.volume = np.asarray(volume, np.float64)           # quantity traded since the previous tick
+        self.oi = np.asarray(oi, np.float64)
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    @staticmethod
+    def concat(batches: list) -> "TickBatch":
+        if len(batches) == 1:
+            return batches[0]
+        return TickBatch(
+            [key for b in batches for key in b.keys],
+            *(np.concatenate([getattr(b, f) for b in batches]) for f in ("timestamp", "price", "volume", "oi")),
+        )
+
+
+class BarAccumulator:
+    """The forming bar of one timeframe for every instrument, slot i holding instrument i.
+
+    Ticks are folded in a whole batch at a time: grouped by (slot, bucket) with the same
+    reduceat passes resample.py uses, merged into the forming bars, and every bar a batch
+    moves past is handed out as closed. Buckets are aligned to the session open.
+    """
+
+    def __init__(self, timeframe: str, capacity: int = 1024):
+        self.timeframe = timeframe
+        self.width = TIMEFRAME_SECONDS[timeframe]
+        self.bucket = np.full(capacity, NO_BAR, np.int64)
+        self.values = np.zeros((len(CANDLE_VALUE_FIELDS), capacity), np.float64)
+        self.ticks = np.zeros(capacity, np.int64)
+        # newest bucket already handed out per slot; ticks for it or anything older are late
+        self.closed_through = np.full(capacity, NO_BAR, np.int64)
+        self.closed = []
+        self.late_ticks = 0
+
+    def grow(self, capacity: int):
+        extra = capacity - len(self.bucket)
+        if extra <= 0:
+            return
+        self.bucket = np.r_[self.bucket, np.full(extra, NO_BAR, np.int64)]
+        self.values = np.hstack([self.values, np.zeros((len(CANDLE_VALUE_FIELDS), extra))])
+        self.ticks = np.r_[self.ticks, np.zeros(extra, np.int64)]
+        self.closed_through = np.r_[self.closed_through, np.full(extra, NO_BAR, np.int64)]
+
+    def _emit(self, slots: np.ndarray, buckets: np.ndarray, values: np.ndarray):
+        if len(slots):
+            self.closed.append((slots, buckets, values))
+            np.maximum.at(self.closed_through, slots, buckets)
+
+    def add(self, slots: np.ndarray, timestamps: np.ndarray, values: np.ndarray, session_open: int):
+        """Fold ticks in; `values` is (3, n): price, traded volume, oi. Input order is arrival order."""
+        buckets = session_open + (timestamps - session_open) // self.width * self.width
+        late = (buckets < self.bucket[slots]) | (buckets <= self.closed_through[slots])
+        if late.any():
+            self.late_ticks += int(late.sum())
+            keep = ~late
+            slots, timestamps, buckets, values = slots[keep], timestamps[keep], buckets[keep], values[:, keep]
+        if not len(slots):
+            return
+
+        # stable, so ticks with the same timestamp keep their arrival order
+        order = np.lexsort((timestamps, slots))
+        slots, buckets = slots[order], buckets[order]
+        price, volume, oi = values[:, order]
+
+        starts = np.flatnonzero(_changes(slots) | _changes(buckets))
+        ends = np.append(starts[1:], len(slots)) - 1
+        g_slot, g_bucket = slots[starts], buckets[starts]
+        g_values = np.vstack([
+            price[starts],
+            np.maximum.reduceat(price, starts),
+            np.minimum.reduceat(price, starts),
+            price[ends],
+            np.add.reduceat(volume, starts),
+            oi[ends],
+        ])
+        g_ticks = np.diff(np.append(starts, len(slots)))
+
+        first = _changes(g_slot)
+        last = np.append(first[1:], True)
+
+        # a slot's first group either continues its forming bar or starts a newer one
+        current = self.bucket[g_slot]
+        merge = first & (g_bucket == current)
+        if merge.any():
+            s = g_slot[merge]
+            g_values[0, merge] = self.values[0, s]
+            g_values[1, merge] = np.maximum(g_values[1, merge], self.values[1, s])
+            g_values[2, merge] = np.minimum(g_values[2, merge], self.values[2, s])
+            g_values[4, merge] += self.values[4, s]
+            g_ticks[merge] += self.ticks[s]
+        rolled = first & ~merge & (current != NO_BAR)
+        if rolled.any():
+            s = g_slot[rolled]
+            self._emit(s, self.bucket[s], self.values[:, s].copy())
+
+        # groups followed by a newer bucket of the same slot closed inside this batch
+        self._emit(g_slot[~last], g_bucket[~last], g_values[:, ~last])
+
+        s = g_slot[last]
+        self.bucket[s] = g_bucket[last]
+        self.values[:, s] = g_values[:, last]
+        self.ticks[s] = g_ticks[last]
+
+    def close_due(self, now: float, session_close: int = None, grace: float = TICK_BAR_CLOSE_GRACE):
+        """Close forming bars whose end (cut at the session close) is at least `grace` seconds past."""
+        ends = self.bucket + self.width
+        if session_close is not None:
+            ends = np.minimum(ends, session_close)
+        due = np.flatnonzero((self.bucket != NO_BAR) & (ends + grace <= now))
+        if len(due):
+            self._emit(due, self.bucket[due], self.values[:, due].copy())
+            self.bucket[due] = NO_BAR
+            self.ticks[due] = 0
+
+    def close_all(self):
+        open_slots = np.flatnonzero(self.bucket != NO_BAR)
+        self._emit(open_slots, self.bucket[open_slots], self.values[:, open_slots].copy())
+        self.bucket[open_slots] = NO_BAR
+        self.ticks[open_slots] = 0
+
+    def reset(self):
+        self.close_all()
+        self.closed_through[:] = NO_BAR
+
+    def drain(self) -> list:
+        closed, self.closed = self.closed, []
+        return closed
+
+
+class TickAggregator:
+    """Per-timeframe accumulators over one slot index, fed with TickBatch objects.
+
+    The session of the newest tick decides bucket alignment; ticks outside it (pre-open,
+    post-close) are dropped, and a new trading day closes whatever the previous one left open.
+    """
+
+    def __init__(self, timeframes: list = STREAM_TIMEFRAMES, calendar: TradingCalendar = trading_calendar):
+        self.calendar = calendar
+        self.accumulators = [BarAccumulator(tf) for tf in timeframes]
+        self.slots = {}
+        self.keys = []
+        self.session_day = None
+        self.session_open = None
+        self.session_close = None
+        self.ticks = 0
+        self.outside_session = 0
+        self._lock = threading.Lock()
+
+    def _slots_for(self, keys: list) -> np.ndarray:
+        slots = np.empty(len(keys), np.int64)
+        for i, key in enumerate(keys):
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = len(self.keys)
+                self.keys.append(key)
+            slots[i] = slot
+        capacity = len(self.accumulators[0].bucket)
+        if len(self.keys) > capacity:
+            for accumulator in self.accumulators:
+                accumulator.grow(max(len(self.keys), 2 * capacity))
+        return slots
+
+    def _start_session(self, at: int):
+        day = datetime.fromtimestamp(at, self.calendar.tz).date()
+        if day == self.session_day:
+            return
+        for accumulator in self.accumulators:
+            accumulator.reset()
+        session = self.calendar.session(day)
+        self.session_day = day
+        self.session_open, self.session_close = (
+            (int(session[0].timestamp()), int(session[1].timestamp())) if session else (None, None)
+        )
+
+    def add(self, batch: TickBatch):
+        if not len(batch):
+            return
+        with self._lock:
+            self._start_session(int(batch.timestamp.max()))
+            self.ticks += len(batch)
+            if self.session_open is None:
+                self.outside_session += len(batch)
+                return
+            inside = (batch.timestamp >= self.session_open) & (batch.timestamp < self.session_close)
+            self.outside_session += int((~inside).sum())
+            if not inside.any():
+                return
+            index = np.flatnonzero(inside)
+            slots = self._slots_for([batch.keys[i] for i in index])
+            values = np.vstack([batch.price[index], batch.volume[index], batch.oi[index]])
+            for accumulator in self.accumulators:
+                accumulator.add(slots, batch.timestamp[index], values, self.session_open)
+
+    def close_due(self, now: float):
+        with self._lock:
+            for accumulator in self.accumulators:
+                accumulator.close_due(now, self.session_close)
+
+    def close_all(self):
+        with self._lock:
+            for accumulator in self.accumulators:
+                accumulator.close_all()
+
+    @property
+    def late_ticks(self) -> int:
+        return sum(a.late_ticks for a in self.accumulators)
+
+    def forming(self, timeframe: str) -> int:
+        accumulator = next(a for a in self.accumulators if a.timeframe == timeframe)
+        return int((accumulator.bucket != NO_BAR).sum())
+
+    def drain(self) -> pd.DataFrame:
+        """Every bar closed since the last drain, in the frame layout bulk_upsert_candles takes."""
+        with self._lock:
+            parts = [(a.timeframe, part) for a in self.accumulators for part in a.drain()]
+            keys = np.array(self.keys, dtype=object)
+        parts = [(tf, p) for tf, p in parts if len(p[0])]
+        if not parts:
+            return pd.DataFrame(columns=["instrument_key", "timeframe", "timestamp", *CANDLE_VALUE_FIELDS])
+        values = np.hstack([p[2] for _, p in parts])
+        frame = pd.DataFrame({
+            "instrument_key": keys[np.concatenate([p[0] for _, p in parts])],
+            "timeframe": np.repeat([tf for tf, _ in parts], [len(p[0]) for _, p in parts]),
+            "timestamp": pd.to_datetime(np.concatenate([p[1] for _, p in parts]), unit="s", utc=True),
+            **{field: values[i] for i, field in enumerate(CANDLE_VALUE_FIELDS)},
+        })
+        frame["volume"] = frame["volume"].astype(np.int64)
+        frame["oi"] = frame["oi"].astype(np.int64)
+        return frame
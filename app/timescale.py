@@ -0,0 +1,87 @@
+# app/timescale.py - Opt-in TimescaleDB storage mode for the candles table
+from sqlalchemy import text
+from app.db import sync_engine
+from dotenv import load_dotenv
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# "timescale" turns candles into a compressed hypertable with a chunk-drop retention backstop,
+# anything else keeps the plain table. Either way the "keep latest 100" delete enforces retention per timeframe.
+CANDLE_STORAGE_MODE = os.getenv("CANDLE_STORAGE_MODE", "plain")
+CANDLE_CHUNK_INTERVAL = os.getenv("CANDLE_CHUNK_INTERVAL", "1 day")
+CANDLE_COMPRESS_AFTER = os.getenv("CANDLE_COMPRESS_AFTER", "3 days")
+# The chunk drop applies to every timeframe at once, so it must outlast the longest one's
+# window: 100 x 1d bars is ~5 months of sessions. It only clears series that stopped updating.
+CANDLE_RETENTION_INTERVAL = os.getenv("CANDLE_RETENTION_INTERVAL", "200 days")
+
+_timescale_active = False
+
+def timescale_active() -> bool:
+    return _timescale_active
+
+def setup_timescale_storage() -> bool:
+    global _timescale_active
+    if CANDLE_STORAGE_MODE != "timescale":
+        return False
+
+    try:
+        with sync_engine.begin() as conn:
+            available = conn.execute(text(
+                "SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb'"
+            )).scalar()
+            if not available:
+                logger.warning("CANDLE_STORAGE_MODE=timescale but the timescaledb extension is not available, falling back to plain Postgres.")
+                return False
+
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS timescaledb"))
+
+            hypertable = conn.execute(text("""
+                SELECT compression_enabled FROM timescaledb_information.hypertables
+                WHERE hypertable_name = 'candles'
+            """)).first()
+
+            if hypertable is None:
+                # Migrate the existing plain table in place. Every unique index on a hypertable
+                # must contain the partitioning column, so the surrogate key becomes (id, timestamp).
+                logger.info("Converting candles to a hypertable, existing rows are migrated into chunks...")
+                conn.execute(text("ALTER TABLE candles DROP CONSTRAINT IF EXISTS candles_pkey"))
+                conn.execute(text("ALTER TABLE candles ADD PRIMARY KEY (id, timestamp)"))
+                conn.execute(text("""
+                    SELECT create_hypertable(
+                        'candles', 'timestamp',
+                        chunk_time_interval => CAST(:chunk_interval AS INTERVAL),
+                        migrate_data => true
+                    )
+                """), {"chunk_interval": CANDLE_CHUNK_INTERVAL})
+
+            if hypertable is None or not hypertable.compression_enabled:
+                conn.execute(text("""
+                    ALTER TABLE candles SET (
+                        timescaledb.compress,
+                        timescaledb.compress_segmentby = 'instrument_key, timeframe',
+                        timescaledb.compress_orderby = 'timestamp DESC'
+                    )
+                """))
+
+            conn.execute(text(
+                "SELECT add_compression_policy('candles', CAST(:after AS INTERVAL), if_not_exists => true)"
+            ), {"after": CANDLE_COMPRESS_AFTER})
+            # Drops whole chunks past the longest timeframe's window, under the per-timeframe
+            # "latest N bars" trim. Re-added so a changed CANDLE_RETENTION_INTERVAL takes effect.
+            conn.execute(text("SELECT remove_retention_policy('candles', if_exists => true)"))
+            conn.execute(text(
+                "SELECT add_retention_policy('candles', CAST(:keep AS INTERVAL))"
+            ), {"keep": CANDLE_RETENTION_INTERVAL})
+
+        _timescale_active = True
+        logger.info(
+            f"TimescaleDB storage enabled for candles (chunk {CANDLE_CHUNK_INTERVAL}, "
+            f"compress after {CANDLE_COMPRESS_AFTER}, retention {CANDLE_RETENTION_INTERVAL})."
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error setting up TimescaleDB storage, falling back to plain Postgres: {e}")
+        return False
@@ -0,0 +1,120 @@
+# app/trading_calendar.py - NSE sessions, holidays and bar closes from a local calendar file
+from dotenv import load_dotenv
+from datetime import date, datetime, time, timedelta
+import numpy as np
+import pytz
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+TRADING_CALENDAR_PATH = os.getenv("TRADING_CALENDAR_PATH", "data/nse_calendar.json")
+
+
+def _parse_time(value: str) -> time:
+    hour, minute = value.split(":")
+    return time(int(hour), int(minute))
+
+
+class TradingCalendar:
+    """Which days the exchange trades and when each session opens and closes.
+
+    Special sessions (Muhurat, weekend budget days, shortened days) override both the
+    weekday rule and the holiday list. Years outside `covered_years` fall back to
+    plain weekdays and log a warning, so a stale file degrades instead of stopping ingestion.
+    """
+
+    def __init__(self, config: dict):
+        self.tz = pytz.timezone(config.get("timezone", "Asia/Kolkata"))
+        regular = config["regular_session"]
+        self.regular_session = (_parse_time(regular["open"]), _parse_time(regular["close"]))
+        self.weekdays = set(config.get("weekdays", [0, 1, 2, 3, 4]))
+        self.holidays = {date.fromisoformat(d): name for d, name in config.get("holidays", {}).items()}
+        self.special_sessions = {
+            date.fromisoformat(d): (_parse_time(s["open"]), _parse_time(s["close"]), s.get("name", ""))
+            for d, s in config.get("special_sessions", {}).items()
+        }
+        self.covered_years = set(config.get("covered_years", []))
+        self._warned_years = set()
+
+    @classmethod
+    def from_file(cls, path: str = TRADING_CALENDAR_PATH) -> "TradingCalendar":
+        with open(path, encoding="utf-8") as f:
+            calendar = cls(json.load(f))
+        logger.info(
+            f"Trading calendar loaded from {path}: {len(calendar.holidays)} holidays, "
+            f"{len(calendar.special_sessions)} special sessions, years {sorted(calendar.covered_years)}."
+        )
+        return calendar
+
+    def covers(self, day: date) -> bool:
+        if day.year in self.covered_years:
+            return True
+        if day.year not in self._warned_years:
+            self._warned_years.add(day.year)
+            logger.warning(f"Trading calendar has no holiday list for {day.year}, assuming every weekday trades.")
+        return False
+
+    def session(self, day: date):
+        """(open, close) as aware datetimes for `day`, or None when the market is closed."""
+        if day in self.special_sessions:
+            open_time, close_time, _ = self.special_sessions[day]
+        elif day.weekday() not in self.weekdays or (day in self.holidays and self.covers(day)):
+            return None
+        else:
+            self.covers(day)
+            open_time, close_time = self.regular_session
+        return (
+            self.tz.localize(datetime.combine(day, open_time)),
+            self.tz.localize(datetime.combine(day, close_time)),
+        )
+
+    def is_trading_day(self, day: date) -> bool:
+        return self.session(day) is not None
+
+    def trading_days(self, first: date, last: date) -> list:
+        return [d for d in (first + timedelta(days=i) for i in range((last - first).days + 1)) if self.is_trading_day(d)]
+
+    def previous_trading_day(self, day: date) -> date:
+        day -= timedelta(days=1)
+        while not self.is_trading_day(day):
+            day -= timedelta(days=1)
+        return day
+
+    def bar_starts(self, day: date, bar_minutes: int = 15) -> np.ndarray:
+        """Epoch (UTC) start of every bar in the session; the last bar is cut at the close."""
+        session = self.session(day)
+        if session is None:
+            return np.empty(0, np.int64)
+        open_ts, close_ts = (int(dt.timestamp()) for dt in session)
+        return np.arange(open_ts, close_ts, bar_minutes * 60, dtype=np.int64)
+
+    def bar_closes(self, day: date, bar_minutes: int = 15) -> list:
+        session = self.session(day)
+        if session is None:
+            return []
+        starts = self.bar_starts(day, bar_minutes)
+        close_ts = int(session[1].timestamp())
+        return [
+            datetime.fromtimestamp(min(int(ts) + bar_minutes * 60, close_ts), self.tz) for ts in starts
+        ]
+
+    def last_bar_close(self, at: datetime, bar_minutes: int = 15):
+        """Latest bar close at or before `at` on the same day, or None before the first one."""
+        closes = [close for close in self.bar_closes(at.astimezone(self.tz).date(), bar_minutes) if close <= at]
+        return closes[-1] if closes else None
+
+    def next_bar_close(self, after: datetime, bar_minutes: int = 15, max_days: int = 30):
+        """First bar close strictly after `after`, looking at most `max_days` ahead."""
+        day = after.astimezone(self.tz).date()
+        for _ in range(max_days):
+            for close in self.bar_closes(day, bar_minutes):
+                if close > after:
+                    return close
+            day += timedelta(days=1)
+        return None
+
+
+trading_calendar = TradingCalendar.from_file()
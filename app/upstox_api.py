@@ -1,49 +1,164 @@
-import upstox_client
-from upstox_client.api import HistoryV3Api
-from upstox_client import Configuration, ApiClient
-import urllib3
-from urllib3.util.retry import Retry
+from app.concurrency import controllers, UPSTOX_INTRADAY_MAX_CONCURRENCY, UPSTOX_HISTORICAL_MAX_CONCURRENCY
+from app.metrics import UPSTOX_RETRIES
+from app.rate_limiter import upstox_rate_limiter
+from app.upstox_replay import UPSTOX_MODE, request_key, recorder, archive, replayed_model
+import orjson
+import threading
+import time
+import os
 import logging
 
 logger = logging.getLogger(__name__)
 
-# 1. Create custom PoolManager
-custom_pool_manager = urllib3.PoolManager(
-    num_pools=100,
-    maxsize=20,
-    retries=Retry(
-        total=3,
-        backoff_factor=0.3,
-        status_forcelist=[429, 500, 502, 503, 504],
-    ),
-)
+UPSTOX_MAX_THROTTLE_RETRIES = int(os.getenv("UPSTOX_MAX_THROTTLE_RETRIES", "3"))
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
 
-# 2. Create config and ApiClient
-configuration = Configuration()
-api_client = ApiClient(configuration=configuration)
+_api_instance = None
+_api_lock = threading.Lock()
 
-# 3. Patch the internal pool manager safely
-api_client.rest_client.pool_manager = custom_pool_manager
+def history_api():
+    """Shared HistoryV3Api, built on first use.
 
-# 4. Instantiate the API with this patched client
-apiInstance = HistoryV3Api(api_client)
+    The SDK pulls in hundreds of generated model modules, so it is imported here rather
+    than at app startup.
+    """
+    global _api_instance
+    if _api_instance is not None:
+        return _api_instance
+    with _api_lock:
+        if _api_instance is None:
+            import urllib3
+            from urllib3.util.retry import Retry
+            from upstox_client.api import HistoryV3Api
+            from upstox_client import Configuration, ApiClient
+
+            # 1. Create custom PoolManager
+            # urllib3 only retries connection errors; 429/5xx surface to the adaptive controllers
+            # in app/concurrency.py, which shrink the window instead of retrying blindly.
+            # status=0 and respect_retry_after_header=False stop urllib3 from retrying and
+            # sleeping on a 413/429/503 that carries Retry-After.
+            custom_pool_manager = urllib3.PoolManager(
+                num_pools=100,
+                maxsize=max(UPSTOX_INTRADAY_MAX_CONCURRENCY, UPSTOX_HISTORICAL_MAX_CONCURRENCY),
+                retries=Retry(
+                    total=3,
+                    status=0,
+                    backoff_factor=0.3,
+                    respect_retry_after_header=False,
+                ),
+            )
+
+            # 2. Create config and ApiClient
+            configuration = Configuration()
+            # Point the SDK at another host, e.g. the local fake server in addhoc/fake_upstox_server.py
+            if os.getenv("UPSTOX_BASE_URL"):
+                configuration.host = os.getenv("UPSTOX_BASE_URL").rstrip("/")
+            api_client = ApiClient(configuration=configuration)
+
+            # 3. Patch the internal pool manager safely
+            api_client.rest_client.pool_manager = custom_pool_manager
+
+            # 4. Instantiate the API with this patched client
+            _api_instance = HistoryV3Api(api_client)
+    return _api_instance
+
+def _call_with_controller(endpoint: str, call):
+    controller = controllers[endpoint]
+    for attempt in range(UPSTOX_MAX_THROTTLE_RETRIES + 1):
+        # the same token buckets as the asyncio engine, so both paths together stay under the caps
+        upstox_rate_limiter.acquire()
+        controller.acquire()
+        started = time.monotonic()
+        status = 200
+        try:
+            return call()
+        except Exception as e:
+            from upstox_client.rest import ApiException  # loaded by history_api() by now
+            if not isinstance(e, ApiException):
+                # connection errors that urllib3 gave up on count against the window like a 5xx
+                status = 599
+                raise
+            status = e.status or 0
+            if status not in THROTTLE_STATUSES or attempt == UPSTOX_MAX_THROTTLE_RETRIES:
+                raise
+            retry_after = (getattr(e, "headers", None) or {}).get("Retry-After")
+        finally:
+            controller.release(time.monotonic() - started, status)
+
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = 0.3 * 2 ** attempt
+        UPSTOX_RETRIES.inc(endpoint=endpoint, status=status)
+        logger.warning(f"Upstox {endpoint} returned {status}, retrying in {delay:.2f}s (window {controller.window}).")
+        time.sleep(delay)
 
 # candles data response structure:
 # response ->response.status, response.data
 # response.data -> list[list[object]]
 def get_historical_candle_data(symbol: str, toDate: str,fromDate: str, timePeriod: str, multiplier: str = "1"):
     try:
-        response = apiInstance.get_historical_candle_data1(symbol, timePeriod, multiplier, toDate, fromDate)
+        key = request_key("historical", symbol, (timePeriod, multiplier, toDate, fromDate))
+        if UPSTOX_MODE == "replay":
+            return replayed_model(archive().get(key))
+        started = time.monotonic()
+        response = _call_with_controller(
+            "historical",
+            lambda: history_api().get_historical_candle_data1(symbol, timePeriod, multiplier, toDate, fromDate),
+        )
+        if UPSTOX_MODE == "record":
+            recorder().record(key, orjson.dumps(response.to_dict()), time.monotonic() - started)
         return response
     except Exception as e:
         print("Exception when calling HistoryV3Api->get_historical_candle_data1: %s\n" % e)
 
 def get_intraday_candle_data(symbol: str, timePeriod: str, multiplier: str = "1"):
     try:
-        response = apiInstance.get_intra_day_candle_data(symbol, timePeriod, multiplier)
+        key = request_key("intraday", symbol, (timePeriod, multiplier))
+        if UPSTOX_MODE == "replay":
+            return replayed_model(archive().get(key))
+        started = time.monotonic()
+        response = _call_with_controller(
+            "intraday",
+            lambda: history_api().get_intra_day_candle_data(symbol, timePeriod, multiplier),
+        )
+        if UPSTOX_MODE == "record":
+            recorder().record(key, orjson.dumps(response.to_dict()), time.monotonic() - started)
         return response
     except Exception as e:
         print("Exception when calling HistoryV3Api->get_intra_day_candle_data: %s\n" % e)
 
+# Raw-body variants for the fast path in app/candle_decoder.py: the SDK hands back the
+# undecoded urllib3 response, skipping its generic model deserializer.
+# Errors propagate (ApiException on non-2xx) so callers can log them per instrument.
+# UPSTOX_MODE=record archives every body, UPSTOX_MODE=replay serves them from the archive (app/upstox_replay.py).
+def get_historical_candle_body(symbol: str, toDate: str, fromDate: str, timePeriod: str, multiplier: str = "1") -> bytes:
+    key = request_key("historical", symbol, (timePeriod, multiplier, toDate, fromDate))
+    if UPSTOX_MODE == "replay":
+        return archive().get(key)
+    started = time.monotonic()
+    response = _call_with_controller(
+        "historical",
+        lambda: history_api().get_historical_candle_data1(
+            symbol, timePeriod, multiplier, toDate, fromDate, _preload_content=False
+        ),
+    )
+    if UPSTOX_MODE == "record":
+        recorder().record(key, response.data, time.monotonic() - started)
+    return response.data
+
+def get_intraday_candle_body(symbol: str, timePeriod: str, multiplier: str = "1") -> bytes:
+    key = request_key("intraday", symbol, (timePeriod, multiplier))
+    if UPSTOX_MODE == "replay":
+        return archive().get(key)
+    started = time.monotonic()
+    response = _call_with_controller(
+        "intraday",
+        lambda: history_api().get_intra_day_candle_data(symbol, timePeriod, multiplier, _preload_content=False),
+    )
+    if UPSTOX_MODE == "record":
+        recorder().record(key, response.data, time.monotonic() - started)
+    return response.data
+
 # get_historical_candle_data("NSE_EQ|INE848E01016", "2025-06-06", "2025-06-06", "minutes")
 # get_intraday_candle_data("NSE_EQ|INE466L01038", "minutes")
\ No newline at end of file
@@ -0,0 +1,273 @@
+# app/upstox_replay.py - Record raw Upstox responses and serve them back in place of the live API
+#
+#   UPSTOX_MODE=record UPSTOX_ARCHIVE=data/archive/2025-06-06 uvicorn app.main:app
+#   python -m app.upstox_replay info data/archive/2025-06-06
+#   python -m app.upstox_replay run data/archive/2025-06-06 --job intraday --profile day.prof
+#
+# An archive is a directory holding responses.bin, the zlib-compressed bodies appended back to
+# back, and index.jsonl with one line per response: key, wall time, offset, length and latency.
+# Replay mmaps responses.bin and decompresses only the bodies that are asked for.
+from dotenv import load_dotenv
+from datetime import date, datetime
+from types import SimpleNamespace
+from urllib.parse import unquote, urlsplit
+import threading
+import asyncio
+import bisect
+import mmap
+import orjson
+import zlib
+import time
+import pytz
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# "live" calls Upstox, "record" calls Upstox and archives every body, "replay" only reads the archive
+UPSTOX_MODE = os.getenv("UPSTOX_MODE", "live")
+UPSTOX_ARCHIVE = os.getenv("UPSTOX_ARCHIVE", "data/upstox_archive")
+# 0 replays each key's responses in order as fast as they are asked for; N > 0 runs a virtual
+# clock N times faster than the recording and also sleeps the recorded latency / N
+UPSTOX_REPLAY_SPEED = float(os.getenv("UPSTOX_REPLAY_SPEED", "0"))
+
+IST = pytz.timezone("Asia/Kolkata")
+BODIES_FILE = "responses.bin"
+INDEX_FILE = "index.jsonl"
+
+
+class ReplayMiss(LookupError):
+    """The archive has no response for this request."""
+
+
+def request_key(endpoint: str, symbol: str, params: tuple) -> str:
+    return f"{endpoint}|{symbol}|{'/'.join(str(p) for p in params)}"
+
+
+def key_from_url(url: str) -> str:
+    # /v3/historical-candle/intraday/{key}/{unit}/{interval}
+    # /v3/historical-candle/{key}/{unit}/{interval}/{to_date}/{from_date}
+    parts = urlsplit(url).path.split("/")[3:]
+    if parts[0] == "intraday":
+        return request_key("intraday", unquote(parts[1]), tuple(parts[2:]))
+    return request_key("historical", unquote(parts[0]), tuple(parts[1:]))
+
+
+class ResponseRecorder:
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._bodies = open(os.path.join(path, BODIES_FILE), "ab")
+        self._index = open(os.path.join(path, INDEX_FILE), "ab")
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def record(self, key: str, body: bytes, latency: float):
+        compressed = zlib.compress(body, 6)
+        with self._lock:
+            offset = self._bodies.tell()
+            self._bodies.write(compressed)
+            self._bodies.flush()
+            # the body is on disk before the index line that points at it
+            self._index.write(orjson.dumps({
+                "k": key, "t": round(time.time(), 3), "o": offset, "n": len(compressed), "l": round(latency, 4),
+            }) + b"\n")
+            self._index.flush()
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            self._bodies.close()
+            self._index.close()
+
+
+class ResponseArchive:
+    def __init__(self, path: str, speed: float = UPSTOX_REPLAY_SPEED):
+        self.path = path
+        self.speed = speed
+        self.entries = {}
+        with open(os.path.join(path, INDEX_FILE), "rb") as f:
+            for line in f:
+                if line.strip():
+                    entry = orjson.loads(line)
+                    self.entries.setdefault(entry["k"], []).append((entry["t"], entry["o"], entry["n"], entry["l"]))
+        for series in self.entries.values():
+            series.sort()
+        self._times = {key: [e[0] for e in series] for key, series in self.entries.items()}
+        self.first_time = min((s[0][0] for s in self.entries.values()), default=0.0)
+        self.last_time = max((s[-1][0] for s in self.entries.values()), default=0.0)
+        self.recorded_day = datetime.fromtimestamp(self.first_time, IST).date() if self.entries else None
+
+        self._file = open(os.path.join(path, BODIES_FILE), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._cursors = {}
+        self._started = None
+        self._lock = threading.Lock()
+        logger.info(
+            f"Replay archive {path}: {sum(len(s) for s in self.entries.values())} responses for "
+            f"{len(self.entries)} requests, speed {speed or 'sequential'}."
+        )
+
+    def cycles(self, endpoint: str = None) -> int:
+        """Most responses recorded for one request, i.e. how many job runs the archive covers."""
+        counts = [len(s) for key, s in self.entries.items() if endpoint is None or key.startswith(f"{endpoint}|")]
+        return max(counts, default=0)
+
+    def _shifted(self, key: str):
+        """`key` with its dates moved from today onto the recording day.
+
+        The historical job asks for "yesterday back two weeks", so a replay on a later day
+        requests other dates than were recorded; ranges fixed in absolute dates (backfill)
+        still match exactly and never get here.
+        """
+        prefix, _, params = key.rpartition("|")
+        if not prefix.startswith("historical|") or self.recorded_day is None:
+            return None
+        shift = self.recorded_day - datetime.now(IST).date()
+        parts = params.split("/")
+        for i, part in enumerate(parts):
+            try:
+                parts[i] = (date.fromisoformat(part) + shift).isoformat()
+            except ValueError:
+                pass
+        return f"{prefix}|{'/'.join(parts)}"
+
+    def _entry(self, key: str):
+        series = self.entries.get(key)
+        if not series:
+            shifted = self._shifted(key)
+            series = self.entries.get(shifted) if shifted else None
+            if not series:
+                raise ReplayMiss(f"no recorded response for {key}")
+            key = shifted
+        with self._lock:
+            if not self.speed:
+                # Sequential: every call gets the next response; the last one repeats once exhausted
+                index = self._cursors.get(key, 0)
+                self._cursors[key] = index + 1
+                return series[min(index, len(series) - 1)]
+            if self._started is None:
+                self._started = time.monotonic()
+            virtual_now = self.first_time + (time.monotonic() - self._started) * self.speed
+        # what the live API would have answered at that moment: the latest response recorded by then
+        index = bisect.bisect_right(self._times[key], virtual_now) - 1
+        return series[max(index, 0)]
+
+    def _body(self, entry) -> bytes:
+        _, offset, length, _ = entry
+        return zlib.decompress(self._map[offset:offset + length])
+
+    def _delay(self, entry) -> float:
+        return entry[3] / self.speed if self.speed else 0.0
+
+    def get(self, key: str) -> bytes:
+        entry = self._entry(key)
+        delay = self._delay(entry)
+        if delay:
+            time.sleep(delay)
+        return self._body(entry)
+
+    async def get_async(self, key: str) -> bytes:
+        entry = self._entry(key)
+        delay = self._delay(entry)
+        if delay:
+            await asyncio.sleep(delay)
+        return self._body(entry)
+
+
+_recorder = None
+_archive = None
+_lock = threading.Lock()
+
+
+def recorder() -> ResponseRecorder:
+    global _recorder
+    with _lock:
+        if _recorder is None:
+            _recorder = ResponseRecorder(UPSTOX_ARCHIVE)
+            logger.info(f"Recording Upstox responses to {UPSTOX_ARCHIVE}.")
+        return _recorder
+
+
+def archive() -> ResponseArchive:
+    global _archive
+    with _lock:
+        if _archive is None:
+            _archive = ResponseArchive(UPSTOX_ARCHIVE)
+        return _archive
+
+
+def replayed_model(body: bytes):
+    """Stand-in for the SDK response model: the jobs only read .status and .data.candles."""
+    payload = orjson.loads(body)
+    return SimpleNamespace(status=payload.get("status"), data=SimpleNamespace(**(payload.get("data") or {})))
+
+
+def _print_info(path: str):
+    replay = ResponseArchive(path)
+    endpoints = {}
+    for key, series in replay.entries.items():
+        endpoints[key.split("|", 1)[0]] = endpoints.get(key.split("|", 1)[0], 0) + len(series)
+    compressed = os.path.getsize(os.path.join(path, BODIES_FILE))
+    print(f"archive   {path}")
+    print(f"requests  {len(replay.entries)}")
+    for endpoint, count in sorted(endpoints.items()):
+        print(f"  {endpoint:<10} {count} responses, {replay.cycles(endpoint)} cycles")
+    print(f"span      {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(replay.first_time))} .. "
+          f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(replay.last_time))}")
+    print(f"size      {compressed / 1e6:.1f} MB compressed")
+
+
+def _run_jobs(path: str, job: str, cycles: int = None, profile: str = None):
+    # Set before the job modules import upstox_api and read the mode
+    os.environ.update({"UPSTOX_MODE": "replay", "UPSTOX_ARCHIVE": path})
+    from app.logging_config import setup_logging
+    from app.jobs.load_intraday_15m_candles import loadIntradayFifteenMinutesCandles
+    from app.jobs.load_historical_15m_candles import loadHistoricalFifteenMinutesCandles
+    # the instance upstox_api uses; under `python -m` this file itself runs as __main__
+    from app import upstox_replay
+
+    setup_logging()
+    runner = {"intraday": loadIntradayFifteenMinutesCandles, "historical": loadHistoricalFifteenMinutesCandles}[job]()
+    cycles = cycles or upstox_replay.archive().cycles(job)
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    started = time.monotonic()
+    for cycle in range(cycles):
+        cycle_started = time.monotonic()
+        runner.run()
+        logger.info(f"Replay {job} cycle {cycle + 1}/{cycles} took {time.monotonic() - cycle_started:.2f}s.")
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
+    print(f"{cycles} {job} cycles replayed in {time.monotonic() - started:.1f}s"
+          + (f", profile written to {profile}" if profile else ""))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or replay a recorded Upstox response archive")
+    commands = parser.add_subparsers(dest="command", required=True)
+    info = commands.add_parser("info", help="summarize an archive")
+    info.add_argument("archive")
+    run = commands.add_parser("run", help="run a candle job against the archive, once per recorded cycle")
+    run.add_argument("archive")
+    run.add_argument("--job", choices=["intraday", "historical"], default="intraday")
+    run.add_argument("--cycles", type=int, help="default: every cycle in the archive")
+    run.add_argument("--profile", help="write cProfile stats to this file")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        _print_info(args.archive)
+    else:
+        _run_jobs(args.archive, args.job, args.cycles, args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,66 @@
-# app/utils/ingest_instruments.py
-
+# app/utils/ingest_instruments.py - Streaming reader for the gzipped Upstox instrument master
+from app.db import sync_engine
+from dotenv import load_dotenv
+from contextlib import contextmanager
+from urllib.request import urlopen
+import gzip
 import csv
-from sqlalchemy.orm import Session
-from app.models import Instrument
+import io
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+INSTRUMENT_MASTER_URL = os.getenv(
+    "INSTRUMENT_MASTER_URL", "https://assets.upstox.com/market-quote/instruments/exchange/complete.csv.gz"
+)
+# Exchange segments kept from the master; indices, currency and commodity rows are dropped while parsing
+INSTRUMENT_SEGMENTS = set(os.getenv("INSTRUMENT_SEGMENTS", "NSE_EQ,BSE_EQ,NSE_FO,BSE_FO").split(","))
+UNCLASSIFIED_INDUSTRY = "Unclassified"
+
+
+@contextmanager
+def _open_source(source: str):
+    # A URL is read straight off the socket, so the compressed file never sits on disk or in memory
+    raw = urlopen(source, timeout=60) if source.startswith(("http://", "https://")) else open(source, "rb")
+    try:
+        yield io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding="utf-8", newline="")
+    finally:
+        raw.close()
 
-def load_instruments(csv_file: str, db: Session):
-    with open(csv_file, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        count = 0
+
+def iter_instrument_master(source: str = INSTRUMENT_MASTER_URL, segments: set = INSTRUMENT_SEGMENTS, universe: dict = None):
+    """Yield (instrument_key, trading_symbol, company_name, industry, segment, instrument_type, active).
+
+    The file is decompressed and parsed one row at a time. `universe` maps the instrument
+    keys the candle jobs should fetch to their (company_name, industry) from the curated CSV;
+    those rows are marked active and keep the curated names.
+    """
+    universe = universe or {}
+    with _open_source(source) as text:
+        reader = csv.reader(text)
+        header = {name: i for i, name in enumerate(next(reader))}
+        key, symbol, name = header["instrument_key"], header["tradingsymbol"], header["name"]
+        segment, instrument_type = header["exchange"], header["instrument_type"]
+
+        kept = 0
         for row in reader:
-            if row.get("instrument_type") != "EQUITY":
+            if row[segment] not in segments:
                 continue
-
-            instrument = Instrument(
-                instrument_key=row["instrument_key"],
-                exchange_token=row.get("exchange_token"),
-                trading_symbol=row.get("trading_symbol"),
-                name=row["name"],
-                tick_size=row.get("tick_size"),
+            curated = universe.get(row[key])
+            company_name, industry = curated or (row[name] or row[symbol], UNCLASSIFIED_INDUSTRY)
+            kept += 1
+            yield (
+                row[key], row[symbol] or None, company_name, industry,
+                row[segment], row[instrument_type] or None, curated is not None,
             )
-            db.merge(instrument)
-            count += 1
+    logger.info(f"Instrument master parsed: {kept} rows in segments {', '.join(sorted(segments))}.")
+
 
-        db.commit()
-        print(f"Ingested {count} EQUITY instruments.")
\ No newline at end of file
+def migrate_instruments_table():
+    # create_all() never alters an existing table, so add the columns introduced with the master loader
+    with sync_engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE instruments ADD COLUMN IF NOT EXISTS segment VARCHAR")
+        conn.exec_driver_sql("ALTER TABLE instruments ADD COLUMN IF NOT EXISTS instrument_type VARCHAR")
+        conn.exec_driver_sql("ALTER TABLE instruments ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT true")
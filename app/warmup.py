@@ -0,0 +1,132 @@
+# app/warmup.py - Startup work run on a background thread so the API serves requests immediately
+#
+# Modules that pull in pandas, numpy-heavy code or the Upstox SDK are imported inside the steps,
+# so importing app.main stays cheap and uvicorn starts accepting connections right away.
+from app.coordination import INGEST_ROLE
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _prepare_schema():
+    from app.db import Base, sync_engine
+    from app import models  # noqa: F401 - registers the tables with Base.metadata
+    from app.utils.ingest_instruments import migrate_instruments_table
+    from app.timescale import setup_timescale_storage
+    from app.compact_candles import setup_compact_schema
+
+    Base.metadata.create_all(bind=sync_engine)
+    logger.info("Database tables created successfully")
+    migrate_instruments_table()
+    # Opt-in hypertable/compression/retention (CANDLE_STORAGE_MODE=timescale)
+    setup_timescale_storage()
+    # Opt-in compact candle layout (CANDLE_SCHEMA=compact)
+    setup_compact_schema()
+
+
+def _warm_candle_store():
+    from app.candle_store import candle_store, CANDLE_STORE_ENABLED
+    from app.delta_tracker import delta_tracker
+
+    # Warm the in-memory candle store before the jobs start appending to it
+    if CANDLE_STORE_ENABLED:
+        candle_store.rebuild_from_db()
+        delta_tracker.seed_from_store(candle_store)
+
+
+def _warm_indicators():
+    from app.indicators import update_indicators
+
+    update_indicators()
+
+
+class Warmup:
+    """Ordered startup steps with per-step status and timings, reported by /ready.
+
+    Steps run one after another on a daemon thread. The first failure stops the sequence,
+    just as an exception used to abort the inline startup hook, and leaves the service not ready.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.jobs = []
+        self.started_at = None
+        self.finished_at = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, func):
+        self.steps.append({"name": name, "func": func, "status": "pending", "duration_ms": None, "error": None})
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        for step in self.steps:
+            step["status"] = "running"
+            started = time.monotonic()
+            try:
+                step["func"]()
+                step["status"] = "done"
+            except Exception as e:
+                step["status"] = "failed"
+                step["error"] = str(e)
+                logger.error(f"Warmup step {step['name']} failed: {e}")
+                break
+            finally:
+                step["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            logger.info(f"Warmup step {step['name']} finished in {step['duration_ms']:.0f} ms.")
+        self.finished_at = time.monotonic()
+        if self.ready:
+            logger.info(f"Warmup finished in {self.finished_at - self.started_at:.1f}s.")
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.steps) and all(step["status"] == "done" for step in self.steps)
+
+    def status(self) -> dict:
+        if self.ready:
+            state = "ready"
+        elif any(step["status"] == "failed" for step in self.steps):
+            state = "failed"
+        else:
+            state = "warming"
+        end = self.finished_at or time.monotonic()
+        return {
+            "status": state,
+            "elapsed_s": round(end - self.started_at, 2) if self.started_at else 0.0,
+            "steps": [{k: v for k, v in step.items() if k != "func"} for step in self.steps],
+        }
+
+    def _register_jobs(self):
+        from app.jobs.registry import register_all_jobs
+
+        self.jobs = register_all_jobs()
+
+    def _run_job_warmups(self):
+        # Registry order: the heartbeat joins the hash ring, then the instrument sync, then the
+        # intraday catch-up run over whatever that sync left active
+        for job in self.jobs:
+            job.warmup()
+
+
+warmup = Warmup()
+
+
+def start_warmup():
+    if not warmup.steps:
+        warmup.add("schema", _prepare_schema)
+        warmup.add("register_jobs", warmup._register_jobs)
+        warmup.add("candle_store", _warm_candle_store)
+        # ingestion-only workers serve no /indicators
+        if INGEST_ROLE != "worker":
+            warmup.add("indicators", _warm_indicators)
+        warmup.add("job_warmup", warmup._run_job_warmups)
+    warmup.start()
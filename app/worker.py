@@ -0,0 +1,112 @@
+# app/worker.py - Ingestion-only processes, one hash-ring member each
+#
+#   python -m app.worker                 # one worker
+#   python -m app.worker --processes 4   # one per core; each owns its own shard of the universe
+#
+# Run the API with INGEST_ROLE=api next to these so it scales out without adding Upstox traffic.
+import os
+
+# Set before any app module reads it; spawned children inherit the environment
+os.environ["INGEST_ROLE"] = "worker"
+
+from app.logging_config import setup_logging
+from app.jobs.scheduler import start_scheduler, shutdown_scheduler
+from app.coordination import worker_lease
+from app.warmup import warmup, start_warmup
+from app.market_feed import market_feed
+from app.metrics import render as render_metrics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+import multiprocessing
+import argparse
+import threading
+import signal
+import logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Worker n of --processes serves /metrics on WORKER_METRICS_PORT + n; unset disables it
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int):
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Worker metrics on :{port}/metrics")
+
+
+def run_worker(slot: int = 0):
+    setup_logging()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    logger.info(f"Ingestion worker {worker_lease.worker_id} starting.")
+    if WORKER_METRICS_PORT:
+        serve_metrics(WORKER_METRICS_PORT + slot)
+    start_scheduler()
+    start_warmup()
+    stop.wait()
+
+    shutdown_scheduler()
+    market_feed.stop()
+    worker_lease.release()
+    logger.info(f"Ingestion worker {worker_lease.worker_id} stopped ({warmup.status()['status']} at shutdown).")
+
+
+def supervise(processes: int):
+    """Keep `processes` workers running; a crashed one is replaced by a new ring member."""
+    context = multiprocessing.get_context("spawn")
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    # one slot per process, so a replacement reuses its predecessor's metrics port
+    children = [None] * processes
+    while not stopping.is_set():
+        for slot, child in enumerate(children):
+            if child is not None and child.is_alive():
+                continue
+            if child is not None:
+                logger.warning(f"Ingestion worker pid {child.pid} exited with code {child.exitcode}, starting a replacement.")
+            children[slot] = context.Process(target=run_worker, args=(slot,), name=f"ingest-worker-{slot}")
+            children[slot].start()
+        stopping.wait(5)
+
+    for child in children:
+        child.terminate()
+    for child in children:
+        child.join(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run ingestion workers that share the instrument universe")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes on this host")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker()
+    else:
+        setup_logging()
+        supervise(args.processes)
+
+
+if __name__ == "__main__":
+    main()